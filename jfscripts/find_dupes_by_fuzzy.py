@@ -0,0 +1,998 @@
+#! /usr/bin/env python3
+
+from __future__ import annotations
+
+import argparse
+import array
+import codecs
+import contextlib
+import difflib
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import zlib
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from jfscripts import __version__
+from jfscripts.list_files import match_glob
+
+THRESHOLD = 90
+"""The minimum similarity (0 to 100) of two names to be reported."""
+
+NGRAM = 3
+"""The length of the character n-grams (shingles) of a name."""
+
+BANDS = 32
+"""The number of LSH bands. More bands find more candidate pairs."""
+
+ROWS = 4
+"""The number of MinHash values per band. More rows find fewer, but more
+similar candidate pairs."""
+
+MAX_BUCKET = 100
+"""Buckets with more names than this are not compared pair by pair. They
+hold names that share a frequent shingle (e. g. an extension) or long
+series like thousands of ``IMG_1234.JPG``."""
+
+WINDOW = 10
+"""The number of successors in sorted order each name of an oversized
+bucket is compared with."""
+
+PAIR_BATCH = 10000
+"""Number of candidate pairs scored in one task of the process pool."""
+
+SIGNATURE_BATCH = 10000
+"""Number of names whose signatures are computed in one task of the
+process pool."""
+
+MAX_DISTANCE = 2
+"""The maximum edit distance of a query to the names of an index."""
+
+MAX_BITS = 3
+"""The maximum number of differing bits of the SimHash fingerprints of two
+similar text files."""
+
+CHUNK_SIZE = 1024 * 1024
+"""Number of bytes of a text file read at once to compute its SimHash."""
+
+_PRIME = (1 << 61) - 1
+_BITS = 16
+_LANE = _BITS + 1
+"""Each MinHash value takes 16 bits plus a guard bit in the packed
+signature."""
+_SEPARATORS = re.compile(r"[\s_.\-]+")
+_WORD = re.compile(r"\w+")
+_MAX_WORD = 64
+"""Longer words are cut to this number of characters for the SimHash, so
+that a file without separators is not collected in memory as a whole."""
+
+_FINGERPRINT_BITS = 64
+_COUNTER = 40
+"""The width of the counter of each fingerprint bit in the packed sums of
+:func:`simhash`."""
+_SPREAD = [
+    sum(1 << (bit * _COUNTER) for bit in range(8) if byte >> bit & 1)
+    for byte in range(256)
+]
+"""The bits of each byte value moved to the lowest bit of one counter
+each."""
+
+
+def normalize(name: str) -> str:
+    """Fold the case of a file name and replace runs of whitespace, dots,
+    dashes and underscores by a single space."""
+    return _SEPARATORS.sub(" ", name.lower()).strip()
+
+
+def shingles(name: str, n: int = NGRAM) -> Set[str]:
+    """The character n-grams of a name. The name is padded with a space on
+    both sides, so that names shorter than ``n`` still have one shingle and
+    the first and the last characters weigh as much as the others."""
+    padded = " {} ".format(name)
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i : i + n] for i in range(len(padded) - n + 1)}
+
+
+class MinHasher:
+    """Compute MinHash signatures of the shingle sets of names.
+
+    The share of equal values of two signatures estimates the Jaccard
+    similarity of the two sets. The 16 bit values of a signature are packed
+    into the lanes of a single integer, so that the element-wise minimum of
+    two signatures takes a handful of integer operations instead of a loop
+    over the values. The packed values of each shingle are computed once
+    and cached.
+
+    :param num_perm: The number of hash functions, the length of a
+      signature.
+    :param ngram: The length of the shingles.
+    :param seed: The seed of the hash functions.
+    """
+
+    def __init__(self, num_perm: int, ngram: int = NGRAM, seed: int = 0) -> None:
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.ngram = ngram
+        self.permutations = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+            for _ in range(num_perm)
+        ]
+        self.guards = sum(1 << (i * _LANE + _BITS) for i in range(num_perm))
+        self.values: Dict[str, int] = {}
+
+    def _values(self, shingle: str) -> int:
+        values = self.values.get(shingle)
+        if values is None:
+            x = zlib.crc32(shingle.encode("utf-8", "surrogateescape"))
+            values = 0
+            for i, (a, b) in enumerate(self.permutations):
+                values |= ((a * x + b) % _PRIME >> 29 & 0xFFFF) << (i * _LANE)
+            self.values[shingle] = values
+        return values
+
+    def signatures(self, names: Iterable[str]) -> List[int]:
+        """The packed MinHash signatures of several names."""
+        return [self.signature(name) for name in names]
+
+    def signature(self, name: str) -> int:
+        """The packed MinHash signature of a (normalized) name."""
+        guards = self.guards
+        result: Optional[int] = None
+        for shingle in shingles(name, self.ngram):
+            values = self._values(shingle)
+            if result is None:
+                result = values
+                continue
+            # The guard bit of a lane survives the subtraction if the lane
+            # of result is not smaller. Spread it to a mask of the lane and
+            # take the lanes of values where it is set.
+            ge = ((result | guards) - values & guards) >> _BITS
+            result ^= (result ^ values) & ge * 0xFFFF
+        assert result is not None
+        return result
+
+    def unpack(self, signature: int) -> List[int]:
+        """The values of a packed signature."""
+        return [signature >> (i * _LANE) & 0xFFFF for i in range(self.num_perm)]
+
+
+class DisjointSet:
+    """Union-find over the integers ``0`` to ``size - 1`` to merge the
+    matching pairs into clusters."""
+
+    def __init__(self, size: int) -> None:
+        self.parents = list(range(size))
+
+    def find(self, item: int) -> int:
+        parents = self.parents
+        root = item
+        while parents[root] != root:
+            root = parents[root]
+        while parents[item] != root:
+            parents[item], item = root, parents[item]
+        return root
+
+    def union(self, a: int, b: int) -> None:
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a != root_b:
+            self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    def groups(self) -> List[List[int]]:
+        """The sets with more than one member, sorted by their smallest
+        member."""
+        groups: Dict[int, List[int]] = {}
+        for item in range(len(self.parents)):
+            groups.setdefault(self.find(item), []).append(item)
+        return [group for group in groups.values() if len(group) > 1]
+
+
+def similarity(a: str, b: str) -> int:
+    """The similarity of two names from 0 to 100, computed like the
+    ``ratio`` of fuzzywuzzy: twice the number of matching characters
+    divided by the total number of characters."""
+    return round(100 * difflib.SequenceMatcher(None, a, b).ratio())
+
+
+def candidate_pairs(
+    signatures: Sequence[int], bands: int, rows: int
+) -> Iterator[Tuple[int, int]]:
+    """Yield the pairs of indexes whose signatures agree in all rows of at
+    least one band (locality-sensitive hashing). A pair may be yielded once
+    per band it shares.
+
+    The bands are bucketed one after another, so that only the buckets of
+    one band are in memory at a time.
+    """
+    mask = (1 << (rows * _LANE)) - 1
+    for band in range(bands):
+        shift = band * rows * _LANE
+        buckets: Dict[int, List[int]] = {}
+        for index, signature in enumerate(signatures):
+            buckets.setdefault(signature >> shift & mask, []).append(index)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) <= MAX_BUCKET:
+                for i, a in enumerate(members):
+                    for b in members[i + 1 :]:
+                        yield a, b
+            else:
+                for i, a in enumerate(members):
+                    for b in members[i + 1 : i + 1 + WINDOW]:
+                        yield a, b
+
+
+class PairScorer:
+    """Score pairs of names against a threshold.
+
+    :param names: The names the pairs of indexes refer to.
+    :param threshold: The minimum similarity from 0 to 100.
+    """
+
+    def __init__(self, names: Sequence[str], threshold: int) -> None:
+        self.names = names
+        self.threshold = threshold
+        self.matcher = difflib.SequenceMatcher(None, "", "")
+
+    def match(self, a: int, b: int) -> bool:
+        """Whether the similarity of two names reaches the threshold."""
+        name_a = self.names[a]
+        name_b = self.names[b]
+        # The ratio cannot exceed the share of the shorter name.
+        length = len(name_a) + len(name_b)
+        if 200 * min(len(name_a), len(name_b)) < (self.threshold - 0.5) * length:
+            return False
+        # The pairs of a bucket arrive grouped by their first name, so the
+        # matcher indexes it only once for all of its partners.
+        if self.matcher.b is not name_a:
+            self.matcher.set_seq2(name_a)
+        self.matcher.set_seq1(name_b)
+        return round(100 * self.matcher.ratio()) >= self.threshold
+
+    def __call__(self, pairs: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """The matching pairs of a batch."""
+        return [(a, b) for a, b in pairs if self.match(a, b)]
+
+
+_hasher: Optional[MinHasher] = None
+_scorer: Optional[PairScorer] = None
+"""The state of a worker process, see :func:`_init_worker`."""
+
+
+def _init_worker(hasher: MinHasher, names: Sequence[str], threshold: int) -> None:
+    # The names are sent once per worker instead of with every batch, and
+    # the shingle values the hasher caches are reused across batches.
+    global _hasher, _scorer
+    _hasher = hasher
+    _scorer = PairScorer(names, threshold)
+
+
+def _signatures(start: int, end: int) -> List[int]:
+    assert _hasher is not None and _scorer is not None
+    return _hasher.signatures(_scorer.names[start:end])
+
+
+def _score(pairs: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    assert _scorer is not None
+    return _scorer(pairs)
+
+
+def _batches(
+    pairs: Iterable[Tuple[int, int]], size: int
+) -> Iterator[List[Tuple[int, int]]]:
+    iterator = iter(pairs)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def score_pairs(
+    names: Sequence[str],
+    pairs: Iterable[Tuple[int, int]],
+    threshold: int = THRESHOLD,
+    executor: Optional[ProcessPoolExecutor] = None,
+    jobs: int = 1,
+) -> Iterator[Tuple[int, int]]:
+    """Yield the pairs whose similarity reaches ``threshold``.
+
+    Without an executor the pairs are scored one by one, so that the
+    consumer can skip pairs that are already known to match. With an
+    executor (whose workers were set up by :func:`_init_worker`) batches of
+    :data:`PAIR_BATCH` pairs are scored in parallel. Only the matching pairs
+    are sent back, as soon as a batch is done, and at most two batches per
+    worker are pending, so that the pairs are never all in memory.
+
+    :param jobs: The number of workers of the executor.
+    """
+    if executor is None:
+        scorer = PairScorer(names, threshold)
+        for a, b in pairs:
+            if scorer.match(a, b):
+                yield a, b
+        return
+
+    pending: Set[Future[List[Tuple[int, int]]]] = set()
+    for batch in _batches(pairs, PAIR_BATCH):
+        pending.add(executor.submit(_score, batch))
+        if len(pending) >= 2 * jobs:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+    for future in as_completed(pending):
+        yield from future.result()
+
+
+def find_clusters(
+    names: Sequence[str],
+    threshold: int = THRESHOLD,
+    ngram: int = NGRAM,
+    bands: int = BANDS,
+    rows: int = ROWS,
+    seed: int = 0,
+    jobs: int = 1,
+) -> List[List[int]]:
+    """Cluster similar names.
+
+    Candidate pairs are found with MinHash signatures of the character
+    n-grams and locality-sensitive hashing, so that only a small share of
+    all pairs is scored. Pairs with a similarity of at least ``threshold``
+    are merged into clusters (single linkage): a name belongs to a cluster
+    if it is similar to any of its members.
+
+    :param names: Distinct, sorted names.
+    :param threshold: The minimum similarity from 0 to 100.
+    :param ngram: The length of the shingles.
+    :param bands: The number of LSH bands.
+    :param rows: The number of signature values per band.
+    :param seed: The seed of the MinHash functions.
+    :param jobs: The number of processes to compute the signatures and to
+      score the pairs in.
+
+    :return: The clusters as lists of indexes into ``names``.
+    """
+    hasher = MinHasher(bands * rows, ngram, seed)
+    with contextlib.ExitStack() as stack:
+        executor: Optional[ProcessPoolExecutor] = None
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=jobs,
+                    initializer=_init_worker,
+                    initargs=(hasher, names, threshold),
+                )
+            )
+
+        if executor:
+            starts = range(0, len(names), SIGNATURE_BATCH)
+            signatures: List[int] = []
+            for chunk in executor.map(
+                _signatures, starts, [start + SIGNATURE_BATCH for start in starts]
+            ):
+                signatures.extend(chunk)
+        else:
+            signatures = hasher.signatures(names)
+            hasher.values.clear()
+
+        clusters = DisjointSet(len(names))
+        scored: Set[Tuple[int, int]] = set()
+
+        def unscored() -> Iterator[Tuple[int, int]]:
+            for pair in candidate_pairs(signatures, bands, rows):
+                if pair in scored or clusters.find(pair[0]) == clusters.find(pair[1]):
+                    continue
+                scored.add(pair)
+                yield pair
+
+        for a, b in score_pairs(names, unscored(), threshold, executor, jobs):
+            clusters.union(a, b)
+    return clusters.groups()
+
+
+def simhash(counts: Dict[str, int]) -> int:
+    """The 64 bit SimHash fingerprint of a document (Charikar): each bit is
+    set if the words with this bit set in their hash outweigh the others.
+    Documents that differ in a few words get fingerprints that differ in a
+    few bits.
+
+    The bits of each word hash are spread into 64 counters packed into one
+    integer with a table lookup per byte, so that adding a weighted hash is
+    a few integer operations instead of a loop over the bits.
+
+    :param counts: The number of occurrences of each word.
+    """
+    sums = 0
+    total = 0
+    for word, count in counts.items():
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        spread = 0
+        for i, byte in enumerate(digest):
+            spread |= _SPREAD[byte] << (i * 8 * _COUNTER)
+        sums += spread * count
+        total += count
+    mask = (1 << _COUNTER) - 1
+    fingerprint = 0
+    for bit in range(_FINGERPRINT_BITS):
+        if 2 * (sums >> (bit * _COUNTER) & mask) > total:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def simhash_file(path: str, chunk_size: int = CHUNK_SIZE) -> Optional[int]:
+    """Compute the SimHash of a text file read in chunks. The words are
+    compared case-insensitively, so that whitespace, line breaks and case do
+    not change the fingerprint. Only the first 64 characters of a word
+    count.
+
+    :return: The fingerprint or ``None`` for binary files (with a NUL byte
+      in the first chunk) and files without words.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    counts: Dict[str, int] = {}
+    carry = ""
+    with open(path, "rb", buffering=0) as f:
+        first = True
+        while True:
+            chunk = f.read(chunk_size)
+            if first and b"\0" in chunk:
+                return None
+            first = False
+            text = carry + decoder.decode(chunk, final=not chunk).lower()
+            carry = ""
+            for match in _WORD.finditer(text):
+                word = match.group()[:_MAX_WORD]
+                if chunk and match.end() == len(text):
+                    # The word may continue in the next chunk.
+                    carry = word
+                else:
+                    counts[word] = counts.get(word, 0) + 1
+            if not chunk:
+                break
+    if not counts:
+        return None
+    return simhash(counts)
+
+
+def _bit_count(value: int) -> int:
+    # int.bit_count() is only available on Python 3.10+.
+    return bin(value).count("1")
+
+
+def hamming_pairs(
+    fingerprints: Sequence[int], max_bits: int = MAX_BITS
+) -> Iterator[Tuple[int, int]]:
+    """Yield the pairs of indexes whose fingerprints differ in at most
+    ``max_bits`` bits.
+
+    The fingerprints are split into ``max_bits + 1`` bands (two at least). Two
+    fingerprints within the distance agree in at least one band, so only
+    the fingerprints sharing a band are compared. The bands are sorted one
+    after another as 64 bit keys of the band and the index, so that
+    besides the fingerprints only one such array is in memory. A pair may
+    be yielded once per band it shares.
+    """
+    # Two bands at least, so that a band and an index fit into 64 bits.
+    bands = max(max_bits + 1, 2)
+    width = _FINGERPRINT_BITS // bands
+    for band in range(bands):
+        shift = band * width
+        if band == bands - 1:
+            width = _FINGERPRINT_BITS - shift
+        mask = (1 << width) - 1
+        index_bits = max(1, (len(fingerprints) - 1).bit_length())
+        keys = array.array(
+            "Q",
+            sorted(
+                (fingerprint >> shift & mask) << index_bits | index
+                for index, fingerprint in enumerate(fingerprints)
+            ),
+        )
+        index_mask = (1 << index_bits) - 1
+        start = 0
+        for end in range(1, len(keys) + 1):
+            if end < len(keys) and keys[end] >> index_bits == keys[start] >> index_bits:
+                continue
+            for i in range(start, end):
+                a = keys[i] & index_mask
+                for j in range(i + 1, end):
+                    b = keys[j] & index_mask
+                    if _bit_count(fingerprints[a] ^ fingerprints[b]) <= max_bits:
+                        yield a, b
+            start = end
+
+
+def levenshtein(a: str, b: str) -> int:
+    """The edit distance of two names: the number of inserted, deleted or
+    substituted characters to turn one into the other.
+
+    The columns of the distance matrix are computed as bit vectors of
+    ``a`` (Myers' algorithm), so each character of ``b`` costs a few integer
+    operations instead of a loop over ``a``.
+    """
+    if not a:
+        return len(b)
+    if not b:
+        return len(a)
+    masks: Dict[str, int] = {}
+    for i, char in enumerate(a):
+        masks[char] = masks.get(char, 0) | 1 << i
+    full = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    positive = full
+    negative = 0
+    distance = len(a)
+    for char in b:
+        match = masks.get(char, 0)
+        vertical = match | negative
+        horizontal = ((match & positive) + positive ^ positive) | match
+        horizontal_positive = negative | ~(horizontal | positive)
+        horizontal_negative = positive & horizontal
+        if horizontal_positive & last:
+            distance += 1
+        elif horizontal_negative & last:
+            distance -= 1
+        horizontal_positive = horizontal_positive << 1 | 1
+        horizontal_negative <<= 1
+        positive = (horizontal_negative | ~(vertical | horizontal_positive)) & full
+        negative = horizontal_positive & vertical & full
+    return distance
+
+
+class BKTree:
+    """A Burkhard-Keller tree of names with the paths of their files.
+
+    The children of a node are keyed by their edit distance to it. By the
+    triangle inequality, only the children whose key differs by at most
+    ``max_distance`` from the distance of the query to the node can hold
+    matches, so a search visits a small part of the tree.
+    """
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.paths: List[List[str]] = []
+        self.children: List[Optional[Dict[int, int]]] = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _append(self, name: str, paths: List[str]) -> int:
+        self.names.append(name)
+        self.paths.append(paths)
+        self.children.append(None)
+        return len(self.names) - 1
+
+    def add(self, name: str, paths: Sequence[str] = ()) -> None:
+        """Add a name, or the paths to an existing one."""
+        if not self.names:
+            self._append(name, list(paths))
+            return
+        node = 0
+        while True:
+            distance = levenshtein(name, self.names[node])
+            if distance == 0:
+                self.paths[node].extend(paths)
+                return
+            children = self.children[node]
+            if children is None:
+                children = self.children[node] = {}
+            child = children.get(distance)
+            if child is None:
+                children[distance] = self._append(name, list(paths))
+                return
+            node = child
+
+    def search(self, name: str, max_distance: int) -> List[Tuple[int, int]]:
+        """Find the names within an edit distance.
+
+        :return: Tuples ``(distance, node)``, sorted by distance and name.
+        """
+        if not self.names:
+            return []
+        matches: List[Tuple[int, int]] = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            distance = levenshtein(name, self.names[node])
+            if distance <= max_distance:
+                matches.append((distance, node))
+            children = self.children[node]
+            if children:
+                low = distance - max_distance
+                high = distance + max_distance
+                stack.extend(
+                    child for key, child in children.items() if low <= key <= high
+                )
+        matches.sort(key=lambda match: (match[0], self.names[match[1]]))
+        return matches
+
+
+INDEX_VERSION = 1
+
+
+def write_index(tree: BKTree, root: str, f: TextIO) -> None:
+    """Save a tree: a header with the searched directory and one line per
+    node with the index of its parent, its distance to the parent and the
+    name and the paths as a JSON list. The parents precede their
+    children."""
+    f.write(
+        "# find-dupes-by-fuzzy.py index {} {}\n".format(
+            INDEX_VERSION, json.dumps(os.path.abspath(root))
+        )
+    )
+    parents: List[Tuple[int, int]] = [(-1, 0)] * len(tree)
+    for node, children in enumerate(tree.children):
+        for distance, child in (children or {}).items():
+            parents[child] = (node, distance)
+    for node, (parent, distance) in enumerate(parents):
+        f.write(
+            "{} {} {}\n".format(
+                parent, distance, json.dumps([tree.names[node]] + tree.paths[node])
+            )
+        )
+
+
+def read_index(f: TextIO) -> Tuple[str, BKTree]:
+    """Load a tree saved by :func:`write_index`.
+
+    :return: A tuple ``(root, tree)``.
+    """
+    parts = f.readline().rstrip("\n").split(" ", 4)
+    if len(parts) != 5 or parts[:3] != ["#", "find-dupes-by-fuzzy.py", "index"]:
+        raise ValueError("Not an index of find-dupes-by-fuzzy.py")
+    if parts[3] != str(INDEX_VERSION):
+        raise ValueError("Unsupported index version: {}".format(parts[3]))
+    tree = BKTree()
+    for line in f:
+        parent, distance, record = line.split(" ", 2)
+        name, *paths = json.loads(record)
+        node = tree._append(name, paths)
+        if node:
+            children = tree.children[int(parent)]
+            if children is None:
+                children = tree.children[int(parent)] = {}
+            children[int(distance)] = node
+    return json.loads(parts[4]), tree
+
+
+def _excluded(relative: str, name: str, excludes: Sequence[str]) -> bool:
+    path = os.path.normpath(os.path.join(relative, name))
+    return any(match_glob(path, pattern) for pattern in excludes)
+
+
+def _files(path: str, excludes: Sequence[str] = ()) -> Iterator[str]:
+    for dirpath, dirnames, filenames in os.walk(path):
+        relative = os.path.relpath(dirpath, path)
+        if excludes:
+            dirnames[:] = [d for d in dirnames if not _excluded(relative, d, excludes)]
+        for filename in filenames:
+            if excludes and _excluded(relative, filename, excludes):
+                continue
+            yield os.path.join(dirpath, filename)
+
+
+def collect_names(path: str, excludes: Sequence[str] = ()) -> Dict[str, List[str]]:
+    """Walk a directory tree and collect the paths of the files by their
+    normalized names.
+
+    :param path: The directory to walk.
+    :param excludes: Glob patterns of files and directories to skip, see
+      :func:`jfscripts.list_files.match_glob`.
+    """
+    names: Dict[str, List[str]] = {}
+    for file_path in _files(path, excludes):
+        name = normalize(os.path.basename(file_path))
+        if name:
+            names.setdefault(name, []).append(file_path)
+    return names
+
+
+def find_similar_texts(
+    path: str, max_bits: int = MAX_BITS, excludes: Sequence[str] = ()
+) -> Tuple[List[str], List[List[int]]]:
+    """Cluster the text files of a directory tree by their SimHash
+    fingerprints. Only one fingerprint per file is kept in memory.
+
+    :return: The paths of the text files and the clusters as lists of
+      indexes into them.
+    """
+    paths: List[str] = []
+    fingerprints = array.array("Q")
+    for file_path in _files(path, excludes):
+        try:
+            fingerprint = simhash_file(file_path)
+        except OSError as e:
+            print("{}: {}".format(file_path, e.strerror), file=sys.stderr)
+            continue
+        if fingerprint is not None:
+            paths.append(file_path)
+            fingerprints.append(fingerprint)
+    clusters = DisjointSet(len(paths))
+    for a, b in hamming_pairs(fingerprints, max_bits):
+        clusters.union(a, b)
+    return paths, clusters.groups()
+
+
+def check_for_fuzzy_duplicates(
+    path: str,
+    threshold: int = THRESHOLD,
+    ngram: int = NGRAM,
+    bands: int = BANDS,
+    rows: int = ROWS,
+    excludes: Sequence[str] = (),
+    jobs: int = 1,
+) -> None:
+    """Print the clusters of files with similar names, one path per line and
+    the clusters separated by an empty line."""
+    paths = collect_names(path, excludes)
+    names = sorted(paths)
+    clusters = find_clusters(names, threshold, ngram, bands, rows, jobs=jobs)
+    _print_clusters(
+        [sorted(paths[names[index]]) for index in cluster] for cluster in clusters
+    )
+
+
+def _print_clusters(clusters: Iterable[Iterable[Iterable[str]]]) -> None:
+    for i, cluster in enumerate(clusters):
+        if i:
+            print()
+        for file_paths in cluster:
+            for file_path in file_paths:
+                print(file_path)
+
+
+def check_for_similar_texts(
+    path: str, max_bits: int = MAX_BITS, excludes: Sequence[str] = ()
+) -> None:
+    """Print the clusters of text files with similar content in the format
+    of :func:`check_for_fuzzy_duplicates`."""
+    paths, clusters = find_similar_texts(path, max_bits, excludes)
+    _print_clusters(
+        [[paths[index]] for index in sorted(cluster, key=paths.__getitem__)]
+        for cluster in clusters
+    )
+
+
+def build_index(path: str, index_file: str, excludes: Sequence[str] = ()) -> int:
+    """Collect the names of the files in a directory tree and save them as a
+    BK-tree.
+
+    :return: The number of distinct names.
+    """
+    paths = collect_names(path, excludes)
+    tree = BKTree()
+    for name in sorted(paths):
+        tree.add(name, sorted(paths[name]))
+    with open(index_file, "w", encoding="utf-8", errors="surrogateescape") as f:
+        write_index(tree, path, f)
+    return len(tree)
+
+
+def query_index(
+    index_file: str, queries: Iterable[str], max_distance: int = MAX_DISTANCE
+) -> None:
+    """Print the files of an index whose names are within an edit distance
+    of each query: one line per file with the query, the distance and the
+    path, separated by tabs."""
+    with open(index_file, encoding="utf-8", errors="surrogateescape") as f:
+        _, tree = read_index(f)
+    for query in queries:
+        query = query.rstrip("\n")
+        name = normalize(query)
+        if not name:
+            continue
+        for distance, node in tree.search(name, max_distance):
+            for file_path in tree.paths[node]:
+                print("{}\t{}\t{}".format(query, distance, file_path))
+
+
+def get_parser():
+    """The argument parser for the command line interface.
+
+    :return: A ArgumentParser object.
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="Find files with similar names.",
+    )
+
+    parser.add_argument(
+        "path",
+        nargs="?",
+        help="A directory to recursively search for files with similar names. "
+        "Not needed with --query.",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=int,
+        default=THRESHOLD,
+        metavar="N",
+        help="The minimum similarity of two names from 0 to 100 (default: "
+        "%(default)s). The names are compared case-insensitively, with runs "
+        "of whitespace, dots, dashes and underscores counted as one space.",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Skip files and directories matching GLOB. A pattern without a "
+        "slash (e. g. .git or *.tmp) matches the name, a pattern with a slash "
+        "the path relative to the searched directory. * does not match a "
+        "slash, ** matches any number of directories (as in list-files.py). "
+        "Can be given multiple times.",
+    )
+
+    parser.add_argument(
+        "--ngram",
+        type=int,
+        default=NGRAM,
+        metavar="N",
+        help="The length of the character n-grams the candidate pairs are "
+        "found with (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--bands",
+        type=int,
+        default=BANDS,
+        metavar="N",
+        help="The number of LSH bands (default: %(default)s). Names are only "
+        "scored against each other if their MinHash signatures agree in all "
+        "rows of at least one band. More bands find more similar names, but "
+        "score more pairs.",
+    )
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=ROWS,
+        metavar="N",
+        help="The number of MinHash values per band (default: %(default)s). "
+        "More rows score fewer pairs, but miss more similar names.",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Compute the signatures and score the candidate pairs of names "
+        "in N processes (default: %(default)s). 0: one process per CPU core.",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--simhash",
+        action="store_true",
+        help="Compare the content of the text files instead of the names. "
+        "The files are read in chunks and each is reduced to a 64 bit SimHash "
+        "fingerprint of its words, so that whitespace, case and small edits "
+        "hardly change it. Files with a NUL byte in the first megabyte are "
+        "skipped as binary.",
+    )
+
+    parser.add_argument(
+        "-b",
+        "--max-bits",
+        type=int,
+        default=MAX_BITS,
+        metavar="N",
+        help="The maximum number of differing bits of the fingerprints of "
+        "similar text files with --simhash (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--build-index",
+        metavar="INDEX",
+        help="Save the names of the files as an edit distance index (a "
+        "BK-tree) instead of searching for similar names. Query it with "
+        "--query.",
+    )
+
+    parser.add_argument(
+        "--query",
+        metavar="INDEX",
+        help="Read names from stdin, one per line, and print the files of an "
+        "index written by --build-index whose names are within "
+        "--max-distance: the name, the distance and the path, separated by "
+        "tabs. Only a small part of the index is compared with each name.",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--max-distance",
+        type=int,
+        default=MAX_DISTANCE,
+        metavar="N",
+        help="The maximum number of inserted, deleted or substituted "
+        "characters of a --query match (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "-V",
+        "--version",
+        action="version",
+        version="%(prog)s {version}".format(version=__version__),
+    )
+
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if not 0 <= args.threshold <= 100:
+        parser.error("--threshold must be between 0 and 100")
+    if args.ngram < 1 or args.bands < 1 or args.rows < 1:
+        parser.error("--ngram, --bands and --rows must be positive")
+    if args.max_distance < 0:
+        parser.error("--max-distance must not be negative")
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    if not 0 <= args.max_bits < 32:
+        parser.error("--max-bits must be between 0 and 31")
+    if args.build_index and args.query:
+        parser.error("--build-index cannot be combined with --query")
+    if args.simhash and (args.build_index or args.query):
+        parser.error("--simhash cannot be combined with --build-index or --query")
+
+    if args.query:
+        try:
+            query_index(args.query, sys.stdin, args.max_distance)
+        except (OSError, ValueError) as e:
+            parser.exit(1, "{}: error: {}: {}\n".format(parser.prog, args.query, e))
+        return
+
+    if not args.path:
+        parser.error("the following arguments are required: path")
+
+    if args.build_index:
+        build_index(args.path, args.build_index, args.exclude)
+        return
+
+    if args.simhash:
+        check_for_similar_texts(args.path, args.max_bits, args.exclude)
+        return
+
+    check_for_fuzzy_duplicates(
+        args.path,
+        threshold=args.threshold,
+        ngram=args.ngram,
+        bands=args.bands,
+        rows=args.rows,
+        excludes=args.exclude,
+        jobs=args.jobs or os.cpu_count() or 1,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,2838 @@
 #! /usr/bin/env python3
 
+from __future__ import annotations
+
 import argparse
+import array
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
 import os
+import queue
+import re
+import select
+import shlex
+import shutil
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+)
 
 from jfscripts import __version__
+from jfscripts.list_files import match_glob
 
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    xxhash = None  # type: ignore
 
-def check_for_duplicates(path):
-    print(path)
-    sizes = {}
-    for dirpath, dirnames, filenames in os.walk(path):
-        for filename in filenames:
-            full_path = os.path.join(dirpath, filename)
-            size = os.path.getsize(full_path)
-            if size in sizes:
-                sizes[size].append(full_path)
+SAMPLE_SIZE = 4096
+"""Number of bytes read from the head and from the tail of a file to
+compute its partial digest."""
+
+CHUNK_SIZE = 1024 * 1024
+"""Number of bytes read at once to compute the full digest of a file
+(default of ``--buffer-size``)."""
+
+HASH_ALGORITHMS = ("blake2b", "sha256", "xxh3")
+"""The algorithms to compute the digests with. ``xxh3`` is not
+cryptographic, but several times faster than the others. It needs the
+optional package ``xxhash``."""
+
+COMPARE_MAX_FILES = 3
+"""Groups with up to this number of candidates are compared directly
+instead of being hashed (strategy ``auto``)."""
+
+COMPARE_MIN_SIZE = 64 * 1024
+"""Files smaller than this are always hashed: memory-mapping them costs
+more than reading them."""
+
+READ_ORDERS = ("path", "inode", "extent")
+"""The orders to read the candidate files in, see :func:`read_key`."""
+
+DEFAULT_READ_ORDER = "inode"
+"""The read order of the library functions and of ``--read-order``."""
+
+READ_BATCH = 4096
+"""Number of files whose reads are scheduled together when the files are
+not read in path order."""
+
+
+class Stage:
+    """Counters of one stage of the content verification."""
+
+    name: str
+
+    files: int
+    """Number of files that took part in this stage."""
+
+    bytes_read: int
+    """Number of bytes read from the disk during this stage."""
+
+    bytes_avoided: int
+    """Number of bytes a naive full content comparison would have read
+    additionally, but this stage made unnecessary."""
+
+    seconds: float
+    """Time spent reading and hashing or comparing in this stage."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_avoided = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes read per second in MB/s."""
+        if not self.seconds:
+            return 0.0
+        return self.bytes_read / self.seconds / 1e6
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "files": self.files,
+            "bytes_read": self.bytes_read,
+            "bytes_avoided": self.bytes_avoided,
+            "seconds": round(self.seconds, 3),
+            "mb_per_s": round(self.throughput, 1),
+        }
+
+    def __str__(self) -> str:
+        return "{}: {} files, {} bytes read, {} bytes avoided".format(
+            self.name, self.files, self.bytes_read, self.bytes_avoided
+        )
+
+
+class Stats:
+    """Counters of the walk and of the staged content verification (size →
+    partial digest → full digest)."""
+
+    dirs: int
+    """Number of listed directories."""
+
+    files: int
+    """Number of files found during the walk."""
+
+    groups: int
+    """Number of size groups examined after the walk."""
+
+    cache_hits: int
+    """Number of digests found in the fingerprint cache."""
+
+    cache_misses: int
+    """Number of digests not found in the fingerprint cache."""
+
+    phases: Dict[str, float]
+    """Seconds spent in each phase (``walk``, ``directories``, ``verify``).
+    The time the consumer of :func:`find_duplicates` spends with a group is
+    included."""
+
+    progress: Optional[Progress]
+    """A status line to update while the counters change."""
+
+    def __init__(self, progress: Optional[Progress] = None) -> None:
+        self.size = Stage("Size")
+        self.partial = Stage("Partial digest")
+        self.full = Stage("Full digest")
+        self.compare = Stage("Compare")
+        self.dirs = 0
+        self.files = 0
+        self.groups = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.phases = {}
+        self.phase: Optional[str] = None
+        self.phase_start = 0.0
+        self.progress = progress
+
+    @property
+    def stages(self) -> Tuple[Stage, Stage, Stage, Stage]:
+        return (self.size, self.partial, self.full, self.compare)
+
+    def start_phase(self, name: str) -> None:
+        self.end_phase()
+        self.phase = name
+        self.phase_start = time.monotonic()
+        self.tick()
+
+    def end_phase(self) -> None:
+        if self.phase:
+            elapsed = time.monotonic() - self.phase_start
+            self.phases[self.phase] = self.phases.get(self.phase, 0.0) + elapsed
+            if self.progress:
+                self.progress.update(self, force=True)
+        self.phase = None
+
+    def tick(self) -> None:
+        """Update the status line (throttled)."""
+        if self.progress:
+            self.progress.update(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        walk = self.phases.get("walk", 0.0)
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "walk": {
+                "dirs": self.dirs,
+                "files": self.files,
+                "dirs_per_s": round(self.dirs / walk, 1) if walk else 0.0,
+                "files_per_s": round(self.files / walk, 1) if walk else 0.0,
+            },
+            "stages": {
+                "size": self.size.to_dict(),
+                "partial": self.partial.to_dict(),
+                "full": self.full.to_dict(),
+                "compare": self.compare.to_dict(),
+            },
+            "cache": {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+            },
+            "phases": {name: round(s, 3) for name, s in self.phases.items()},
+        }
+
+
+class Progress:
+    """A status line on ``stderr`` showing the rates of the current phase,
+    rewritten at most every ``interval`` seconds."""
+
+    def __init__(self, stream: Optional[TextIO] = None, interval: float = 0.5) -> None:
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.last = 0.0
+        self.width = 0
+
+    def format(self, stats: Stats, now: float) -> str:
+        elapsed = max(now - stats.phase_start, 1e-9)
+        if stats.phase == "walk":
+            return "Walk: {} dirs ({:.0f}/s), {} files ({:.0f}/s)".format(
+                stats.dirs,
+                stats.dirs / elapsed,
+                stats.files,
+                stats.files / elapsed,
+            )
+        stages = ", ".join(
+            "{}: {:.1f} MB ({:.1f} MB/s)".format(
+                stage.name, stage.bytes_read / 1e6, stage.throughput
+            )
+            for stage in (stats.partial, stats.full, stats.compare)
+            if stage.files
+        )
+        return "{}: {} groups{}".format(
+            (stats.phase or "done").capitalize(),
+            stats.groups,
+            ", " + stages if stages else "",
+        )
+
+    def update(self, stats: Stats, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        line = self.format(stats, now)
+        self.stream.write("\r" + line.ljust(self.width))
+        self.stream.flush()
+        self.width = len(line)
+
+    def finish(self) -> None:
+        if self.width:
+            self.stream.write("\n")
+            self.stream.flush()
+
+
+def new_hash(algorithm: str = "blake2b") -> Any:
+    """Create a hash object.
+
+    :param algorithm: One of :data:`HASH_ALGORITHMS`.
+
+    :return: An object with the methods ``update`` and ``hexdigest``.
+    """
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm == "xxh3":
+        if xxhash is None:
+            raise ValueError("The hash algorithm xxh3 needs the package xxhash")
+        return xxhash.xxh3_128()
+    raise ValueError("Unknown hash algorithm: {}".format(algorithm))
+
+
+class RateLimiter:
+    """Cap the average rate of reads by sleeping whenever more bytes were
+    read than the rate allows for the elapsed time. A credit of at most
+    :attr:`burst` seconds is kept after idle periods."""
+
+    burst: float = 1.0
+
+    def __init__(self, rate: int) -> None:
+        """
+        :param rate: The number of bytes per second.
+        """
+        self.rate = rate
+        self.start = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, n: int) -> None:
+        """Account for ``n`` bytes read and sleep if ahead of the rate."""
+        self.consumed += n
+        ahead = self.consumed / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+        elif ahead < -self.burst:
+            self.start = time.monotonic() - self.burst
+            self.consumed = 0
+
+
+class Hasher:
+    """Compute the digests of files with one algorithm. All files are read
+    unbuffered into the same preallocated buffer and the hash is updated
+    from a view of it, so that reading a file allocates no chunks."""
+
+    def __init__(
+        self,
+        algorithm: str = "blake2b",
+        buffer_size: int = CHUNK_SIZE,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        """
+        :param algorithm: One of :data:`HASH_ALGORITHMS`.
+        :param buffer_size: The number of bytes to read at once. At least
+          :data:`SAMPLE_SIZE` bytes are used.
+        :param limiter: Cap the rate of the reads.
+        """
+        new_hash(algorithm)
+        self.algorithm = algorithm
+        self.buffer = bytearray(max(buffer_size, SAMPLE_SIZE))
+        self.view = memoryview(self.buffer)
+        self.limiter = limiter
+
+    def _update(self, h: Any, f: BinaryIO, limit: Optional[int] = None) -> None:
+        """Feed the hash with ``limit`` bytes or, if ``None``, with the rest
+        of the file."""
+        remaining = limit
+        while remaining is None or remaining > 0:
+            view = self.view if remaining is None else self.view[:remaining]
+            n = f.readinto(view)
+            if not n:
+                break
+            h.update(view[:n])
+            if self.limiter:
+                self.limiter.consume(n)
+            if remaining is not None:
+                remaining -= n
+
+    def partial(self, path: str, size: int) -> str:
+        """Hash the first and the last :data:`SAMPLE_SIZE` bytes of a file.
+        Files not larger than two samples are hashed completely.
+
+        :param path: The path of the file.
+        :param size: The size of the file in bytes.
+
+        :return: The hex digest of the sample.
+        """
+        h = new_hash(self.algorithm)
+        with open(path, "rb", buffering=0) as f:
+            if size <= 2 * SAMPLE_SIZE:
+                self._update(h, f)
+            else:
+                self._update(h, f, SAMPLE_SIZE)
+                f.seek(-SAMPLE_SIZE, os.SEEK_END)
+                self._update(h, f, SAMPLE_SIZE)
+        return h.hexdigest()
+
+    def full(self, path: str) -> str:
+        """Hash the whole content of a file.
+
+        :param path: The path of the file.
+
+        :return: The hex digest of the content.
+        """
+        h = new_hash(self.algorithm)
+        with open(path, "rb", buffering=0) as f:
+            self._update(h, f)
+        return h.hexdigest()
+
+
+def partial_digest(path: str, size: int, algorithm: str = "blake2b") -> str:
+    """Hash the head and the tail of a file, see :meth:`Hasher.partial`."""
+    return Hasher(algorithm, SAMPLE_SIZE).partial(path, size)
+
+
+def full_digest(path: str, algorithm: str = "blake2b") -> str:
+    """Hash the whole content of a file, see :meth:`Hasher.full`."""
+    return Hasher(algorithm).full(path)
+
+
+class FileEntry(NamedTuple):
+    """A regular file found during the walk together with the parts of its
+    ``stat`` result the duplicate detection needs."""
+
+    path: str
+    size: int
+    dev: int
+    ino: int
+    mtime_ns: int
+    nlink: int = 1
+
+    @classmethod
+    def from_stat(cls, path: str, st: os.stat_result) -> FileEntry:
+        return cls(path, st.st_size, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_nlink)
+
+
+class WalkFilter:
+    """Prunes the walk: excluded directories are not descended into and
+    excluded files are skipped before they are recorded.
+
+    :param root: The directory the walk starts in. Patterns containing a
+      path separator are matched against the paths relative to it.
+    :param min_size: Skip files smaller than this number of bytes.
+    :param max_size: Skip files larger than this number of bytes.
+    :param excludes: Glob patterns of files and directories to skip, see
+      :func:`jfscripts.list_files.match_glob`.
+    :param one_file_system: Do not descend into directories on other file
+      systems than the one of ``root``.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        min_size: int = 0,
+        max_size: Optional[int] = None,
+        excludes: Sequence[str] = (),
+        one_file_system: bool = False,
+    ) -> None:
+        self.prefix = len(os.path.join(root, ""))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.excludes = tuple(excludes)
+        self.dev = os.stat(root).st_dev if one_file_system else None
+
+    def excluded(self, path: str) -> bool:
+        relpath = path[self.prefix :]
+        return any(match_glob(relpath, pattern) for pattern in self.excludes)
+
+    def skip_dir(self, dir_entry: os.DirEntry[str]) -> bool:
+        if self.excludes and self.excluded(dir_entry.path):
+            return True
+        if self.dev is not None:
+            return dir_entry.stat(follow_symlinks=False).st_dev != self.dev
+        return False
+
+    def skip_size(self, size: int) -> bool:
+        return size < self.min_size or (
+            self.max_size is not None and size > self.max_size
+        )
+
+
+def _scan_directory(
+    dir_path: str, walk_filter: Optional[WalkFilter] = None
+) -> Tuple[List[FileEntry], List[str]]:
+    """List one directory with :func:`os.scandir`. The stat data of the
+    ``DirEntry`` objects is reused, so no additional lookup per file is
+    necessary.
+
+    :return: A tuple ``(files, subdirectories)``.
+    """
+    files: List[FileEntry] = []
+    subdirs: List[str] = []
+    try:
+        with os.scandir(dir_path) as it:
+            for dir_entry in it:
+                try:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        if not walk_filter or not walk_filter.skip_dir(dir_entry):
+                            subdirs.append(dir_entry.path)
+                    elif dir_entry.is_file(follow_symlinks=False):
+                        if walk_filter and walk_filter.excludes:
+                            if walk_filter.excluded(dir_entry.path):
+                                continue
+                        st = dir_entry.stat()
+                        if walk_filter and walk_filter.skip_size(st.st_size):
+                            continue
+                        files.append(FileEntry.from_stat(dir_entry.path, st))
+                except OSError as e:
+                    print("Skipping {}: {}".format(dir_entry.path, e), file=sys.stderr)
+    except OSError as e:
+        print("Skipping {}: {}".format(dir_path, e), file=sys.stderr)
+    subdirs.sort()
+    return files, subdirs
+
+
+def walk(
+    path: str,
+    jobs: int = 1,
+    walk_filter: Optional[WalkFilter] = None,
+    stats: Optional[Stats] = None,
+) -> Iterator[FileEntry]:
+    """Find all regular files below a directory. Symbolic links are
+    skipped: deleting them frees no space.
+
+    :param path: The directory to walk.
+    :param jobs: The number of directories to list concurrently. On
+      network file systems the walk is bound by the latency of the
+      server, so listing several directories at once speeds it up
+      considerably. The order of the files depends on the number of jobs
+      and on the timing of the server.
+    :param walk_filter: Prune the walk.
+    :param stats: Count the listed directories.
+    """
+    if jobs <= 1:
+        stack = [path]
+        while stack:
+            files, subdirs = _scan_directory(stack.pop(), walk_filter)
+            if stats:
+                stats.dirs += 1
+            yield from files
+            stack.extend(reversed(subdirs))
+        return
+
+    results: queue.Queue[Future[Tuple[List[FileEntry], List[str]]]] = queue.Queue()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def submit(dir_path: str) -> None:
+            future = executor.submit(_scan_directory, dir_path, walk_filter)
+            future.add_done_callback(results.put)
+
+        submit(path)
+        outstanding = 1
+        while outstanding:
+            files, subdirs = results.get().result()
+            outstanding -= 1
+            if stats:
+                stats.dirs += 1
+            for subdir in subdirs:
+                submit(subdir)
+            outstanding += len(subdirs)
+            yield from files
+
+
+def parse_size(size: str) -> int:
+    """Convert a human readable size like ``512M`` or ``2G`` into bytes.
+    The suffixes ``K``, ``M``, ``G`` and ``T`` are powers of 1024.
+
+    :param size: A number optionally followed by a suffix.
+
+    :return: The size in bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", size, re.I)
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(size))
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**exponent)
+
+
+_PACKED_ENTRY = struct.Struct("=IQQQqQq")
+"""The directory id, size, device, inode, mtime, number of links and the
+index of the previous file of the same size."""
+
+_PREVIOUS = struct.Struct("=q")
+_PREVIOUS_OFFSET = _PACKED_ENTRY.size - _PREVIOUS.size
+_FS_ENCODING = sys.getfilesystemencoding()
+
+
+class DirectoryTable:
+    """Interns the directory part of paths: every directory is stored once
+    and referred to by its number."""
+
+    def __init__(self) -> None:
+        self.ids: Dict[str, int] = {}
+        self.prefixes: List[str] = []
+
+    def split(self, path: str) -> Tuple[int, str]:
+        """Split a path into the number of its directory and its name.
+
+        :return: A tuple ``(directory id, name)``.
+        """
+        prefix, sep, name = path.rpartition(os.sep)
+        prefix += sep
+        dir_id = self.ids.get(prefix)
+        if dir_id is None:
+            dir_id = self.ids[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        return dir_id, name
+
+    def join(self, dir_id: int, name: str) -> str:
+        return self.prefixes[dir_id] + name
+
+
+class SizeIndex:
+    """Collects the files found during the walk grouped by their size.
+
+    The files are packed into one buffer instead of being kept as one tuple
+    per file (see :data:`_PACKED_ENTRY`): the directory as the number of a
+    :class:`DirectoryTable`, the fields of the :class:`FileEntry` and the
+    index of the previous file of the same size, which chains the files of
+    a size. The names are encoded into a second buffer. The paths and the
+    :class:`FileEntry` tuples are only created again for the group
+    :meth:`groups` yields.
+    """
+
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self.dirs = DirectoryTable()
+        self.entries = bytearray()
+        self.names = bytearray()
+        self.name_ends = array.array("Q")
+        self.last: Dict[int, int] = {}
+        """The index of the last file of each size."""
+
+    def __len__(self) -> int:
+        return len(self.name_ends)
+
+    def add(self, entry: FileEntry) -> None:
+        # Inlined DirectoryTable.split(): this runs once per file.
+        prefix, sep, name = entry.path.rpartition(os.sep)
+        dir_id = self.dirs.ids.get(prefix + sep)
+        if dir_id is None:
+            dir_id = self.dirs.split(entry.path)[0]
+        self.names += name.encode(_FS_ENCODING, "surrogateescape")
+        index = len(self.name_ends)
+        self.name_ends.append(len(self.names))
+        size = entry.size
+        self.entries += _PACKED_ENTRY.pack(
+            dir_id,
+            size,
+            entry.dev,
+            entry.ino,
+            entry.mtime_ns,
+            entry.nlink,
+            self.last.get(size, -1),
+        )
+        self.last[size] = index
+
+    def entry(self, index: int) -> FileEntry:
+        """Create the :class:`FileEntry` of a file."""
+        dir_id, size, dev, ino, mtime_ns, nlink, _ = _PACKED_ENTRY.unpack_from(
+            self.entries, index * _PACKED_ENTRY.size
+        )
+        start = self.name_ends[index - 1] if index else 0
+        name = self.names[start : self.name_ends[index]].decode(
+            _FS_ENCODING, "surrogateescape"
+        )
+        # Faster than calling the constructor of the named tuple.
+        return tuple.__new__(
+            FileEntry,
+            (self.dirs.prefixes[dir_id] + name, size, dev, ino, mtime_ns, nlink),
+        )
+
+    def _previous(self, index: int) -> int:
+        return _PREVIOUS.unpack_from(
+            self.entries, index * _PACKED_ENTRY.size + _PREVIOUS_OFFSET
+        )[0]
+
+    def groups(self) -> Iterator[Tuple[int, List[FileEntry]]]:
+        """Iterate over all files grouped by size in ascending order of the
+        size. Groups with only one file are included. The files of a group
+        are in the order they were added."""
+        for size in sorted(self.last):
+            index = self.last[size]
+            indexes = [index]
+            index = self._previous(index)
+            while index >= 0:
+                indexes.append(index)
+                index = self._previous(index)
+            yield size, [self.entry(index) for index in reversed(indexes)]
+
+    def close(self) -> None:
+        self.clear()
+
+
+_RECORD = struct.Struct("<QQQqQI")
+
+
+def _size_key(entry: FileEntry) -> Tuple[int, str]:
+    return (entry.size, entry.path)
+
+
+def _write_record(f: BinaryIO, entry: FileEntry) -> None:
+    path = os.fsencode(entry.path)
+    f.write(
+        _RECORD.pack(
+            entry.size, entry.dev, entry.ino, entry.mtime_ns, entry.nlink, len(path)
+        )
+    )
+    f.write(path)
+
+
+def _read_records(path: str) -> Iterator[FileEntry]:
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_RECORD.size)
+            if not header:
+                return
+            size, dev, ino, mtime_ns, nlink, length = _RECORD.unpack(header)
+            yield FileEntry(
+                os.fsdecode(f.read(length)), size, dev, ino, mtime_ns, nlink
+            )
+
+
+class SpillingSizeIndex(SizeIndex):
+    """A size index whose memory usage is bounded. As soon as the collected
+    entries exceed the memory budget, they are sorted by size and written
+    to a temporary file (a run). :meth:`groups` merges the runs in a
+    single streaming pass, so only one size group at a time is held in
+    memory.
+
+    The memory usage of an entry is estimated, so the budget is an
+    approximation of the real memory usage.
+    """
+
+    ENTRY_OVERHEAD = 320
+    """Estimated number of bytes an entry occupies in memory, excluding
+    the characters of its path."""
+
+    MERGE_FAN_IN = 128
+    """Maximum number of runs that are merged at once. Keeps the number of
+    open files and of read buffers bounded."""
+
+    def __init__(self, max_memory: int, tmp_dir: Optional[str] = None) -> None:
+        self.max_memory = max_memory
+        self.tmp_dir = tempfile.TemporaryDirectory(
+            prefix="find-dupes-by-size-", dir=tmp_dir
+        )
+        self.runs: List[str] = []
+        super().__init__()
+
+    def clear(self) -> None:
+        super().clear()
+        for run in self.runs:
+            os.remove(run)
+        self.runs = []
+        self.buffer: List[FileEntry] = []
+        self.buffer_bytes = 0
+        self.count = 0
+        """The number of files added, including the spilled ones."""
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, entry: FileEntry) -> None:
+        self.count += 1
+        self.buffer.append(entry)
+        self.buffer_bytes += self.ENTRY_OVERHEAD + len(entry.path)
+        if self.buffer_bytes >= self.max_memory:
+            self._spill()
+
+    def _new_run(self) -> str:
+        path = os.path.join(self.tmp_dir.name, "run-{}".format(len(self.runs)))
+        self.runs.append(path)
+        return path
+
+    def _spill(self) -> None:
+        self.buffer.sort(key=_size_key)
+        with open(self._new_run(), "wb") as f:
+            for entry in self.buffer:
+                _write_record(f, entry)
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def _merge(self, runs: List[str]) -> Iterator[FileEntry]:
+        return heapq.merge(*(_read_records(run) for run in runs), key=_size_key)
+
+    def groups(self) -> Iterator[Tuple[int, List[FileEntry]]]:
+        if not self.runs:
+            self.buffer.sort(key=_size_key)
+            entries: Iterator[FileEntry] = iter(self.buffer)
+        else:
+            if self.buffer:
+                self._spill()
+            runs = self.runs
+            while len(runs) > self.MERGE_FAN_IN:
+                batch, runs = runs[: self.MERGE_FAN_IN], runs[self.MERGE_FAN_IN :]
+                with open(self._new_run(), "wb") as f:
+                    for entry in self._merge(batch):
+                        _write_record(f, entry)
+                for run in batch:
+                    os.remove(run)
+                runs.append(self.runs[-1])
+            entries = self._merge(runs)
+        for size, group in itertools.groupby(entries, key=lambda e: e.size):
+            yield size, list(group)
+
+    def close(self) -> None:
+        self.buffer = []
+        self.tmp_dir.cleanup()
+
+
+def default_cache_file() -> str:
+    """The location of the fingerprint cache: ``find-dupes-by-size.sqlite``
+    in the directory ``jfscripts`` of ``$XDG_CACHE_HOME`` (default:
+    ``~/.cache``)."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "jfscripts", "find-dupes-by-size.sqlite")
+
+
+class FingerprintCache:
+    """A persistent SQLite cache of the partial and full digests of files.
+
+    An entry is identified by ``(st_dev, st_ino, size, mtime_ns)`` and the
+    hash algorithm. A file that is modified or replaced gets a new key, so
+    its outdated digests are never used again.
+
+    The digests are committed in batches, so an interrupted scan keeps most
+    of its work and several scans can share the cache: the database is in
+    WAL mode and a writer waits up to :attr:`TIMEOUT` seconds for the
+    transaction of another one.
+    """
+
+    SCHEMA_VERSION = 2
+
+    COMMIT_INTERVAL = 1000
+    """Commit after this number of stored digests ..."""
+
+    COMMIT_SECONDS = 5.0
+    """... or after this number of seconds, whichever comes first."""
+
+    TIMEOUT = 30.0
+    """Number of seconds to wait for a lock held by another process."""
+
+    EVICT_CHUNK = 1000
+    """Number of entries :meth:`evict` checks at once."""
+
+    hits: int
+    """Number of digests found in the cache."""
+
+    misses: int
+    """Number of digests that had to be computed."""
+
+    def __init__(self, path: str, algorithm: str = "blake2b") -> None:
+        """
+        :param path: The path of the SQLite database.
+        :param algorithm: The hash algorithm of the digests to look up and
+          to store.
+        """
+        self.algorithm = algorithm
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=self.TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS fingerprints")
+            self.connection.execute(
+                "PRAGMA user_version = {}".format(self.SCHEMA_VERSION)
+            )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "algorithm TEXT, path TEXT, partial TEXT, full TEXT, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._committed = time.monotonic()
+        # The paths looked up during this run. A private temporary database
+        # spills to disk instead of growing in memory and never locks the
+        # shared cache.
+        self._seen = sqlite3.connect("")
+        self._seen.execute(
+            "CREATE TABLE seen (path TEXT PRIMARY KEY, "
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER)"
+        )
+
+    @staticmethod
+    def _key(entry: FileEntry) -> Tuple[int, int, int, int]:
+        return (entry.dev, entry.ino, entry.size, entry.mtime_ns)
+
+    def get(self, entry: FileEntry, kind: str) -> Optional[str]:
+        """Look up a digest.
+
+        :param entry: The file to look up.
+        :param kind: ``partial`` or ``full``.
+
+        :return: The cached hex digest or ``None``.
+        """
+        if kind not in ("partial", "full"):
+            raise ValueError("Unknown digest kind: {}".format(kind))
+        key = self._key(entry)
+        self._seen.execute(
+            "INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?, ?)",
+            (os.path.abspath(entry.path),) + key,
+        )
+        row = self.connection.execute(
+            "SELECT {} FROM fingerprints "
+            "WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? "
+            "AND algorithm = ?".format(kind),
+            key + (self.algorithm,),
+        ).fetchone()
+        if row is None or row[0] is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, entry: FileEntry, kind: str, digest: str) -> None:
+        """Store a digest.
+
+        :param entry: The hashed file.
+        :param kind: ``partial`` or ``full``.
+        :param digest: The hex digest.
+        """
+        if kind not in ("partial", "full"):
+            raise ValueError("Unknown digest kind: {}".format(kind))
+        self.connection.execute(
+            "INSERT INTO fingerprints "
+            "(dev, ino, size, mtime_ns, algorithm, path, {0}) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (dev, ino, size, mtime_ns, algorithm) "
+            "DO UPDATE SET path = excluded.path, {0} = excluded.{0}".format(kind),
+            self._key(entry) + (self.algorithm, os.path.abspath(entry.path), digest),
+        )
+        self._pending += 1
+        if (
+            self._pending >= self.COMMIT_INTERVAL
+            or time.monotonic() - self._committed >= self.COMMIT_SECONDS
+        ):
+            self.commit()
+
+    def commit(self) -> None:
+        """Make the stored digests visible to other processes and keep them
+        if the scan is interrupted."""
+        self.connection.commit()
+        self._pending = 0
+        self._committed = time.monotonic()
+
+    def evict(self, root: str) -> int:
+        """Delete the entries below a directory whose path has disappeared
+        or now points to a different or modified file. Paths looked up
+        during this run are known to be valid and are not checked again.
+
+        The entries are read and deleted :attr:`EVICT_CHUNK` at a time, so
+        the memory use does not grow with the size of the cache.
+
+        :param root: The scanned directory.
+
+        :return: The number of deleted entries.
+        """
+        prefix = os.path.join(os.path.abspath(root), "")
+        deleted = 0
+        last = 0
+        while True:
+            rows = self.connection.execute(
+                "SELECT rowid, dev, ino, size, mtime_ns, path FROM fingerprints "
+                "WHERE rowid > ? AND substr(path, 1, ?) = ? "
+                "ORDER BY rowid LIMIT ?",
+                (last, len(prefix), prefix, self.EVICT_CHUNK),
+            ).fetchall()
+            if not rows:
+                return deleted
+            last = rows[-1][0]
+            stale: List[Tuple[int]] = []
+            for rowid, dev, ino, size, mtime_ns, path in rows:
+                key = (dev, ino, size, mtime_ns)
+                seen = self._seen.execute(
+                    "SELECT dev, ino, size, mtime_ns FROM seen WHERE path = ?",
+                    (path,),
+                ).fetchone()
+                if seen == key:
+                    continue
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    stale.append((rowid,))
+                    continue
+                if self._key(FileEntry.from_stat(path, st)) != key:
+                    stale.append((rowid,))
+            self.connection.executemany(
+                "DELETE FROM fingerprints WHERE rowid = ?", stale
+            )
+            self.commit()
+            deleted += len(stale)
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+        self._seen.close()
+
+
+def _sample_bytes(size: int) -> int:
+    return min(size, 2 * SAMPLE_SIZE)
+
+
+def _digest(
+    entry: FileEntry,
+    kind: str,
+    stage: Stage,
+    cache: Optional[FingerprintCache],
+    hasher: Hasher,
+) -> Optional[str]:
+    """Look up or compute the partial or full digest of a file.
+
+    :return: The hex digest or ``None`` if the file could not be read.
+    """
+    digest = cache.get(entry, kind) if cache else None
+    if digest is None:
+        start = time.monotonic()
+        try:
+            if kind == "partial":
+                digest = hasher.partial(entry.path, entry.size)
+                stage.bytes_read += _sample_bytes(entry.size)
             else:
-                sizes[size] = [full_path]
+                digest = hasher.full(entry.path)
+                stage.bytes_read += entry.size
+        except OSError as e:
+            print("Skipping {}: {}".format(entry.path, e), file=sys.stderr)
+            return None
+        finally:
+            stage.seconds += time.monotonic() - start
+        if cache:
+            cache.set(entry, kind, digest)
+    stage.files += 1
+    return digest
+
+
+def _group_by_digest(
+    entries: List[FileEntry],
+    kind: str,
+    stage: Stage,
+    cache: Optional[FingerprintCache],
+    hasher: Hasher,
+    prefetched: Optional[Dict[Tuple[str, str], Optional[str]]] = None,
+) -> Dict[str, List[FileEntry]]:
+    groups: Dict[str, List[FileEntry]] = {}
+    for entry in entries:
+        if prefetched is not None and (entry.path, kind) in prefetched:
+            digest = prefetched[(entry.path, kind)]
+        else:
+            digest = _digest(entry, kind, stage, cache, hasher)
+        if digest is not None:
+            groups.setdefault(digest, []).append(entry)
+    return groups
+
+
+def _mmaps_equal(
+    a: mmap.mmap, b: mmap.mmap, size: int, limiter: Optional[RateLimiter] = None
+) -> Tuple[bool, int]:
+    """Compare two memory maps block by block.
+
+    The blocks are compared as views of 8 byte words instead of as slices,
+    which would copy every block into a new bytes object. A memoryview of
+    words compares several times faster than one of bytes.
+
+    :return: A tuple ``(equal, offset)``: the offset is the end of the last
+      compared block.
+    """
+    words = size // 8 * 8
+    with memoryview(a) as view_a, memoryview(b) as view_b:
+        with view_a[:words].cast("Q") as words_a:
+            with view_b[:words].cast("Q") as words_b:
+                for offset in range(0, size, CHUNK_SIZE):
+                    end = min(offset + CHUNK_SIZE, size)
+                    if limiter:
+                        limiter.consume(2 * (end - offset))
+                    middle = min(end, words)
+                    start = offset // 8
+                    if words_a[start : middle // 8] != words_b[start : middle // 8]:
+                        return False, end
+                    if view_a[middle:end] != view_b[middle:end]:
+                        return False, end
+    return True, size
+
+
+def compare_content(
+    entries: List[FileEntry], stage: Stage, limiter: Optional[RateLimiter] = None
+) -> List[List[FileEntry]]:
+    """Split a group of files with the same size into groups of files with
+    the same content by comparing them directly. The files are
+    memory-mapped and compared block by block. The comparison of two files
+    stops at the first differing block, so in contrast to hashing, files
+    that differ early are hardly read.
 
+    :param entries: The files with the same size (larger than zero bytes).
+    :param stage: The counters to update.
+    :param limiter: Cap the rate of the reads.
+
+    :return: The groups of files with identical content, including groups
+      with only one file.
+    """
+    size = entries[0].size
+    start = time.monotonic()
+    maps: List[Tuple[FileEntry, mmap.mmap]] = []
+    for entry in entries:
+        try:
+            with open(entry.path, "rb") as f:
+                maps.append((entry, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+        except (OSError, ValueError) as e:
+            print("Skipping {}: {}".format(entry.path, e), file=sys.stderr)
+    bytes_read = 0
+    classes: List[Tuple[mmap.mmap, List[FileEntry]]] = []
+    try:
+        for entry, m in maps:
+            for first, members in classes:
+                equal, offset = _mmaps_equal(first, m, size, limiter)
+                bytes_read += 2 * offset
+                if equal:
+                    members.append(entry)
+                    break
+            else:
+                classes.append((m, [entry]))
+    finally:
+        for _, m in maps:
+            m.close()
+    stage.seconds += time.monotonic() - start
+    stage.files += len(maps)
+    stage.bytes_read += bytes_read
+    stage.bytes_avoided += max(0, len(maps) * size - bytes_read)
+    return [members for _, members in classes]
+
+
+def choose_strategy(files: int, size: int, cache: bool = False) -> str:
+    """Choose how to confirm that files with matching partial digests are
+    identical (strategy ``auto``).
+
+    :param files: The number of candidate files.
+    :param size: The size of the files in bytes.
+    :param cache: Whether a fingerprint cache is used. Only digests can be
+      cached, so with a cache the files are always hashed.
+
+    :return: ``compare`` for small groups of large files, ``hash``
+      otherwise.
+    """
+    if not cache and files <= COMPARE_MAX_FILES and size >= COMPARE_MIN_SIZE:
+        return "compare"
+    return "hash"
+
+
+def verify_content(
+    size: int,
+    entries: List[FileEntry],
+    stats: Stats,
+    cache: Optional[FingerprintCache] = None,
+    strategy: str = "auto",
+    hasher: Optional[Hasher] = None,
+    prefetched: Optional[Dict[Tuple[str, str], Optional[str]]] = None,
+) -> List[Tuple[Optional[str], List[FileEntry]]]:
+    """Split a group of files with the same size into groups of files with
+    the same content. Every file is first hashed partially. Only the files
+    whose partial digests still collide are hashed completely or compared
+    directly.
+
+    :param size: The size in bytes all files share.
+    :param entries: The files with the same size.
+    :param stats: The counters to update.
+    :param cache: An optional cache to look up digests before reading the
+      files and to store newly computed digests in.
+    :param strategy: ``hash``: compute the full digests.
+      ``compare``: compare the files directly (see
+      :func:`compare_content`). ``auto``: choose per group with
+      :func:`choose_strategy`.
+    :param hasher: The :class:`Hasher` to compute the digests with
+      (default: ``blake2b``).
+    :param prefetched: Digests already computed by
+      :func:`prefetch_digests`, keyed by ``(path, kind)``.
+
+    :return: A list of tuples ``(digest, entries)``. Each tuple contains
+      at least two files with identical content. The digest is ``None`` if
+      the files were compared directly.
+    """
+    hasher = hasher or Hasher()
+    sample = _sample_bytes(size)
+    partial_groups = _group_by_digest(
+        entries, "partial", stats.partial, cache, hasher, prefetched
+    )
+
+    output: List[Tuple[Optional[str], List[FileEntry]]] = []
+    for digest, candidates in partial_groups.items():
+        if len(candidates) == 1:
+            stats.partial.bytes_avoided += size - sample
+            continue
+        if size <= 2 * SAMPLE_SIZE:
+            # The partial digest already covers the whole content.
+            output.append((digest, candidates))
+            continue
+        chosen = strategy
+        if chosen == "auto":
+            chosen = choose_strategy(len(candidates), size, cache is not None)
+        if chosen == "compare":
+            for duplicates in compare_content(
+                candidates, stats.compare, hasher.limiter
+            ):
+                if len(duplicates) > 1:
+                    output.append((None, duplicates))
+            continue
+        full_groups = _group_by_digest(
+            candidates, "full", stats.full, cache, hasher, prefetched
+        )
+        for digest, duplicates in full_groups.items():
+            if len(duplicates) > 1:
+                output.append((digest, duplicates))
+    return output
+
+
+FS_IOC_FIEMAP = 0xC020660B
+"""The Linux ioctl to map the logical blocks of a file to physical ones."""
+
+_FIEMAP = struct.Struct("=QQIIII")
+_FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+FIEMAP_EXTENT_SHARED = 0x00002000
+"""The extent is shared with other files, e. g. by a reflink."""
+
+
+def _first_extent(path: str) -> Optional[Tuple[int, int]]:
+    """The physical position and the flags of the first extent of a file,
+    queried with the ``FIEMAP`` ioctl.
+
+    :return: ``None`` if the file system does not support ``FIEMAP`` or
+      the file has no extents.
+    """
+    import fcntl
+
+    request = bytearray(
+        _FIEMAP.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size)
+    )
+    try:
+        with open(path, "rb", buffering=0) as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    if not _FIEMAP.unpack_from(request)[3]:
+        return None
+    extent = _FIEMAP_EXTENT.unpack_from(request, _FIEMAP.size)
+    return extent[1], extent[5]
+
+
+def physical_offset(path: str) -> Optional[int]:
+    """The physical position of the first extent of a file on its device.
+
+    :return: The offset in bytes or ``None`` if the file system does not
+      support ``FIEMAP`` or the file has no extents.
+    """
+    extent = _first_extent(path)
+    return extent[0] if extent else None
+
+
+def read_key(entry: FileEntry, read_order: str) -> Tuple[Any, ...]:
+    """The sort key to schedule the reads of a file with.
+
+    :param read_order: ``path``: in the order of the paths. ``inode``: by
+      device and inode number, a cheap approximation of the position on
+      the disk for most file systems. ``extent``: by device and the
+      physical position of the first extent (see
+      :func:`physical_offset`); files without one are read first, by inode.
+    """
+    if read_order == "inode":
+        return (entry.dev, entry.ino)
+    if read_order == "extent":
+        return (entry.dev, physical_offset(entry.path) or 0, entry.ino)
+    return (entry.path,)
+
+
+def prefetch_digests(
+    batch: List[Tuple[int, List[FileEntry]]],
+    stats: Stats,
+    cache: Optional[FingerprintCache],
+    hasher: Hasher,
+    strategy: str = "auto",
+    read_order: str = DEFAULT_READ_ORDER,
+) -> Dict[Tuple[str, str], Optional[str]]:
+    """Compute the digests :func:`verify_content` needs for a batch of size
+    groups, reading the files across all groups sorted by
+    :func:`read_key` instead of group by group. On rotational disks this
+    turns the reads into few long sweeps over the platter.
+
+    :param batch: Tuples ``(size, entries)`` as yielded by
+      :meth:`SizeIndex.groups`.
+
+    :return: The digests keyed by ``(path, kind)``, ``None`` for files that
+      could not be read.
+    """
+    digests: Dict[Tuple[str, str], Optional[str]] = {}
+    pending = [entry for _, entries in batch if len(entries) > 1 for entry in entries]
+    for entry in sorted(pending, key=lambda entry: read_key(entry, read_order)):
+        digests[(entry.path, "partial")] = _digest(
+            entry, "partial", stats.partial, cache, hasher
+        )
+        stats.tick()
+
+    pending = []
+    for size, entries in batch:
+        if len(entries) < 2 or size <= 2 * SAMPLE_SIZE:
+            continue
+        partial_groups: Dict[str, List[FileEntry]] = {}
+        for entry in entries:
+            digest = digests[(entry.path, "partial")]
+            if digest is not None:
+                partial_groups.setdefault(digest, []).append(entry)
+        for candidates in partial_groups.values():
+            if len(candidates) < 2:
+                continue
+            chosen = strategy
+            if chosen == "auto":
+                chosen = choose_strategy(len(candidates), size, cache is not None)
+            if chosen == "hash":
+                pending.extend(candidates)
+    for entry in sorted(pending, key=lambda entry: read_key(entry, read_order)):
+        digests[(entry.path, "full")] = _digest(
+            entry, "full", stats.full, cache, hasher
+        )
+        stats.tick()
+    return digests
+
+
+def _batches(
+    groups: Iterator[Tuple[int, List[FileEntry]]], files: int
+) -> Iterator[List[Tuple[int, List[FileEntry]]]]:
+    """Combine consecutive size groups to batches of at least ``files``
+    files."""
+    batch: List[Tuple[int, List[FileEntry]]] = []
     count = 0
-    duplicate_paths = {}
-    for size, full_paths in sizes.items():
-        if len(full_paths) > 1:
-            count += 1
-            full_paths.sort()
-            duplicate_paths[full_paths[0]] = full_paths
+    for size, entries in groups:
+        batch.append((size, entries))
+        count += len(entries)
+        if count >= files:
+            yield batch
+            batch = []
+            count = 0
+    if batch:
+        yield batch
+
+
+class DuplicateGroup(NamedTuple):
+    """A group of files reported by :func:`find_duplicates`."""
+
+    kind: str
+    """``duplicates``: files with the same size (and the same content, if
+    verified). ``hardlinks``: paths of the same inode. ``directories``:
+    directory trees with the same content. ``manifest``: a local file and
+    a file with the same content listed in a manifest (see
+    :func:`find_in_manifest`)."""
+
+    size: int
+    """The size of the files or the total size of the directory trees."""
+
+    digest: Optional[str]
+    """The hex digest of the content or ``None`` if not verified."""
+
+    entries: List[FileEntry]
+    """The files sorted by their paths."""
+
+    @property
+    def reclaimable(self) -> int:
+        """The number of bytes freed by keeping only the first of the files.
+        Like with :class:`ActionEngine`, a duplicate file with further
+        hardlinks frees no space."""
+        if self.kind == "hardlinks":
+            return 0
+        if self.kind == "duplicates":
+            return sum(self.size for entry in self.entries[1:] if entry.nlink == 1)
+        return (len(self.entries) - 1) * self.size
+
+
+class DirectoryTree:
+    """The directories of a walk with their files, used to find duplicate
+    directory trees by Merkle hashing: the digest of a directory is
+    computed bottom-up from the names and the digests of its children.
+
+    The digests are computed in three stages. The size signature covers
+    the names and sizes of all files in the tree and needs no reads. Only
+    trees whose size signatures collide get a Merkle digest from the
+    partial digests of their files, and only trees whose partial Merkle
+    digests still collide get one from the full digests.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        entries: List[FileEntry],
+        stats: Stats,
+        cache: Optional[FingerprintCache] = None,
+        hasher: Optional[Hasher] = None,
+    ) -> None:
+        self.root = root
+        self.stats = stats
+        self.cache = cache
+        self.hasher = hasher or Hasher()
+        self.files: Dict[str, List[Tuple[str, FileEntry]]] = {root: []}
+        self.dirs: Dict[str, List[str]] = {root: []}
+        for entry in entries:
+            directory, name = os.path.split(entry.path)
+            if directory not in self.files:
+                self._add_directory(directory)
+            self.files[directory].append((name, entry))
+        self.total_size: Dict[str, int] = {}
+        self.file_count: Dict[str, int] = {}
+        self.dir_count: Dict[str, int] = {}
+        """The number of directories of each tree, including its root."""
+        self.signatures: Dict[str, str] = {}
+        self.merkle: Dict[Tuple[str, str], Optional[str]] = {}
+        self.file_digests: Dict[Tuple[str, str], Optional[str]] = {}
+        for directory in sorted(self.files, key=len, reverse=True):
+            self._sign(directory)
+
+    def _add_directory(self, directory: str) -> None:
+        self.files[directory] = []
+        self.dirs[directory] = []
+        parent = os.path.dirname(directory)
+        if parent not in self.files:
+            self._add_directory(parent)
+        self.dirs[parent].append(directory)
+
+    def _sign(self, directory: str) -> None:
+        h = hashlib.blake2b(digest_size=16)
+        total_size = 0
+        file_count = 0
+        dir_count = 1
+        for name, entry in sorted(self.files[directory]):
+            h.update(
+                "f\0{}\0{}\0".format(name, entry.size).encode(errors="surrogateescape")
+            )
+            total_size += entry.size
+            file_count += 1
+        for subdir in sorted(self.dirs[directory]):
+            h.update(
+                "d\0{}\0{}\0".format(
+                    os.path.basename(subdir), self.signatures[subdir]
+                ).encode(errors="surrogateescape")
+            )
+            total_size += self.total_size[subdir]
+            file_count += self.file_count[subdir]
+            dir_count += self.dir_count[subdir]
+        self.signatures[directory] = h.hexdigest()
+        self.total_size[directory] = total_size
+        self.file_count[directory] = file_count
+        self.dir_count[directory] = dir_count
+
+    def _file_digest(self, entry: FileEntry, kind: str) -> Optional[str]:
+        if kind == "full" and entry.size <= 2 * SAMPLE_SIZE:
+            # The partial digest already covers the whole content.
+            kind = "partial"
+        key = (entry.path, kind)
+        if key not in self.file_digests:
+            stage = self.stats.partial if kind == "partial" else self.stats.full
+            self.file_digests[key] = _digest(
+                entry, kind, stage, self.cache, self.hasher
+            )
+        return self.file_digests[key]
+
+    def merkle_digest(self, directory: str, kind: str) -> Optional[str]:
+        """The Merkle digest of a directory tree.
+
+        :param directory: A directory of the tree.
+        :param kind: ``partial`` or ``full``: the kind of the file digests
+          the Merkle digest is computed from.
+
+        :return: The hex digest or ``None`` if a file could not be read.
+        """
+        key = (directory, kind)
+        if key in self.merkle:
+            return self.merkle[key]
+        h = hashlib.blake2b(digest_size=16)
+        digest: Optional[str] = None
+        for name, entry in sorted(self.files[directory]):
+            digest = self._file_digest(entry, kind)
+            if digest is None:
+                break
+            h.update(
+                "f\0{}\0{}\0".format(name, digest).encode(errors="surrogateescape")
+            )
+        else:
+            for subdir in sorted(self.dirs[directory]):
+                digest = self.merkle_digest(subdir, kind)
+                if digest is None:
+                    break
+                h.update(
+                    "d\0{}\0{}\0".format(os.path.basename(subdir), digest).encode(
+                        errors="surrogateescape"
+                    )
+                )
+            else:
+                digest = h.hexdigest()
+        self.merkle[key] = digest
+        return digest
 
-    for key, full_paths in sorted(duplicate_paths.items()):
-        print("-----------------------------------------")
-        for full_path in full_paths:
-            print('rm -f "' + full_path + '"')
+    def duplicates(self) -> List[List[str]]:
+        """Find groups of directories with identical trees. The first
+        directory of a group is kept, the others are redundant. Directories
+        below a redundant directory are omitted, and so are the groups left
+        with fewer than two directories. So no tree is reported twice, also
+        if duplicate trees are nested in other duplicate trees.
 
-    print("Duplicates found: " + str(count))
+        :return: The groups, each sorted by path, the groups sorted by the
+          path of their first directory.
+        """
+        candidates: Dict[str, List[str]] = {}
+        for directory, signature in self.signatures.items():
+            if directory != self.root and self.file_count[directory]:
+                candidates.setdefault(signature, []).append(directory)
+
+        groups: List[List[str]] = []
+        for directories in candidates.values():
+            if len(directories) < 2:
+                continue
+            for partial in self._split(directories, "partial"):
+                groups.extend(self._split(partial, "full"))
+
+        # A tree has more directories than every tree below it, so the
+        # groups of the enclosing trees are handled first.
+        groups.sort(key=lambda group: (-self.dir_count[group[0]], min(group)))
+        redundant: Set[str] = set()
+        result: List[List[str]] = []
+        for group in groups:
+            members = [d for d in sorted(group) if not _is_below(d, redundant)]
+            if len(members) > 1:
+                redundant.update(members[1:])
+                result.append(members)
+        return sorted(result)
+
+    def _split(self, directories: List[str], kind: str) -> List[List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for directory in directories:
+            digest = self.merkle_digest(directory, kind)
+            if digest is not None:
+                groups.setdefault(digest, []).append(directory)
+        return [group for group in groups.values() if len(group) > 1]
+
+
+def _is_below(path: str, directories: Set[str]) -> bool:
+    parent = os.path.dirname(path)
+    while parent not in directories:
+        grandparent = os.path.dirname(parent)
+        if grandparent == parent:
+            return False
+        parent = grandparent
+    return True
+
+
+def find_duplicates(
+    path: str,
+    stats: Stats,
+    verify: bool = False,
+    cache_file: Optional[str] = None,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    strategy: str = "auto",
+    dirs: bool = False,
+    walk_filter: Optional[WalkFilter] = None,
+    hash_algorithm: str = "blake2b",
+    buffer_size: int = CHUNK_SIZE,
+    read_order: str = DEFAULT_READ_ORDER,
+    io_rate: Optional[int] = None,
+) -> Iterator[DuplicateGroup]:
+    """Walk a directory and yield every group of duplicates as soon as it is
+    final, that means after the walk and the verification of its size
+    group. The hardlink sets are yielded first, right after the walk.
+
+    :param path: A directory to recursively search for duplicate files.
+    :param stats: The counters to update.
+    :param verify: Confirm that files with the same size also have the
+      same content. Files with a unique size are never opened.
+    :param cache_file: The path of a fingerprint cache (see
+      :class:`FingerprintCache`) to verify the content with. Implies
+      ``verify``.
+    :param jobs: The number of directories to list concurrently.
+    :param max_memory: Bound the memory the collected files occupy to
+      approximately this number of bytes by spilling them to temporary
+      files (see :class:`SpillingSizeIndex`).
+    :param strategy: How to confirm the content of files with matching
+      partial digests, see :func:`verify_content`.
+    :param dirs: Report identical directory trees once as a group of the
+      kind ``directories`` (see :class:`DirectoryTree`) and omit the files
+      of the redundant copies from the groups of duplicate files.
+    :param walk_filter: Skip files and directories during the walk.
+    :param hash_algorithm: One of :data:`HASH_ALGORITHMS`.
+    :param buffer_size: The number of bytes to read at once when hashing.
+    :param read_order: The order to read the files of up to
+      :data:`READ_BATCH` files in, see :func:`read_key` and
+      :func:`prefetch_digests`. The groups are still yielded sorted by size.
+    :param io_rate: Cap the reads of the verification to this number of
+      bytes per second.
+    """
+    hasher = Hasher(
+        hash_algorithm, buffer_size, RateLimiter(io_rate) if io_rate else None
+    )
+    sizes = SpillingSizeIndex(max_memory) if max_memory else SizeIndex()
+    # Only files with more than one link can share their inode.
+    inodes: Dict[Tuple[int, int], List[FileEntry]] = {}
+    files: List[FileEntry] = []
+    stats.start_phase("walk")
+    for entry in walk(path, jobs, walk_filter, stats):
+        stats.files += 1
+        stats.tick()
+        if dirs:
+            files.append(entry)
+        if entry.nlink > 1:
+            links = inodes.setdefault((entry.dev, entry.ino), [])
+            links.append(entry)
+            if len(links) > 1:
+                continue
+        if not dirs:
+            sizes.add(entry)
+    stats.end_phase()
+
+    for links in sorted(
+        (sorted(links) for links in inodes.values() if len(links) > 1),
+        key=lambda links: links[0].path,
+    ):
+        yield DuplicateGroup("hardlinks", links[0].size, None, links)
+
+    def representative(entry: FileEntry) -> FileEntry:
+        """The link with the smallest path, independent of the order of
+        the walk."""
+        if entry.nlink > 1:
+            return min(inodes[(entry.dev, entry.ino)])
+        return entry
+
+    cache: Optional[FingerprintCache] = None
+    if cache_file:
+        verify = True
+        cache = FingerprintCache(cache_file, hash_algorithm)
+
+    if dirs:
+        stats.start_phase("directories")
+        root = path.rstrip(os.sep) or os.sep
+        tree = DirectoryTree(root, files, stats, cache, hasher)
+        redundant: Set[str] = set()
+        # Stat all directories before the consumer acts on the first group.
+        directory_groups = [
+            DuplicateGroup(
+                "directories",
+                tree.total_size[directories[0]],
+                tree.merkle_digest(directories[0], "full"),
+                [
+                    FileEntry.from_stat(d, os.stat(d))._replace(size=tree.total_size[d])
+                    for d in directories
+                ],
+            )
+            for directories in tree.duplicates()
+        ]
+        for group in directory_groups:
+            redundant.update(entry.path for entry in group.entries[1:])
+        del tree
+        yield from directory_groups
+        for entry in files:
+            if entry == representative(entry) and not _is_below(entry.path, redundant):
+                sizes.add(entry)
+        del files
+        stats.end_phase()
+
+    try:
+        stats.start_phase("verify")
+        scheduled = verify and read_order != "path"
+        for batch in _batches(sizes.groups(), READ_BATCH if scheduled else 1):
+            prefetched = None
+            if scheduled:
+                prefetched = prefetch_digests(
+                    batch, stats, cache, hasher, strategy, read_order
+                )
+            for size, entries in batch:
+                stats.groups += 1
+                stats.tick()
+                stats.size.files += len(entries)
+                if len(entries) == 1:
+                    stats.size.bytes_avoided += size
+                    continue
+                if verify:
+                    groups = verify_content(
+                        size, entries, stats, cache, strategy, hasher, prefetched
+                    )
+                else:
+                    groups = [(None, entries)]
+                for group, digest in sorted(
+                    (sorted(representative(entry) for entry in group), digest)
+                    for digest, group in groups
+                ):
+                    yield DuplicateGroup("duplicates", size, digest, group)
+        if cache:
+            cache.evict(path)
+    finally:
+        stats.end_phase()
+        sizes.close()
+        if cache:
+            stats.cache_hits = cache.hits
+            stats.cache_misses = cache.misses
+            cache.close()
+
+
+def format_group(group: DuplicateGroup, output_format: str = "shell") -> str:
+    """Format a group of duplicates for the output.
+
+    :param group: The group to format.
+    :param output_format: ``shell``: ``rm -f`` commands (``rm -rf`` for
+      directories), one per line, quoted for a POSIX shell. Hardlink sets
+      and the paths of a manifest are commented out. ``jsonl``:
+      one JSON object per line. ``nul``: the paths of a group of duplicates
+      each terminated by a NUL character, the group terminated by an
+      additional NUL character. Hardlink sets are omitted. Not supported
+      for the groups of a manifest, whose paths need to be marked.
+
+    :return: The formatted group including the trailing line break or NUL
+      character.
+    """
+    paths = [entry.path for entry in group.entries]
+    if output_format == "jsonl":
+        record = {
+            "type": group.kind,
+            "size": group.size,
+            "digest": group.digest,
+            "inodes": [entry.ino for entry in group.entries],
+            "paths": paths,
+        }
+        return json.dumps(record) + "\n"
+    if output_format == "nul":
+        if group.kind == "hardlinks":
+            return ""
+        return "".join(path + "\0" for path in paths) + "\0"
+    lines = ["-----------------------------------------"]
+    if group.kind == "duplicates":
+        lines += ["rm -f " + shlex.quote(path) for path in paths]
+    elif group.kind == "directories":
+        lines += ["rm -rf " + shlex.quote(path) for path in paths]
+    elif group.kind == "manifest":
+        lines.append("rm -f " + shlex.quote(paths[0]))
+        lines += ["# In the manifest: " + shlex.quote(path) for path in paths[1:]]
+    else:
+        lines.append("# Hardlinks to the same inode, deleting one frees no space:")
+        lines += ["# " + shlex.quote(path) for path in paths]
+    return "\n".join(lines) + "\n"
+
+
+MANIFEST_VERSION = 1
+
+
+class ManifestRecord(NamedTuple):
+    """A file listed in a manifest, see :func:`export_manifest`."""
+
+    size: int
+
+    partial: str
+    """The hex digest of the head and the tail of the file."""
+
+    full: str
+    """The hex digest of the whole content."""
+
+    path: str
+    """The path relative to the root of the manifest."""
+
+
+def format_manifest_record(record: ManifestRecord) -> str:
+    """One line of a manifest: the size, the two digests and the path as a
+    JSON string, separated by spaces."""
+    return "{} {} {} {}\n".format(
+        record.size, record.partial, record.full, json.dumps(record.path)
+    )
+
+
+def read_manifest_header(f: TextIO) -> Tuple[str, str]:
+    """Read the first line of a manifest.
+
+    :return: A tuple ``(hash algorithm, root)``.
+    """
+    parts = f.readline().rstrip("\n").split(" ", 5)
+    if len(parts) != 6 or parts[:3] != ["#", "find-dupes-by-size.py", "manifest"]:
+        raise ValueError("Not a manifest of find-dupes-by-size.py")
+    if parts[3] != str(MANIFEST_VERSION):
+        raise ValueError("Unsupported manifest version: {}".format(parts[3]))
+    return parts[4], json.loads(parts[5])
+
+
+def read_manifest(f: TextIO) -> Iterator[ManifestRecord]:
+    """Read the records of a manifest after its header. Raises a
+    :class:`ValueError` if they are not sorted."""
+    previous: Optional[ManifestRecord] = None
+    for line in f:
+        size, partial, full, path = line.rstrip("\n").split(" ", 3)
+        record = ManifestRecord(int(size), partial, full, json.loads(path))
+        if previous and record < previous:
+            raise ValueError("The manifest is not sorted: {}".format(record.path))
+        previous = record
+        yield record
+
+
+def _collect_sizes(
+    path: str,
+    stats: Stats,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    walk_filter: Optional[WalkFilter] = None,
+) -> SizeIndex:
+    sizes = SpillingSizeIndex(max_memory) if max_memory else SizeIndex()
+    stats.start_phase("walk")
+    for entry in walk(path, jobs, walk_filter, stats):
+        stats.files += 1
+        stats.tick()
+        sizes.add(entry)
+    stats.end_phase()
+    return sizes
+
+
+def _digests(
+    entry: FileEntry,
+    stats: Stats,
+    cache: Optional[FingerprintCache],
+    hasher: Hasher,
+) -> Optional[Tuple[str, str]]:
+    """The partial and the full digest of a file. The full digest of a
+    small file is its partial digest, the file is not read twice."""
+    partial = _digest(entry, "partial", stats.partial, cache, hasher)
+    if partial is None or entry.size <= 2 * SAMPLE_SIZE:
+        return (partial, partial) if partial else None
+    full = _digest(entry, "full", stats.full, cache, hasher)
+    return (partial, full) if full else None
+
+
+def export_manifest(
+    path: str,
+    manifest_file: str,
+    stats: Stats,
+    cache_file: Optional[str] = None,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    walk_filter: Optional[WalkFilter] = None,
+    hash_algorithm: str = "blake2b",
+    buffer_size: int = CHUNK_SIZE,
+    io_rate: Optional[int] = None,
+) -> int:
+    """Hash all files below a directory and write a manifest of them that
+    :func:`find_in_manifest` can compare other trees against without
+    access to this one.
+
+    The manifest is a text file. The first line is a header with the
+    version, the hash algorithm and the root directory, every further line
+    a :class:`ManifestRecord` (see :func:`format_manifest_record`). The
+    records are sorted by size, partial digest, full digest and path.
+    Several links of the same inode are hashed once. The file is written
+    under a temporary name and renamed when complete.
+
+    The other arguments are the same as for :func:`find_duplicates`.
+
+    :param manifest_file: The path of the manifest to write.
+
+    :return: The number of records written.
+    """
+    hasher = Hasher(
+        hash_algorithm, buffer_size, RateLimiter(io_rate) if io_rate else None
+    )
+    cache = FingerprintCache(cache_file, hash_algorithm) if cache_file else None
+    sizes = _collect_sizes(path, stats, jobs, max_memory, walk_filter)
+    prefix = os.path.join(path, "")
+    tmp = manifest_file + ".tmp"
+    count = 0
+    try:
+        stats.start_phase("verify")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(
+                "# find-dupes-by-size.py manifest {} {} {}\n".format(
+                    MANIFEST_VERSION, hash_algorithm, json.dumps(os.path.abspath(path))
+                )
+            )
+            for size, entries in sizes.groups():
+                stats.groups += 1
+                stats.tick()
+                inodes: Dict[Tuple[int, int], Optional[Tuple[str, str]]] = {}
+                records: List[ManifestRecord] = []
+                for entry in entries:
+                    key = (entry.dev, entry.ino)
+                    if key not in inodes:
+                        inodes[key] = _digests(entry, stats, cache, hasher)
+                    digests = inodes[key]
+                    if digests:
+                        relpath = entry.path[len(prefix) :]
+                        records.append(ManifestRecord(size, *digests, relpath))
+                records.sort()
+                f.writelines(format_manifest_record(record) for record in records)
+                count += len(records)
+        os.replace(tmp, manifest_file)
+        if cache:
+            cache.evict(path)
+    finally:
+        stats.end_phase()
+        sizes.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if cache:
+            stats.cache_hits = cache.hits
+            stats.cache_misses = cache.misses
+            cache.close()
+    return count
+
+
+def find_in_manifest(
+    path: str,
+    manifest_file: str,
+    stats: Stats,
+    cache_file: Optional[str] = None,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    walk_filter: Optional[WalkFilter] = None,
+    buffer_size: int = CHUNK_SIZE,
+    io_rate: Optional[int] = None,
+) -> Iterator[DuplicateGroup]:
+    """Find the files below a directory whose content is listed in a
+    manifest written by :func:`export_manifest`.
+
+    The sizes of the walk and the manifest are merge-joined in one pass
+    over the manifest, which is never loaded as a whole. Files whose size
+    is not in the manifest are never opened, of the others only the head
+    and the tail are read unless a manifest record has the same partial
+    digest. The digests are computed with the algorithm of the manifest.
+
+    The other arguments are the same as for :func:`find_duplicates`.
+
+    :param manifest_file: The path of the manifest.
+
+    :return: For every local file found in the manifest a group of the
+      kind ``manifest`` with the local file and the first matching path of
+      the manifest, relative to the root of the manifest.
+    """
+    with open(manifest_file, encoding="utf-8") as f:
+        algorithm, root = read_manifest_header(f)
+        hasher = Hasher(
+            algorithm, buffer_size, RateLimiter(io_rate) if io_rate else None
+        )
+        cache = FingerprintCache(cache_file, algorithm) if cache_file else None
+        sizes = _collect_sizes(path, stats, jobs, max_memory, walk_filter)
+        records = read_manifest(f)
+        record = next(records, None)
+        try:
+            stats.start_phase("verify")
+            for size, entries in sizes.groups():
+                stats.groups += 1
+                stats.tick()
+                stats.size.files += len(entries)
+                while record and record.size < size:
+                    record = next(records, None)
+                if not record or record.size > size:
+                    stats.size.bytes_avoided += len(entries) * size
+                    continue
+
+                local: List[Tuple[str, FileEntry]] = []
+                for entry in entries:
+                    partial = _digest(entry, "partial", stats.partial, cache, hasher)
+                    if partial:
+                        local.append((partial, entry))
+                local.sort()
+                matches: List[DuplicateGroup] = []
+                for partial, group in itertools.groupby(local, key=lambda t: t[0]):
+                    candidates = [entry for _, entry in group]
+                    while record and record[:2] < (size, partial):
+                        record = next(records, None)
+                    if not record or record[:2] != (size, partial):
+                        stats.partial.bytes_avoided += len(candidates) * (
+                            size - _sample_bytes(size)
+                        )
+                        continue
+                    fulls: List[Tuple[str, FileEntry]] = []
+                    for entry in candidates:
+                        if size <= 2 * SAMPLE_SIZE:
+                            fulls.append((partial, entry))
+                            continue
+                        full = _digest(entry, "full", stats.full, cache, hasher)
+                        if full:
+                            fulls.append((full, entry))
+                    for full, entry in sorted(fulls):
+                        while record and record[:3] < (size, partial, full):
+                            record = next(records, None)
+                        if record and record[:3] == (size, partial, full):
+                            remote = FileEntry(
+                                os.path.join(root, record.path), size, 0, 0, 0
+                            )
+                            matches.append(
+                                DuplicateGroup("manifest", size, full, [entry, remote])
+                            )
+                yield from sorted(matches, key=lambda group: group.entries[0].path)
+            if cache:
+                cache.evict(path)
+        finally:
+            stats.end_phase()
+            sizes.close()
+            if cache:
+                stats.cache_hits = cache.hits
+                stats.cache_misses = cache.misses
+                cache.close()
+
+
+FICLONE = 0x40049409
+"""The Linux ioctl to share the extents of one file with another file
+(``reflink``), supported by Btrfs and XFS."""
+
+
+def files_equal(a: str, b: str) -> bool:
+    """Compare the content of two files byte by byte. Stops at the first
+    chunk that differs."""
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        while True:
+            chunk_a = fa.read(CHUNK_SIZE)
+            if chunk_a != fb.read(CHUNK_SIZE):
+                return False
+            if not chunk_a:
+                return True
+
+
+def reflink(src: str, dst: str) -> None:
+    """Create the file ``dst`` sharing all data blocks with ``src``
+    (``cp --reflink=always``). Raises an :class:`OSError` if the file
+    system does not support it.
+
+    The file is not synced: the shared blocks are already on disk and
+    :meth:`ActionEngine.sync` flushes the modified directories in
+    batches."""
+    import fcntl
+
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
+
+
+def _shares_extents(a: str, b: str) -> bool:
+    """Whether two files start with the same shared data block, e. g.
+    because one is a reflink of the other."""
+    extent = _first_extent(a)
+    if not extent or not extent[1] & FIEMAP_EXTENT_SHARED:
+        return False
+    other = _first_extent(b)
+    return other is not None and other[0] == extent[0]
+
+
+def _temporary_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".{}.{}.tmp".format(name, os.getpid()))
+
+
+def _is_temporary(name: str) -> bool:
+    return name.startswith(".") and name.endswith(".{}.tmp".format(os.getpid()))
+
+
+class ActionEngine:
+    """Reclaim the space of duplicates in place instead of printing ``rm``
+    commands. The first file of a group is kept. Every other file is
+    compared byte by byte with it and then
+
+    * ``hardlink``: replaced by a hardlink to the kept file,
+    * ``reflink``: replaced by a copy sharing the data blocks with the kept
+      file (Btrfs, XFS); the metadata of the duplicate is preserved,
+    * ``delete``: deleted.
+
+    The replacement is created under a temporary name in the directory of
+    the duplicate and renamed over it, so the path always points to a
+    complete file. The modified directories are synced in batches.
+    """
+
+    replaced: int
+    """Number of replaced or deleted files."""
+
+    reclaimed: int
+    """Number of bytes freed. A duplicate with further hardlinks outside
+    of the group frees no space."""
+
+    failed: int
+    """Number of duplicates that were left untouched because of an error
+    or because their content differs."""
+
+    def __init__(
+        self, action: str, dry_run: bool = False, fsync_batch: int = 256
+    ) -> None:
+        if action not in ("hardlink", "reflink", "delete"):
+            raise ValueError("Unknown action: {}".format(action))
+        self.action = action
+        self.dry_run = dry_run
+        self.fsync_batch = fsync_batch
+        self.replaced = 0
+        self.reclaimed = 0
+        self.failed = 0
+        self._dirty_dirs: Set[str] = set()
+
+    def _replace(self, keep: FileEntry, duplicate: FileEntry) -> None:
+        if self.action == "delete":
+            os.remove(duplicate.path)
+            return
+        tmp = _temporary_path(duplicate.path)
+        if self.action == "hardlink":
+            os.link(keep.path, tmp)
+        else:
+            reflink(keep.path, tmp)
+            try:
+                shutil.copystat(duplicate.path, tmp)
+            except OSError:
+                pass
+        try:
+            os.replace(tmp, duplicate.path)
+        except OSError:
+            os.remove(tmp)
+            raise
+
+    def apply(self, group: DuplicateGroup) -> List[str]:
+        """Reclaim the space of all duplicates of a group. Of a group of
+        identical directory trees the files of all but the first tree are
+        reclaimed one by one; with ``delete`` the emptied directories are
+        removed as well.
+
+        :return: The paths of the files that were replaced or deleted.
+        """
+        modified: List[str] = []
+        if group.kind == "duplicates":
+            keep = group.entries[0]
+            for duplicate in group.entries[1:]:
+                self._apply(keep, duplicate, modified)
+        elif group.kind == "directories":
+            for copy in group.entries[1:]:
+                self._apply_tree(group.entries[0].path, copy.path, modified)
+        return modified
+
+    def _apply(
+        self, keep: FileEntry, duplicate: FileEntry, modified: List[str]
+    ) -> None:
+        if self.action == "reflink" and _shares_extents(keep.path, duplicate.path):
+            return
+        try:
+            if self.action != "delete" and duplicate.dev != keep.dev:
+                raise OSError("{} is on another file system".format(keep.path))
+            if not files_equal(keep.path, duplicate.path):
+                raise OSError("content differs from {}".format(keep.path))
+            if not self.dry_run:
+                self._replace(keep, duplicate)
+        except OSError as e:
+            print("Skipping {}: {}".format(duplicate.path, e), file=sys.stderr)
+            self.failed += 1
+            return
+        self.replaced += 1
+        if duplicate.nlink == 1:
+            self.reclaimed += duplicate.size
+        if not self.dry_run:
+            modified.append(duplicate.path)
+            self._dirty_dirs.add(os.path.dirname(duplicate.path))
+            if len(self._dirty_dirs) >= self.fsync_batch:
+                self.sync()
+
+    def _apply_tree(self, keep: str, copy: str, modified: List[str]) -> None:
+        for root, dirs, files in os.walk(keep):
+            relative = os.path.relpath(root, keep)
+            for name in sorted(files):
+                keep_path = os.path.join(root, name)
+                duplicate_path = os.path.normpath(os.path.join(copy, relative, name))
+                try:
+                    keep_st = os.lstat(keep_path)
+                    duplicate_st = os.lstat(duplicate_path)
+                except OSError as e:
+                    print("Skipping {}: {}".format(duplicate_path, e), file=sys.stderr)
+                    self.failed += 1
+                    continue
+                if not (
+                    stat.S_ISREG(keep_st.st_mode) and stat.S_ISREG(duplicate_st.st_mode)
+                ):
+                    continue
+                self._apply(
+                    FileEntry.from_stat(keep_path, keep_st),
+                    FileEntry.from_stat(duplicate_path, duplicate_st),
+                    modified,
+                )
+        if self.action == "delete" and not self.dry_run:
+            for root, dirs, files in os.walk(copy, topdown=False):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    # Not empty: a file was skipped.
+                    continue
+                self._dirty_dirs.discard(root)
+                self._dirty_dirs.add(os.path.dirname(root))
+
+    def sync(self) -> None:
+        """Flush the renames to disk by syncing the modified directories."""
+        for directory in self._dirty_dirs:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._dirty_dirs = set()
+
+    def __str__(self) -> str:
+        return "{}{}: {} files, {} bytes reclaimed, {} skipped".format(
+            "Dry run " if self.dry_run else "",
+            self.action.capitalize(),
+            self.replaced,
+            self.reclaimed,
+            self.failed,
+        )
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+"""The inotify events :class:`Watcher` subscribes to for each directory."""
+
+_EVENT = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+    wd: int
+    """The watch descriptor of the directory."""
+
+    mask: int
+    """The ``IN_*`` flags of the event."""
+
+    cookie: int
+
+    name: str
+    """The name of the file or subdirectory in the watched directory."""
+
+
+class Inotify:
+    """A minimal binding of the Linux inotify API with :mod:`ctypes`.
+
+    Raises an :class:`OSError` if inotify is not available.
+    """
+
+    def __init__(self) -> None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    @staticmethod
+    def _raise(path: Optional[str] = None) -> None:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        """Watch a directory.
+
+        :return: The watch descriptor.
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        # Fails if the kernel already removed the watch, e. g. because the
+        # directory was deleted.
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout: Optional[float] = None) -> List[InotifyEvent]:
+        """Wait for events.
+
+        :param timeout: The number of seconds to wait at most, ``None`` to
+          wait forever.
+
+        :return: The queued events, an empty list after the timeout.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        events: List[InotifyEvent] = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher:
+    """Keep an index of the files below a directory up to date with inotify
+    events instead of walking the tree again.
+
+    After the initial :meth:`scan`, every file that is closed after writing,
+    moved into the tree or hardlinked into it is indexed and its group of
+    duplicates is reported by :meth:`poll`. Deleted and moved away files
+    and directories are dropped from the index; new directories are
+    watched and scanned. If the kernel queue overflows, the tree is scanned
+    again.
+
+    :param path: The directory to watch.
+    :param stats: The counters to update.
+    :param verify: Confirm the content of files with the same size. The
+      digests are kept in an in-memory cache, so every file is read at most
+      once while it is unchanged.
+    :param cache_file: Keep the digests in this :class:`FingerprintCache`
+      instead. Implies ``verify``.
+    :param walk_filter: Skip files and directories, also when they are
+      created later.
+    :param hash_algorithm: One of :data:`HASH_ALGORITHMS`.
+    :param buffer_size: The number of bytes to read at once when hashing.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        stats: Stats,
+        verify: bool = False,
+        cache_file: Optional[str] = None,
+        walk_filter: Optional[WalkFilter] = None,
+        hash_algorithm: str = "blake2b",
+        buffer_size: int = CHUNK_SIZE,
+    ) -> None:
+        self.root = path.rstrip(os.sep) or os.sep
+        self.stats = stats
+        self.walk_filter = walk_filter
+        self.hasher = Hasher(hash_algorithm, buffer_size)
+        self.cache: Optional[FingerprintCache] = None
+        if verify or cache_file:
+            self.cache = FingerprintCache(cache_file or ":memory:", hash_algorithm)
+        self.inotify = Inotify()
+        self.watches: Dict[int, str] = {}
+        self.files: Dict[str, FileEntry] = {}
+        self.sizes: Dict[int, Dict[str, FileEntry]] = {}
+
+    def _index(self, entry: FileEntry) -> bool:
+        """:return: ``False`` if the file is already indexed unchanged."""
+        old = self.files.get(entry.path)
+        if old == entry:
+            return False
+        if old:
+            self._unindex(old.path)
+        self.files[entry.path] = entry
+        self.sizes.setdefault(entry.size, {})[entry.path] = entry
+        return True
+
+    def _unindex(self, path: str) -> None:
+        entry = self.files.pop(path, None)
+        if entry:
+            same_size = self.sizes[entry.size]
+            del same_size[path]
+            if not same_size:
+                del self.sizes[entry.size]
+
+    def _unindex_tree(self, directory: str) -> None:
+        prefix = os.path.join(directory, "")
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            self._unindex(path)
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _add_tree(self, directory: str) -> List[FileEntry]:
+        """Watch a directory and all its subdirectories and index their
+        files. The directories are watched before they are listed, so no
+        file created in the meantime is missed.
+
+        :raises OSError: If the watched root itself cannot be watched.
+        """
+        added: List[FileEntry] = []
+        stack = [directory]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                self.watches[self.inotify.add_watch(dir_path)] = dir_path
+            except OSError as e:
+                if dir_path == self.root:
+                    raise
+                print("Not watching {}: {}".format(dir_path, e), file=sys.stderr)
+            files, subdirs = _scan_directory(dir_path, self.walk_filter)
+            self.stats.dirs += 1
+            for entry in files:
+                self.stats.files += 1
+                if self._index(entry):
+                    added.append(entry)
+            self.stats.tick()
+            stack.extend(reversed(subdirs))
+        return added
+
+    def _skip_dir(self, path: str) -> bool:
+        walk_filter = self.walk_filter
+        if not walk_filter:
+            return False
+        if walk_filter.excludes and walk_filter.excluded(path):
+            return True
+        if walk_filter.dev is not None:
+            try:
+                return os.lstat(path).st_dev != walk_filter.dev
+            except OSError:
+                return True
+        return False
+
+    def _stat(self, path: str) -> Optional[FileEntry]:
+        """Stat a file reported by an event.
+
+        :return: ``None`` if the file is gone, not a regular file, skipped
+          by the filter or a temporary file of an :class:`ActionEngine`.
+        """
+        if _is_temporary(os.path.basename(path)):
+            return None
+        walk_filter = self.walk_filter
+        if walk_filter and walk_filter.excludes and walk_filter.excluded(path):
+            return None
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if walk_filter and walk_filter.skip_size(st.st_size):
+            return None
+        return FileEntry.from_stat(path, st)
+
+    def groups(
+        self, size: int, entry: Optional[FileEntry] = None
+    ) -> List[DuplicateGroup]:
+        """The groups of duplicates among the indexed files of one size. Of
+        several links of the same inode only the one with the smallest path
+        is considered.
+
+        :param size: The size of the files.
+        :param entry: Only return the group of this file.
+        """
+        links: Dict[Tuple[int, int], FileEntry] = {}
+        for candidate in self.sizes.get(size, {}).values():
+            key = (candidate.dev, candidate.ino)
+            if key not in links or candidate.path < links[key].path:
+                links[key] = candidate
+        if entry and links.get((entry.dev, entry.ino)) != entry:
+            # A further link of an indexed file.
+            return []
+        if len(links) < 2:
+            return []
+        candidates = sorted(links.values())
+        if self.cache:
+            groups = verify_content(
+                size, candidates, self.stats, self.cache, "hash", self.hasher
+            )
+        else:
+            groups = [(None, candidates)]
+        return [
+            DuplicateGroup("duplicates", size, digest, sorted(group))
+            for digest, group in groups
+            if not entry or entry in group
+        ]
+
+    def scan(self) -> List[DuplicateGroup]:
+        """Watch the directory tree, index all files and return the groups
+        of duplicates sorted by size.
+
+        :raises OSError: If the directory cannot be watched, e. g. because
+          it does not exist.
+        """
+        self.stats.start_phase("walk")
+        self._add_tree(self.root)
+        self.stats.end_phase()
+        self.stats.start_phase("verify")
+        groups: List[DuplicateGroup] = []
+        for size in sorted(self.sizes):
+            groups.extend(self.groups(size))
+        self.stats.end_phase()
+        return groups
+
+    def rescan(self) -> List[FileEntry]:
+        """Drop the index and all watches and scan the tree again.
+
+        :return: The files that are new or modified compared to the old
+          index.
+        """
+        for wd in self.watches:
+            self.inotify.rm_watch(wd)
+        self.watches.clear()
+        old = self.files
+        self.files = {}
+        self.sizes.clear()
+        return [
+            entry for entry in self._add_tree(self.root) if old.get(entry.path) != entry
+        ]
+
+    def refresh(self, paths: List[str]) -> None:
+        """Index files modified by this process, e. g. by an
+        :class:`ActionEngine`, so that their events are not reported as new
+        duplicates.
+
+        :param paths: The paths of the replaced or deleted files.
+        """
+        for path in paths:
+            entry = self._stat(path)
+            if entry:
+                self._index(entry)
+            else:
+                self._unindex(path)
+
+    def poll(self, timeout: Optional[float] = None) -> List[DuplicateGroup]:
+        """Wait for events and update the index.
+
+        :param timeout: The number of seconds to wait at most, ``None`` to
+          wait forever.
+
+        :return: The groups of duplicates the new or modified files belong
+          to.
+        """
+        changed: Dict[str, FileEntry] = {}
+        for event in self.inotify.read(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                print(
+                    "The inotify queue overflowed, scanning {} again.".format(
+                        self.root
+                    ),
+                    file=sys.stderr,
+                )
+                changed = {entry.path: entry for entry in self.rescan()}
+                continue
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & IN_IGNORED:
+                del self.watches[event.wd]
+                continue
+            if not event.name:
+                # IN_DELETE_SELF or IN_MOVE_SELF: handled by the event of
+                # the parent directory.
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & IN_ISDIR:
+                if event.mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._unindex_tree(path)
+                elif event.mask & (IN_CREATE | IN_MOVED_TO):
+                    if not self._skip_dir(path):
+                        for entry in self._add_tree(path):
+                            changed[entry.path] = entry
+                continue
+            if event.mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unindex(path)
+                changed.pop(path, None)
+                continue
+            entry = self._stat(path)
+            if not entry:
+                continue
+            if event.mask & IN_CREATE and entry.nlink == 1:
+                # Wait for IN_CLOSE_WRITE. Only a new hardlink is complete
+                # when it is created.
+                continue
+            if self._index(entry):
+                changed[path] = entry
+
+        groups: List[DuplicateGroup] = []
+        reported: Set[Tuple[str, ...]] = set()
+        for entry in changed.values():
+            if self.files.get(entry.path) != entry:
+                continue
+            for group in self.groups(entry.size, entry):
+                paths = tuple(e.path for e in group.entries)
+                if paths not in reported:
+                    reported.add(paths)
+                    groups.append(group)
+        if self.cache:
+            self.cache.commit()
+        return groups
+
+    def close(self) -> None:
+        self.inotify.close()
+        if self.cache:
+            self.cache.close()
+
+
+def check_for_duplicates(
+    path: str,
+    verify: bool = False,
+    cache_file: Optional[str] = None,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    strategy: str = "auto",
+    dirs: bool = False,
+    walk_filter: Optional[WalkFilter] = None,
+    output_format: str = "shell",
+    action: Optional[str] = None,
+    dry_run: bool = False,
+    progress: bool = False,
+    stats_format: str = "text",
+    hash_algorithm: str = "blake2b",
+    buffer_size: int = CHUNK_SIZE,
+    read_order: str = DEFAULT_READ_ORDER,
+    io_rate: Optional[int] = None,
+) -> None:
+    """Print the duplicates below a directory. The arguments are the same as
+    for :func:`find_duplicates`.
+
+    :param output_format: See :func:`format_group`. For the machine
+      readable formats the summary is printed to ``stderr``.
+    :param action: Reclaim the space of the duplicates with an
+      :class:`ActionEngine`: ``hardlink``, ``reflink`` or ``delete``.
+      Implies ``verify``.
+    :param dry_run: Only report the bytes the action would reclaim.
+    :param progress: Show a live status line on ``stderr``.
+    :param stats_format: ``text``: print a summary. ``json``: print the
+      summary and all counters of :class:`Stats` as one JSON object to
+      ``stderr``.
+    """
+    summary = sys.stdout if output_format == "shell" else sys.stderr
+    print(path, file=summary)
+
+    engine: Optional[ActionEngine] = None
+    if action:
+        verify = True
+        engine = ActionEngine(action, dry_run=dry_run)
+
+    stats = Stats(Progress() if progress else None)
+    counts = {"duplicates": 0, "hardlinks": 0, "directories": 0}
+    reclaimable = 0
+    for group in find_duplicates(
+        path,
+        stats,
+        verify=verify,
+        cache_file=cache_file,
+        jobs=jobs,
+        max_memory=max_memory,
+        strategy=strategy,
+        dirs=dirs,
+        walk_filter=walk_filter,
+        hash_algorithm=hash_algorithm,
+        buffer_size=buffer_size,
+        read_order=read_order,
+        io_rate=io_rate,
+    ):
+        counts[group.kind] += 1
+        reclaimable += group.reclaimable
+        sys.stdout.write(format_group(group, output_format))
+        sys.stdout.flush()
+        if engine:
+            engine.apply(group)
+    if engine:
+        engine.sync()
+    if stats.progress:
+        stats.progress.finish()
+
+    if stats_format == "json":
+        report = stats.to_dict()
+        report["groups"] = counts
+        report["reclaimable_bytes"] = reclaimable
+        report["hash"] = hash_algorithm
+        if engine:
+            report["action"] = {
+                "action": engine.action,
+                "dry_run": engine.dry_run,
+                "files": engine.replaced,
+                "bytes_reclaimed": engine.reclaimed,
+                "skipped": engine.failed,
+            }
+        print(json.dumps(report), file=sys.stderr)
+        return
+
+    print("Duplicates found: " + str(counts["duplicates"]), file=summary)
+    if dirs:
+        print(
+            "Duplicate directories found: " + str(counts["directories"]),
+            file=summary,
+        )
+    print("Hardlink sets found: " + str(counts["hardlinks"]), file=summary)
+    print("Reclaimable bytes: " + str(reclaimable), file=summary)
+    if verify or cache_file or dirs:
+        _print_stages(stats, cache_file, summary)
+    if engine:
+        print(engine, file=summary)
+
+
+def _print_stages(stats: Stats, cache_file: Optional[str], file: TextIO) -> None:
+    for stage in stats.stages:
+        print(stage, file=file)
+    if cache_file:
+        print(
+            "Cache: {} hits, {} misses".format(stats.cache_hits, stats.cache_misses),
+            file=file,
+        )
+
+
+def write_manifest(
+    path: str,
+    manifest_file: str,
+    cache_file: Optional[str] = None,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    walk_filter: Optional[WalkFilter] = None,
+    hash_algorithm: str = "blake2b",
+    buffer_size: int = CHUNK_SIZE,
+    io_rate: Optional[int] = None,
+    progress: bool = False,
+    stats_format: str = "text",
+) -> None:
+    """Write a manifest with :func:`export_manifest` and print a summary.
+    The arguments are the same as for :func:`check_for_duplicates`."""
+    stats = Stats(Progress() if progress else None)
+    count = export_manifest(
+        path,
+        manifest_file,
+        stats,
+        cache_file=cache_file,
+        jobs=jobs,
+        max_memory=max_memory,
+        walk_filter=walk_filter,
+        hash_algorithm=hash_algorithm,
+        buffer_size=buffer_size,
+        io_rate=io_rate,
+    )
+    if stats.progress:
+        stats.progress.finish()
+
+    if stats_format == "json":
+        report = stats.to_dict()
+        report["manifest"] = {"file": manifest_file, "records": count}
+        report["hash"] = hash_algorithm
+        print(json.dumps(report), file=sys.stderr)
+        return
+
+    print(path)
+    print("Manifest records written: {}".format(count))
+    _print_stages(stats, cache_file, sys.stdout)
+
+
+def check_against_manifest(
+    path: str,
+    manifest_file: str,
+    cache_file: Optional[str] = None,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    walk_filter: Optional[WalkFilter] = None,
+    output_format: str = "shell",
+    buffer_size: int = CHUNK_SIZE,
+    io_rate: Optional[int] = None,
+    progress: bool = False,
+    stats_format: str = "text",
+) -> None:
+    """Print the files below a directory that are listed in a manifest (see
+    :func:`find_in_manifest`). The arguments are the same as for
+    :func:`check_for_duplicates`."""
+    summary = sys.stdout if output_format == "shell" else sys.stderr
+    print(path, file=summary)
+
+    stats = Stats(Progress() if progress else None)
+    found = 0
+    found_bytes = 0
+    for group in find_in_manifest(
+        path,
+        manifest_file,
+        stats,
+        cache_file=cache_file,
+        jobs=jobs,
+        max_memory=max_memory,
+        walk_filter=walk_filter,
+        buffer_size=buffer_size,
+        io_rate=io_rate,
+    ):
+        found += 1
+        found_bytes += group.size
+        sys.stdout.write(format_group(group, output_format))
+        sys.stdout.flush()
+    if stats.progress:
+        stats.progress.finish()
+
+    if stats_format == "json":
+        report = stats.to_dict()
+        report["manifest"] = {"file": manifest_file, "found": found}
+        report["reclaimable_bytes"] = found_bytes
+        print(json.dumps(report), file=sys.stderr)
+        return
+
+    print("Found in manifest: {}".format(found), file=summary)
+    print("Reclaimable bytes: {}".format(found_bytes), file=summary)
+    _print_stages(stats, cache_file, summary)
+
+
+def watch_for_duplicates(
+    path: str,
+    verify: bool = False,
+    cache_file: Optional[str] = None,
+    walk_filter: Optional[WalkFilter] = None,
+    output_format: str = "shell",
+    action: Optional[str] = None,
+    dry_run: bool = False,
+    hash_algorithm: str = "blake2b",
+    buffer_size: int = CHUNK_SIZE,
+) -> None:
+    """Print the duplicates below a directory, then keep watching it with a
+    :class:`Watcher` and print the group of every file that becomes a
+    duplicate. Runs until interrupted. The arguments are the same as for
+    :func:`check_for_duplicates`.
+    """
+    summary = sys.stdout if output_format == "shell" else sys.stderr
+    print(path, file=summary)
+
+    engine: Optional[ActionEngine] = None
+    if action:
+        verify = True
+        engine = ActionEngine(action, dry_run=dry_run, fsync_batch=1)
+
+    watcher = Watcher(
+        path,
+        Stats(),
+        verify=verify,
+        cache_file=cache_file,
+        walk_filter=walk_filter,
+        hash_algorithm=hash_algorithm,
+        buffer_size=buffer_size,
+    )
+    try:
+        groups = watcher.scan()
+        while True:
+            for group in groups:
+                sys.stdout.write(format_group(group, output_format))
+                sys.stdout.flush()
+                if engine:
+                    watcher.refresh(engine.apply(group))
+            if engine:
+                engine.sync()
+            groups = watcher.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        if engine:
+            print(engine, file=summary)
 
 
 def get_parser():
@@ -49,6 +2850,225 @@ def get_parser():
         help="A directory to recursively search for duplicate files.",
     )
 
+    parser.add_argument(
+        "--min-size",
+        type=parse_size,
+        default=0,
+        metavar="SIZE",
+        help="Skip files smaller than SIZE (e. g. 1 to skip empty files).",
+    )
+
+    parser.add_argument(
+        "--max-size",
+        type=parse_size,
+        metavar="SIZE",
+        help="Skip files larger than SIZE (e. g. 100M).",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Skip files and directories matching GLOB. A pattern without a "
+        "slash (e. g. .git or *.tmp) matches the name, a pattern with a slash "
+        "the path relative to the searched directory. * does not match a "
+        "slash, ** matches any number of directories (as in list-files.py). "
+        "Excluded directories are not descended into. Can be given multiple "
+        "times.",
+    )
+
+    parser.add_argument(
+        "-x",
+        "--one-file-system",
+        action="store_true",
+        help="Do not descend into directories on other file systems.",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Confirm that files with the same size also have the same "
+        "content. Only files sharing their size with other files are read: "
+        "first a small sample of the head and the tail, then the whole "
+        "content of the files whose samples still match.",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep the digests in a persistent cache (default location: "
+        "$XDG_CACHE_HOME/jfscripts/find-dupes-by-size.sqlite), so that a "
+        "rescan only reads new or modified files. Implies --verify.",
+    )
+
+    parser.add_argument(
+        "--cache-file",
+        metavar="PATH",
+        help="The location of the persistent digest cache. Implies --cache.",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="List N directories concurrently (default: %(default)s). Raise "
+        "this on network file systems like NFS or CIFS.",
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        metavar="SIZE",
+        help="Keep the memory used for the collected files below SIZE "
+        "(e. g. 512M or 2G) by spilling them to sorted temporary files. "
+        "Use this on trees with many millions of files.",
+    )
+
+    parser.add_argument(
+        "--strategy",
+        choices=("auto", "hash", "compare"),
+        default="auto",
+        help="How to confirm the content of files whose samples match "
+        "(default: %(default)s). hash: compute a digest of each file. "
+        "compare: memory-map the files and compare them block by block, "
+        "stopping at the first difference. auto: compare groups of up to "
+        "{} files of at least {} KiB, hash all others.".format(
+            COMPARE_MAX_FILES, COMPARE_MIN_SIZE // 1024
+        ),
+    )
+
+    parser.add_argument(
+        "--hash",
+        choices=HASH_ALGORITHMS,
+        default="blake2b",
+        help="The algorithm to compute the digests with (default: "
+        "%(default)s). xxh3 is not cryptographic, but much faster; it needs "
+        "the package xxhash and falls back to blake2b without it. The cache "
+        "keeps the digests of each algorithm separately.",
+    )
+
+    parser.add_argument(
+        "--buffer-size",
+        metavar="SIZE",
+        type=parse_size,
+        default=CHUNK_SIZE,
+        help="The number of bytes to read at once when hashing (default: 1M).",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--dirs",
+        action="store_true",
+        help="Report directory trees with identical content once instead of "
+        "as many groups of duplicate files. Only trees with the same names "
+        "and file sizes are hashed. Not available with --max-memory.",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("shell", "jsonl", "nul"),
+        default="shell",
+        dest="output_format",
+        help="The output format (default: %(default)s). shell: rm commands. "
+        "jsonl: one JSON object per group with the keys type, size, digest, "
+        "inodes and paths. nul: the paths of a group each terminated by a NUL "
+        "character and the group terminated by an additional NUL character. "
+        "Each group is printed as soon as it is final. For jsonl and nul the "
+        "summary is printed to stderr.",
+    )
+
+    parser.add_argument(
+        "-a",
+        "--action",
+        choices=("hardlink", "reflink", "delete"),
+        help="Reclaim the space of the duplicates instead of only printing "
+        "them. The first file of each group is kept, the others are compared "
+        "byte by byte with it and then replaced by a hardlink, replaced by a "
+        "reflink (Btrfs, XFS) or deleted. Implies --verify.",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Only report the bytes --action would reclaim.",
+    )
+
+    parser.add_argument(
+        "--read-order",
+        choices=READ_ORDERS,
+        default=DEFAULT_READ_ORDER,
+        help="The order to read the files to verify in (default: "
+        "%(default)s). The reads of {} files are scheduled together. path: "
+        "group by group. inode: by inode number, a cheap approximation of "
+        "the position on the disk. extent: by the physical position of the "
+        "first extent (Linux FIEMAP), the fewest seeks on rotational "
+        "disks.".format(READ_BATCH),
+    )
+
+    parser.add_argument(
+        "--io-rate",
+        metavar="SIZE",
+        type=parse_size,
+        help="Read at most SIZE bytes per second (e. g. 50M) to leave "
+        "bandwidth for other processes.",
+    )
+
+    parser.add_argument(
+        "--export-manifest",
+        metavar="MANIFEST",
+        help="Hash all files and write a manifest of their sizes, digests and "
+        "paths, sorted by size, instead of searching for duplicates. Compare "
+        "other trees against it with --against, e. g. on another host.",
+    )
+
+    parser.add_argument(
+        "--against",
+        metavar="MANIFEST",
+        help="Print the files that are listed in a manifest written by "
+        "--export-manifest instead of the duplicates within the directory. "
+        "The manifest is read in one pass and never loaded into memory. Only "
+        "files with a size listed in the manifest are read, and only their "
+        "head and tail unless a listed file has the same sample. The hash "
+        "algorithm of the manifest is used. Cannot be combined with --format "
+        "nul, which has no way to mark the paths of the manifest.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Keep running after the scan and watch the directory with Linux "
+        "inotify: print the group of every file that becomes a duplicate "
+        "when it is closed after writing, moved into the tree or hardlinked. "
+        "With --action the new duplicates are reclaimed right away. Not "
+        "available with --dirs and --max-memory.",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--progress",
+        action="store_true",
+        help="Show a live status line on stderr: directories and files per "
+        "second during the walk, bytes read and MB/s per stage during the "
+        "verification.",
+    )
+
+    parser.add_argument(
+        "--stats",
+        choices=("text", "json"),
+        default="text",
+        help="The format of the final report (default: %(default)s). json: "
+        "one object on stderr with the walk rates, the bytes read, bytes "
+        "avoided and MB/s per stage, the cache hit rate and the seconds "
+        "spent in each phase.",
+    )
+
     parser.add_argument(
         "-V",
         "--version",
@@ -60,9 +3080,133 @@ def get_parser():
 
 
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.dry_run and not args.action:
+        parser.error("--dry-run requires --action")
+    if args.dirs and args.max_memory:
+        parser.error("--dirs cannot be combined with --max-memory")
+    if args.watch and (args.dirs or args.max_memory):
+        parser.error("--watch cannot be combined with --dirs or --max-memory")
+    manifest = args.export_manifest or args.against
+    if manifest and (args.dirs or args.watch or args.action):
+        parser.error(
+            "--export-manifest and --against cannot be combined with --dirs, "
+            "--watch or --action"
+        )
+    if args.export_manifest and args.against:
+        parser.error("--export-manifest cannot be combined with --against")
+    if args.against and args.output_format == "nul":
+        parser.error("--against cannot be combined with --format nul")
+    if args.buffer_size < SAMPLE_SIZE:
+        parser.error("--buffer-size must be at least {}".format(SAMPLE_SIZE))
+
+    hash_algorithm: str = args.hash
+    if hash_algorithm == "xxh3" and xxhash is None:
+        print(
+            "The package xxhash is not installed, falling back to blake2b.",
+            file=sys.stderr,
+        )
+        hash_algorithm = "blake2b"
+
+    cache_file: Optional[str] = args.cache_file
+    if args.cache and not cache_file:
+        cache_file = default_cache_file()
+
+    try:
+        walk_filter = WalkFilter(
+            args.path,
+            min_size=args.min_size,
+            max_size=args.max_size,
+            excludes=args.exclude,
+            one_file_system=args.one_file_system,
+        )
+    except OSError as e:
+        parser.error("{}: {}".format(args.path, e.strerror))
+
+    try:
+        if args.export_manifest:
+            try:
+                write_manifest(
+                    args.path,
+                    args.export_manifest,
+                    cache_file=cache_file,
+                    jobs=args.jobs,
+                    max_memory=args.max_memory,
+                    walk_filter=walk_filter,
+                    hash_algorithm=hash_algorithm,
+                    buffer_size=args.buffer_size,
+                    io_rate=args.io_rate,
+                    progress=args.progress,
+                    stats_format=args.stats,
+                )
+            except OSError as e:
+                parser.exit(
+                    1,
+                    "{}: error: {}: {}\n".format(parser.prog, args.export_manifest, e),
+                )
+            return
+
+        if args.against:
+            try:
+                check_against_manifest(
+                    args.path,
+                    args.against,
+                    cache_file=cache_file,
+                    jobs=args.jobs,
+                    max_memory=args.max_memory,
+                    walk_filter=walk_filter,
+                    output_format=args.output_format,
+                    buffer_size=args.buffer_size,
+                    io_rate=args.io_rate,
+                    progress=args.progress,
+                    stats_format=args.stats,
+                )
+            except (OSError, ValueError) as e:
+                parser.exit(
+                    1, "{}: error: {}: {}\n".format(parser.prog, args.against, e)
+                )
+            return
+
+        if args.watch:
+            try:
+                watch_for_duplicates(
+                    args.path,
+                    verify=args.verify,
+                    cache_file=cache_file,
+                    walk_filter=walk_filter,
+                    output_format=args.output_format,
+                    action=args.action,
+                    dry_run=args.dry_run,
+                    hash_algorithm=hash_algorithm,
+                    buffer_size=args.buffer_size,
+                )
+            except OSError as e:
+                parser.exit(1, "{}: error: {}\n".format(parser.prog, e))
+            return
+
+        check_for_duplicates(
+            args.path,
+            verify=args.verify,
+            cache_file=cache_file,
+            jobs=args.jobs,
+            max_memory=args.max_memory,
+            strategy=args.strategy,
+            dirs=args.dirs,
+            walk_filter=walk_filter,
+            output_format=args.output_format,
+            action=args.action,
+            dry_run=args.dry_run,
+            progress=args.progress,
+            stats_format=args.stats,
+            hash_algorithm=hash_algorithm,
+            buffer_size=args.buffer_size,
+            read_order=args.read_order,
+            io_rate=args.io_rate,
+        )
 
-    check_for_duplicates(args.path)
+    except sqlite3.OperationalError as e:
+        parser.exit(1, "{}: error: {}: {}\n".format(parser.prog, cache_file, e))
 
 
 if __name__ == "__main__":
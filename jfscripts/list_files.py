@@ -4,10 +4,16 @@ from __future__ import annotations
 
 import argparse
 import fnmatch
+import functools
 import os
+import queue
 import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Callable, FrozenSet, Iterator, List, Optional, Set, Tuple
 
 from jfscripts import __version__
 
@@ -51,57 +57,450 @@ def _split_glob(glob_path: str) -> Tuple[str, str]:
     )
 
 
-def _list_files_all(dir_path: str) -> List[str]:
-    output: List[str] = []
-    for root, dirs, files in os.walk(dir_path):
+class GlobPattern:
+    """A glob pattern compiled into one matcher per path segment.
+
+    ``*``, ``?`` and ``[...]`` match within a single segment, a segment
+    ``**`` matches any number of segments, including none. A pattern
+    without a path separator (e. g. “(asterisk).txt”) matches the name of
+    a file at any depth, so it behaves like
+    “(asterisk)(asterisk)/(asterisk).txt”.
+
+    A walk keeps the set of positions in the pattern each directory can be
+    matched up to (the states), so that it can skip the directories no
+    file below can match.
+
+    :param pattern: A glob pattern relative to the walked directory.
+    """
+
+    def __init__(self, pattern: str) -> None:
+        segments = [s for s in pattern.split(os.path.sep) if s not in ("", ".")]
+        if len(segments) == 1 and segments[0] != "**":
+            segments.insert(0, "**")
+        self.segments: List[Optional[Callable[[str], Any]]] = []
+        for segment in segments:
+            if segment == "**":
+                if not self.segments or self.segments[-1] is not None:
+                    self.segments.append(None)
+            else:
+                self.segments.append(re.compile(fnmatch.translate(segment)).match)
+
+    def _closure(self, states: Set[int]) -> FrozenSet[int]:
+        # A “**” may match no segment at all.
+        closure = set(states)
+        for state in sorted(states):
+            while state < len(self.segments) and self.segments[state] is None:
+                state += 1
+                closure.add(state)
+        return frozenset(closure)
+
+    def start(self) -> FrozenSet[int]:
+        """The states of the walked directory itself."""
+        return self._closure({0})
+
+    def advance(self, states: FrozenSet[int], name: str) -> FrozenSet[int]:
+        """The states after one more path segment."""
+        following: Set[int] = set()
+        for state in states:
+            if state == len(self.segments):
+                continue
+            matcher = self.segments[state]
+            if matcher is None:
+                following.add(state)
+            elif matcher(name):
+                following.add(state + 1)
+        return self._closure(following)
+
+    def descend(self, states: FrozenSet[int]) -> bool:
+        """Whether a file below a directory with these states can still
+        match."""
+        return any(state < len(self.segments) for state in states)
+
+    def accepts(self, states: FrozenSet[int]) -> bool:
+        """Whether a path with these states matches the whole pattern."""
+        return len(self.segments) in states
+
+    def states(self, path: str) -> FrozenSet[int]:
+        """The states of a relative path."""
+        states = self.start()
+        for name in path.split(os.path.sep):
+            if name and name != ".":
+                states = self.advance(states, name)
+        return states
+
+    def match(self, path: str) -> bool:
+        """Match a relative file path."""
+        return self.accepts(self.states(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_glob(glob_pattern: str) -> GlobPattern:
+    return GlobPattern(glob_pattern)
+
+
+def match_glob(path: str, glob_pattern: str) -> bool:
+    """Match a path against a glob pattern with the semantics of
+    :class:`GlobPattern`: ``*`` does not cross a path separator and ``**``
+    matches any number of path segments. A pattern without a path
+    separator (e. g. “node_modules” or “(asterisk).tmp”) is matched against
+    the last component of the path only, a pattern with a path separator
+    (e. g. “data/(asterisk)/raw”) against the whole relative path.
+
+    :param path: A relative file path.
+    :param glob_pattern: A glob pattern.
+    """
+    return _compile_glob(glob_pattern).match(path)
+
+
+def _scandir(path: str) -> Tuple[List[str], List[str], Set[str]]:
+    """List a directory like one step of :func:`os.walk`.
+
+    :return: The names of the subdirectories, of the other entries and of
+      the subdirectories that are symbolic links and are not descended
+      into.
+    """
+    dirs: List[str] = []
+    files: List[str] = []
+    links: Set[str] = set()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+                else:
+                    files.append(entry.name)
+    except OSError:
+        pass
+    return dirs, files, links
+
+
+def default_index_file() -> str:
+    """The location of the directory index: ``list-files.sqlite`` in the
+    directory ``jfscripts`` of ``$XDG_CACHE_HOME`` (default:
+    ``~/.cache``)."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "jfscripts", "list-files.sqlite")
+
+
+def _pack(names: List[str]) -> bytes:
+    return b"\0".join(os.fsencode(name) for name in names)
+
+
+def _unpack(data: bytes) -> List[str]:
+    return [os.fsdecode(name) for name in data.split(b"\0")] if data else []
+
+
+class DirectoryIndex:
+    """A persistent SQLite index of the entries of directories.
+
+    Each directory is stored with its modification time. A directory is
+    only read again if its modification time has changed, so a walk of an
+    unchanged tree needs one :func:`os.stat` per directory instead of one
+    :func:`os.scandir`. The index can be used from several threads.
+
+    The listings are committed in batches, so an interrupted walk keeps
+    most of its work and several walks can share the index: the database
+    is in WAL mode and a writer waits up to :attr:`TIMEOUT` seconds for the
+    transaction of another one.
+    """
+
+    SCHEMA_VERSION = 1
+
+    COMMIT_INTERVAL = 1000
+    """Commit after this number of read directories ..."""
+
+    COMMIT_SECONDS = 5.0
+    """... or after this number of seconds, whichever comes first."""
+
+    TIMEOUT = 30.0
+    """Number of seconds to wait for a lock held by another process."""
+
+    RACY_NS = 2 * 10**9
+    """A listing is only trusted if it was read this many nanoseconds after
+    the modification time of the directory. An entry created within the
+    resolution of the file system timestamps right after the listing would
+    otherwise go unnoticed."""
+
+    hits: int
+    """Number of directories whose listing was still valid."""
+
+    misses: int
+    """Number of directories that had to be read."""
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: The path of the SQLite database.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(
+            path, timeout=self.TIMEOUT, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.lock = threading.Lock()
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS directories")
+            self.connection.execute(
+                "PRAGMA user_version = {}".format(self.SCHEMA_VERSION)
+            )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            "path BLOB PRIMARY KEY, mtime_ns INTEGER, scanned_ns INTEGER, "
+            "dirs BLOB, files BLOB, links BLOB)"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._committed = time.monotonic()
+
+    def listdir(self, path: str) -> Tuple[List[str], List[str], Set[str]]:
+        """List a directory like :func:`_scandir`, from the index if the
+        directory is unchanged.
+
+        :param path: The directory to list.
+        """
+        key = os.fsencode(os.path.abspath(path))
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime_ns = 0
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT mtime_ns, scanned_ns, dirs, files, links FROM directories "
+                "WHERE path = ?",
+                (key,),
+            ).fetchone()
+        if row is not None and row[0] == mtime_ns and row[1] - mtime_ns >= self.RACY_NS:
+            with self.lock:
+                self.hits += 1
+            return _unpack(row[2]), _unpack(row[3]), set(_unpack(row[4]))
+
+        scanned_ns = time.time_ns()
+        dirs, files, links = _scandir(path)
+        with self.lock:
+            self.misses += 1
+            if row is not None:
+                # Forget the subtrees of the directories that are gone.
+                kept = set(dirs) - links
+                for name in set(_unpack(row[2])) - set(_unpack(row[4])) - kept:
+                    self._evict(os.path.join(key, os.fsencode(name)))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO directories "
+                "(path, mtime_ns, scanned_ns, dirs, files, links) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    mtime_ns,
+                    scanned_ns,
+                    _pack(dirs),
+                    _pack(files),
+                    _pack(sorted(links)),
+                ),
+            )
+            self._pending += 1
+            if (
+                self._pending >= self.COMMIT_INTERVAL
+                or time.monotonic() - self._committed >= self.COMMIT_SECONDS
+            ):
+                self._commit()
+        return dirs, files, links
+
+    def _commit(self) -> None:
+        self.connection.commit()
+        self._pending = 0
+        self._committed = time.monotonic()
+
+    def _evict(self, key: bytes) -> None:
+        prefix = os.path.join(key, b"")
+        self.connection.execute(
+            "DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+            (key, len(prefix), prefix),
+        )
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+
+def _walk(
+    dir_path: str, jobs: int = 1, index: Optional[DirectoryIndex] = None
+) -> Iterator[Tuple[str, List[str], List[str]]]:
+    """Walk a directory tree top-down like :func:`os.walk`.
+
+    With more than one job the directories are listed concurrently with
+    :func:`os.scandir` in a thread pool. On network file systems the walk is
+    bound by the latency of the server, so listing several directories at
+    once speeds it up considerably. The directories are yielded in the
+    order their listings complete. As with :func:`os.walk`, removing names
+    from the yielded list of directories skips them: the subdirectories are
+    only submitted once the caller resumes the walk.
+
+    :param dir_path: The directory to walk.
+    :param jobs: The number of directories to list concurrently.
+    :param index: An optional index to list the unchanged directories from.
+    """
+    if jobs <= 1 and index is None:
+        yield from os.walk(dir_path)
+        return
+
+    listdir = index.listdir if index else _scandir
+    results: queue.Queue[Tuple[str, Future[Tuple[List[str], List[str], Set[str]]]]]
+    results = queue.Queue()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+
+        def submit(path: str) -> None:
+            future = executor.submit(listdir, path)
+            future.add_done_callback(lambda future: results.put((path, future)))
+
+        submit(dir_path)
+        outstanding = 1
+        while outstanding:
+            root, future = results.get()
+            outstanding -= 1
+            dirs, files, links = future.result()
+            yield root, dirs, files
+            for d in dirs:
+                if d not in links:
+                    submit(os.path.join(root, d))
+                    outstanding += 1
+
+
+def _iter_files_all(
+    dir_path: str, jobs: int = 1, index: Optional[DirectoryIndex] = None
+) -> Iterator[str]:
+    for root, dirs, files in _walk(dir_path, jobs, index):
         for d in dirs:
-            output.append(os.path.join(root, d))
+            yield os.path.join(root, d)
         for f in files:
-            output.append(os.path.join(root, f))
-    output.sort()
-    return output
+            yield os.path.join(root, f)
+
+
+def _list_files_all(
+    dir_path: str, jobs: int = 1, index: Optional[DirectoryIndex] = None
+) -> List[str]:
+    return sorted(_iter_files_all(dir_path, jobs, index))
+
+
+def _iter_files_filter(
+    dir_path: str,
+    glob_pattern: str,
+    jobs: int = 1,
+    index: Optional[DirectoryIndex] = None,
+) -> Iterator[str]:
+    pattern = GlobPattern(glob_pattern)
+    for root, dirs, files in _walk(dir_path, jobs, index):
+        states = pattern.states(root[len(dir_path) :])
+        # Only descend into the directories a file below can still match.
+        descend = [d for d in dirs if pattern.descend(pattern.advance(states, d))]
+        if len(descend) != len(dirs):
+            dirs[:] = descend
+        for f in files:
+            if pattern.accepts(pattern.advance(states, f)):
+                yield os.path.join(root, f)
 
 
-def _list_files_filter(dir_path: str, glob_pattern: str) -> List[str]:
-    output: List[str] = []
-    for root, _, files in os.walk(dir_path):
-        relroot = root[len(dir_path) :]
-        for f in files:
-            relfiles = os.path.join(relroot, f)
-            if fnmatch.fnmatch(relfiles, glob_pattern):
-                output.append(os.path.join(root, f))
-    output.sort()
-    return output
+def _list_files_filter(
+    dir_path: str,
+    glob_pattern: str,
+    jobs: int = 1,
+    index: Optional[DirectoryIndex] = None,
+) -> List[str]:
+    return sorted(_iter_files_filter(dir_path, glob_pattern, jobs, index))
 
 
-def list_files(files: List[str], default_glob: str | None = None):
-    """
+def iter_files(
+    files: List[str],
+    default_glob: str | None = None,
+    sort: bool = False,
+    jobs: int = 1,
+    index_file: Optional[str] = None,
+) -> Iterator[str]:
+    """Yield the file paths as they are discovered, without waiting for the
+    whole walk and without keeping the paths in memory.
+
     :param list files: A list of file paths or a single element list containing
       a glob string.
 
     :param string default_glob: A default glob pattern like “(asterisk).txt”.
       This argument is only taken into account, if “element” is a list with
       only one entry and this entry is a path to a directory.
+
+    :param sort: Collect and sort the paths of a walk before yielding them,
+      like :func:`list_files`.
+
+    :param jobs: The number of directories to list concurrently. Without
+      ``sort`` the order of the paths then depends on the timing of the
+      file system.
+
+    :param index_file: The path of a :class:`DirectoryIndex`. The walk
+      then only reads the directories that have changed since the last
+      walk with this index.
     """
     if len(files) > 1:
-        return files
+        yield from files
+        return
 
     file_path = files[0]
 
     if not is_glob(file_path):
-        if os.path.isdir(file_path):
-            if default_glob:
-                return _list_files_filter(file_path, default_glob)
-            else:
-                return _list_files_all(file_path)
-        else:  # not a directory
-            return [file_path]
-
+        if not os.path.isdir(file_path):
+            yield file_path
+            return
+        dir_path = file_path
+        glob_pattern = default_glob
     else:  # is glob
-        glob_prefix, glob_pattern = _split_glob(file_path)
-        return _list_files_filter(glob_prefix, glob_pattern)
+        dir_path, glob_pattern = _split_glob(file_path)
 
-    raise ValueError("Something went wrong.")
+    index = DirectoryIndex(index_file) if index_file else None
+    try:
+        if glob_pattern:
+            paths = _iter_files_filter(dir_path, glob_pattern, jobs, index)
+        else:
+            paths = _iter_files_all(dir_path, jobs, index)
+        if sort:
+            yield from sorted(paths)
+        else:
+            yield from paths
+    finally:
+        if index:
+            index.close()
+
+
+def list_files(
+    files: List[str],
+    default_glob: str | None = None,
+    jobs: int = 1,
+    index_file: Optional[str] = None,
+):
+    """
+    :param list files: A list of file paths or a single element list containing
+      a glob string.
+
+    :param string default_glob: A default glob pattern like “(asterisk).txt”.
+      This argument is only taken into account, if “element” is a list with
+      only one entry and this entry is a path to a directory.
+
+    :param jobs: The number of directories to list concurrently.
+
+    :param index_file: The path of a :class:`DirectoryIndex` to answer
+      repeated queries of the same tree from.
+    """
+    if len(files) > 1:
+        return files
+    return list(
+        iter_files(files, default_glob, sort=True, jobs=jobs, index_file=index_file)
+    )
 
 
 def doc_examples(
@@ -157,6 +556,40 @@ def get_parser():
         nargs="+",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="List N directories concurrently (default: %(default)s). Raise "
+        "this on network file systems like NFS or CIFS.",
+    )
+
+    parser.add_argument(
+        "-i",
+        "--index",
+        action="store_true",
+        help="Keep the listings of the directories in a persistent index "
+        "(default location: $XDG_CACHE_HOME/jfscripts/list-files.sqlite), so "
+        "that a query of an unchanged tree only checks the modification time "
+        "of each directory and only changed directories are read again.",
+    )
+
+    parser.add_argument(
+        "--index-file",
+        metavar="PATH",
+        help="The location of the persistent directory index. Implies --index.",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--sort",
+        action="store_true",
+        help="Sort the paths. They are only printed after the whole tree "
+        "is walked. By default each path is printed as soon as it is found.",
+    )
+
     parser.add_argument(
         "-V",
         "--version",
@@ -168,12 +601,21 @@ def get_parser():
 
 
 def main():
-    args = get_parser().parse_args()
-    files = list_files(args.input_files)
-    if files:
-        for f in files:
+    parser = get_parser()
+    args = parser.parse_args()
+    index_file: Optional[str] = args.index_file
+    if args.index and not index_file:
+        index_file = default_index_file()
+    found = False
+    try:
+        for f in iter_files(
+            args.input_files, sort=args.sort, jobs=args.jobs, index_file=index_file
+        ):
             print(f)
-    else:
+            found = True
+    except sqlite3.OperationalError as e:
+        parser.exit(1, "{}: error: {}: {}\n".format(parser.prog, index_file, e))
+    if not found:
         print("Nothing found to list. :-(")
 
 
@@ -0,0 +1,386 @@
+#! /usr/bin/env python3
+
+"""Benchmark ``find-dupes-by-size.py`` on synthetic directory trees.
+
+The trees are generated reproducibly from a seed and kept in a work
+directory, so that repeated runs only pay for the generation once. Each
+scenario is scanned with several option sets, the best of ``--repeat`` runs
+is written as JSON and can be compared against a stored baseline:
+
+::
+
+    python -m tests.benchmark_find_dupes_by_size --save baseline.json
+    python -m tests.benchmark_find_dupes_by_size --baseline baseline.json
+
+The second call exits with status 1 if a run is slower than the baseline by
+more than ``--tolerance``. The files are read through the page cache, so
+the numbers measure the CPU and system call overhead rather than the disk.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from jfscripts import __version__
+from jfscripts.find_dupes_by_size import check_for_duplicates
+
+SIZE_DISTRIBUTIONS: Dict[str, List[Tuple[float, int, int]]] = {
+    "small": [(0.7, 0, 4096), (0.3, 4096, 65536)],
+    "mixed": [(0.6, 0, 4096), (0.3, 4096, 1 << 20), (0.1, 1 << 20, 8 << 20)],
+    "large": [(0.5, 1 << 20, 16 << 20), (0.5, 16 << 20, 64 << 20)],
+}
+"""Buckets of ``(weight, minimum size, maximum size)`` in bytes."""
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "small-files": {
+        "files": 20000,
+        "depth": 4,
+        "fanout": 6,
+        "sizes": "small",
+        "duplicate_ratio": 0.2,
+        "collision_ratio": 0.1,
+        "hardlink_ratio": 0.02,
+    },
+    "mixed": {
+        "files": 5000,
+        "depth": 3,
+        "fanout": 5,
+        "sizes": "mixed",
+        "duplicate_ratio": 0.2,
+        "collision_ratio": 0.05,
+        "hardlink_ratio": 0.02,
+    },
+    "large-files": {
+        "files": 100,
+        "depth": 2,
+        "fanout": 3,
+        "sizes": "large",
+        "duplicate_ratio": 0.3,
+        "collision_ratio": 0.2,
+        "hardlink_ratio": 0.0,
+    },
+}
+"""The parameters of :func:`generate_tree` for each scenario."""
+
+MODES: Dict[str, Dict[str, Any]] = {
+    "size": {},
+    "verify": {"verify": True},
+    "hash": {"verify": True, "strategy": "hash"},
+    "dirs": {"verify": True, "dirs": True},
+}
+"""The keyword arguments of ``check_for_duplicates`` for each mode."""
+
+BLOCK_SIZE = 65536
+
+NOISE = 0.01
+"""Differences below this many seconds are never reported as regressions."""
+
+
+def _random_bytes(rng: random.Random, size: int) -> bytes:
+    # random.randbytes() is only available on Python 3.9+.
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def _content(rng: random.Random, block: bytes, size: int) -> bytes:
+    """Unique content: a random head and a random tail around a shared
+    filler block, so that generating large files stays fast."""
+    head = _random_bytes(rng, min(size, 16))
+    if size <= 32:
+        return (head + _random_bytes(rng, size))[:size]
+    tail = _random_bytes(rng, 16)
+    middle = size - 32
+    filler = block * (middle // len(block) + 1)
+    return head + filler[:middle] + tail
+
+
+def generate_tree(
+    root: str,
+    files: int = 1000,
+    depth: int = 3,
+    fanout: int = 4,
+    sizes: str = "mixed",
+    duplicate_ratio: float = 0.2,
+    collision_ratio: float = 0.05,
+    hardlink_ratio: float = 0.02,
+    seed: int = 0,
+) -> Dict[str, int]:
+    """Generate a reproducible directory tree with duplicate files.
+
+    :param root: The directory to create the tree in.
+    :param files: The number of files.
+    :param depth: The maximum depth of the directories below ``root``.
+    :param fanout: The number of subdirectories of each directory.
+    :param sizes: A key of :data:`SIZE_DISTRIBUTIONS`.
+    :param duplicate_ratio: The share of files that are copies of an
+      earlier file.
+    :param collision_ratio: The share of files that have the size of an
+      earlier file, but differ from it in a single byte in the middle. They
+      pass the partial digest and are only told apart by the full content.
+    :param hardlink_ratio: The share of files that are hardlinks of an
+      earlier file.
+    :param seed: The seed of the random number generator.
+
+    :return: The number of ``files``, ``bytes``, ``dirs``, ``duplicates``,
+      ``collisions`` and ``hardlinks`` created.
+    """
+    rng = random.Random(seed)
+    buckets = SIZE_DISTRIBUTIONS[sizes]
+    weights = [bucket[0] for bucket in buckets]
+    block = _random_bytes(rng, BLOCK_SIZE)
+
+    dirs = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, "d{}".format(i))
+            for parent in level
+            for i in range(fanout)
+        ]
+        dirs.extend(level)
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+
+    summary = {
+        "files": files,
+        "bytes": 0,
+        "dirs": len(dirs),
+        "duplicates": 0,
+        "collisions": 0,
+        "hardlinks": 0,
+    }
+    created: List[Tuple[str, int]] = []
+    for i in range(files):
+        path = os.path.join(rng.choice(dirs), "f{}.bin".format(i))
+        kind = rng.random()
+        if created and kind < hardlink_ratio:
+            os.link(rng.choice(created)[0], path)
+            summary["hardlinks"] += 1
+            continue
+        if created and kind < hardlink_ratio + duplicate_ratio:
+            source, size = rng.choice(created)
+            with open(source, "rb") as f:
+                content = f.read()
+            summary["duplicates"] += 1
+        elif created and kind < hardlink_ratio + duplicate_ratio + collision_ratio:
+            source, size = rng.choice(created)
+            with open(source, "rb") as f:
+                content = bytearray(f.read())
+            if size:
+                content[size // 2] ^= 0xFF
+            summary["collisions"] += 1
+        else:
+            _, low, high = rng.choices(buckets, weights)[0]
+            size = rng.randint(low, high)
+            content = _content(rng, block, size)
+        with open(path, "wb") as f:
+            f.write(content)
+        created.append((path, size))
+        summary["bytes"] += size
+    return summary
+
+
+def prepare_tree(workdir: str, scenario: str, scale: float, seed: int) -> str:
+    """Generate the tree of a scenario or reuse it from an earlier run.
+
+    :return: The root directory of the tree.
+    """
+    params = dict(SCENARIOS[scenario])
+    params["files"] = max(1, int(params["files"] * scale))
+    params["seed"] = seed
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    root = os.path.join(workdir, "{}-{}".format(scenario, key[:8]))
+    manifest = root + ".json"
+    if not os.path.exists(manifest):
+        summary = generate_tree(os.path.join(root, "tree"), **params)
+        with open(manifest, "w") as f:
+            json.dump({"params": params, "summary": summary}, f)
+    return os.path.join(root, "tree")
+
+
+def run_once(path: str, **kwargs: Any) -> Tuple[float, Dict[str, Any]]:
+    """Run ``check_for_duplicates`` with ``--stats json``.
+
+    :return: The wall time in seconds and the stats report.
+    """
+    stderr = io.StringIO()
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(stderr):
+            start = time.perf_counter()
+            check_for_duplicates(path, stats_format="json", **kwargs)
+            seconds = time.perf_counter() - start
+    return seconds, json.loads(stderr.getvalue().splitlines()[-1])
+
+
+def run_benchmark(
+    workdir: str,
+    scenarios: List[str],
+    modes: List[str],
+    scale: float = 1.0,
+    repeat: int = 3,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Run each mode on each scenario and keep the fastest of ``repeat``
+    runs.
+
+    :return: The results keyed by ``scenario/mode``.
+    """
+    results: Dict[str, Any] = {}
+    for scenario in scenarios:
+        path = prepare_tree(workdir, scenario, scale, seed)
+        for mode in modes:
+            seconds, report = min(
+                (run_once(path, **MODES[mode]) for _ in range(repeat)),
+                key=lambda run: run[0],
+            )
+            bytes_read = sum(stage["bytes_read"] for stage in report["stages"].values())
+            results["{}/{}".format(scenario, mode)] = {
+                "seconds": round(seconds, 4),
+                "files_per_s": round(report["walk"]["files"] / seconds, 1),
+                "mb_per_s": round(bytes_read / 1e6 / seconds, 1),
+                "stats": report,
+            }
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(
+    current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2
+) -> List[str]:
+    """Compare the wall times of two benchmark results.
+
+    :param tolerance: The share a run may be slower than the baseline.
+
+    :return: The names of the runs slower than the baseline.
+    """
+    regressions: List[str] = []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if not reference:
+            continue
+        ratio = result["seconds"] / max(reference["seconds"], 1e-9)
+        status = "ok"
+        if ratio > 1 + tolerance and result["seconds"] - reference["seconds"] > NOISE:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(
+            "{:24} {:9.4f}s {:9.4f}s {:+7.1%}  {}".format(
+                name, reference["seconds"], result["seconds"], ratio - 1, status
+            )
+        )
+    return regressions
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Benchmark find-dupes-by-size.py on synthetic trees.",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="The scenarios to run (default: all). Can be given multiple times.",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="append",
+        choices=list(MODES),
+        help="The option sets to run (default: all). Can be given multiple times.",
+    )
+
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the number of files of each scenario (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Keep the fastest of N runs (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The seed of the tree generator."
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        help="Keep the generated trees in this directory and reuse them "
+        "(default: a temporary directory).",
+    )
+
+    parser.add_argument("--save", metavar="FILE", help="Write the results as JSON.")
+
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="Compare against the results of an earlier run and exit with "
+        "status 1 on regressions.",
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="The share a run may be slower than the baseline (default: %(default)s).",
+    )
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = get_parser().parse_args(argv)
+    scenarios = args.scenario or sorted(SCENARIOS)
+    modes = args.mode or list(MODES)
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(workdir, exist_ok=True)
+        current = run_benchmark(
+            workdir, scenarios, modes, args.scale, args.repeat, args.seed
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.tolerance):
+            sys.exit(1)
+    else:
+        for name, result in current["results"].items():
+            print(
+                "{:24} {:9.4f}s {:12.1f} files/s {:9.1f} MB/s".format(
+                    name, result["seconds"], result["files_per_s"], result["mb_per_s"]
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
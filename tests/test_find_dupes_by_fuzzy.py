@@ -0,0 +1,423 @@
+import io
+import itertools
+import random
+import subprocess
+from pathlib import Path
+from typing import List
+from unittest import mock
+
+import pytest
+from stdout_stderr_capturing import Capturing
+
+from jfscripts.find_dupes_by_fuzzy import (
+    BKTree,
+    DisjointSet,
+    MinHasher,
+    candidate_pairs,
+    check_for_fuzzy_duplicates,
+    collect_names,
+    find_clusters,
+    find_similar_texts,
+    hamming_pairs,
+    levenshtein,
+    normalize,
+    query_index,
+    read_index,
+    score_pairs,
+    shingles,
+    simhash,
+    simhash_file,
+    similarity,
+    write_index,
+)
+from tests._helper import is_executable
+
+
+def touch(path: Path) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    return str(path)
+
+
+class TestFunctionNormalize:
+    def test_separators(self) -> None:
+        assert normalize("My_File - Copy.PDF") == "my file copy pdf"
+
+    def test_only_separators(self) -> None:
+        assert normalize("._-") == ""
+
+
+class TestFunctionShingles:
+    def test_padding(self) -> None:
+        assert shingles("abc") == {" ab", "abc", "bc "}
+
+    def test_short(self) -> None:
+        assert shingles("a") == {" a "}
+        assert shingles("a", 5) == {" a "}
+
+
+class TestClassMinHasher:
+    def test_identical(self) -> None:
+        hasher = MinHasher(64)
+        assert hasher.signature("report 2020") == hasher.signature("report 2020")
+
+    def test_minimum(self) -> None:
+        hasher = MinHasher(32)
+        values = [hasher.unpack(hasher._values(s)) for s in shingles("report")]
+        assert hasher.unpack(hasher.signature("report")) == [
+            min(column) for column in zip(*values)
+        ]
+
+    def test_estimates_jaccard(self) -> None:
+        hasher = MinHasher(256)
+        a = hasher.unpack(hasher.signature("annual report 2020 final"))
+        b = hasher.unpack(hasher.signature("annual report 2021 final"))
+        c = hasher.unpack(hasher.signature("holiday photos"))
+        assert sum(x == y for x, y in zip(a, b)) > 128
+        assert sum(x == y for x, y in zip(a, c)) < 32
+
+    def test_seed(self) -> None:
+        assert MinHasher(16, seed=1).signature("x") != MinHasher(16).signature("x")
+
+
+class TestClassDisjointSet:
+    def test_groups(self) -> None:
+        clusters = DisjointSet(6)
+        clusters.union(4, 1)
+        clusters.union(1, 3)
+        clusters.union(5, 2)
+        assert clusters.groups() == [[1, 3, 4], [2, 5]]
+
+
+class TestFunctionCandidatePairs:
+    def test_bands(self) -> None:
+        hasher = MinHasher(8)
+        signatures = [hasher.signature(name) for name in ["abcd", "xyz", "abcd"]]
+        assert set(candidate_pairs(signatures, 4, 2)) == {(0, 2)}
+
+
+class TestFunctionFindClusters:
+    def test_clusters(self) -> None:
+        names = sorted(
+            [
+                "annual report 2020 final pdf",
+                "annual report 2020 finel pdf",
+                "annual report 2020 final1 pdf",
+                "holiday photos mallorca jpg",
+                "holiday photos malorca jpg",
+                "shopping list txt",
+            ]
+        )
+        clusters = [[names[i] for i in cluster] for cluster in find_clusters(names)]
+        assert clusters == [
+            [
+                "annual report 2020 final pdf",
+                "annual report 2020 final1 pdf",
+                "annual report 2020 finel pdf",
+            ],
+            ["holiday photos mallorca jpg", "holiday photos malorca jpg"],
+        ]
+
+    def test_threshold(self) -> None:
+        names = ["holiday photos mallorca jpg", "holiday photos malorca jpg"]
+        assert similarity(*names) == 98
+        assert find_clusters(names, threshold=99) == []
+
+    def test_same_as_brute_force(self) -> None:
+        names: List[str] = sorted(
+            {
+                "{} {} {}".format(word, suffix, number)
+                for word in ("invoice", "invoise", "contract", "contrakt", "letter")
+                for suffix in ("draft", "final")
+                for number in (1, 2, 10)
+            }
+        )
+        expected = DisjointSet(len(names))
+        for a, b in itertools.combinations(range(len(names)), 2):
+            if similarity(names[b], names[a]) >= 90:
+                expected.union(a, b)
+        assert find_clusters(names) == expected.groups()
+
+    def test_jobs(self) -> None:
+        names = sorted(
+            {
+                "{} {} {}".format(word, suffix, number)
+                for word in ("invoice", "invoise", "contract", "contrakt", "letter")
+                for suffix in ("draft", "final")
+                for number in range(30)
+            }
+        )
+        with mock.patch.multiple(
+            "jfscripts.find_dupes_by_fuzzy", PAIR_BATCH=7, SIGNATURE_BATCH=11
+        ):
+            assert find_clusters(names, jobs=3) == find_clusters(names)
+
+
+class TestFunctionScorePairs:
+    def test_threshold(self) -> None:
+        names = ["holiday jpg", "holidays jpg", "list txt", "lists txt"]
+        pairs = [(0, 1), (0, 2), (2, 3)]
+        assert list(score_pairs(names, pairs, 95)) == [(0, 1)]
+        assert list(score_pairs(names, pairs, 90)) == [(0, 1), (2, 3)]
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        previous = current
+    return previous[-1]
+
+
+class TestFunctionLevenshtein:
+    def test_examples(self) -> None:
+        assert levenshtein("kitten", "sitting") == 3
+        assert levenshtein("", "abc") == 3
+        assert levenshtein("abc", "") == 3
+        assert levenshtein("same", "same") == 0
+
+    def test_same_as_matrix(self) -> None:
+        rng = random.Random(0)
+        for _ in range(500):
+            a = "".join(rng.choice("abc ") for _ in range(rng.randint(0, 70)))
+            b = "".join(rng.choice("abc ") for _ in range(rng.randint(0, 70)))
+            assert levenshtein(a, b) == edit_distance(a, b)
+
+
+def build_tree(names: List[str]) -> BKTree:
+    tree = BKTree()
+    for name in names:
+        tree.add(name, ["/data/" + name])
+    return tree
+
+
+class TestClassBKTree:
+    names = [
+        "annual report pdf",
+        "anual report pdf",
+        "annual reports pdf",
+        "annual report 2020 pdf",
+        "holiday jpg",
+        "holidays jpg",
+        "list txt",
+    ]
+
+    def test_search(self) -> None:
+        tree = build_tree(self.names)
+        matches = tree.search("annual report pdf", 1)
+        assert [(d, tree.names[node]) for d, node in matches] == [
+            (0, "annual report pdf"),
+            (1, "annual reports pdf"),
+            (1, "anual report pdf"),
+        ]
+
+    def test_same_as_brute_force(self) -> None:
+        rng = random.Random(1)
+        names = ["".join(rng.choice("ab") for _ in range(8)) for _ in range(300)]
+        tree = build_tree(names)
+        for query in names[:20]:
+            distances = {(edit_distance(query, name), name) for name in names}
+            expected = sorted(match for match in distances if match[0] <= 2)
+            found = [(d, tree.names[node]) for d, node in tree.search(query, 2)]
+            assert found == expected
+
+    def test_duplicate_name(self) -> None:
+        tree = BKTree()
+        tree.add("a", ["/x/a"])
+        tree.add("a", ["/y/a"])
+        assert len(tree) == 1
+        assert tree.paths[0] == ["/x/a", "/y/a"]
+
+    def test_empty(self) -> None:
+        assert BKTree().search("a", 2) == []
+
+    def test_index_round_trip(self) -> None:
+        tree = build_tree(self.names)
+        f = io.StringIO()
+        write_index(tree, "/data", f)
+        f.seek(0)
+        root, loaded = read_index(f)
+        assert root == "/data"
+        assert loaded.names == tree.names
+        assert loaded.paths == tree.paths
+        assert loaded.children == tree.children
+
+    def test_not_an_index(self) -> None:
+        with pytest.raises(ValueError, match="Not an index"):
+            read_index(io.StringIO("something else\n"))
+
+    def test_query_index(self, tmp_path: Path) -> None:
+        index = tmp_path / "index"
+        with open(index, "w") as f:
+            write_index(build_tree(self.names), "/data", f)
+        with Capturing() as output:
+            query_index(str(index), ["Holiday.JPG\n", "---\n"], 1)
+        assert output == [
+            "Holiday.JPG\t0\t/data/holiday jpg",
+            "Holiday.JPG\t1\t/data/holidays jpg",
+        ]
+
+
+def write_text(path: Path, text: str) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def bits(value: int) -> int:
+    return bin(value).count("1")
+
+
+class TestFunctionSimhash:
+    words = " ".join("word{}".format(i % 700) for i in range(2000))
+
+    def test_weights(self) -> None:
+        assert simhash({"a": 1}) == simhash({"a": 5})
+        assert simhash({"a": 1, "b": 1}) != simhash({"a": 1, "b": 0})
+
+    def test_whitespace_and_case(self, tmp_path: Path) -> None:
+        a = write_text(tmp_path / "a.txt", self.words)
+        b = write_text(tmp_path / "b.txt", self.words.upper().replace(" ", "\n\t "))
+        assert simhash_file(a) == simhash_file(b)
+
+    def test_small_edit(self, tmp_path: Path) -> None:
+        a = write_text(tmp_path / "a.txt", self.words)
+        b = write_text(tmp_path / "b.txt", self.words.replace("word5 ", "edit ", 1))
+        c = write_text(tmp_path / "c.txt", "completely different text " * 50)
+        fingerprint = simhash_file(a)
+        assert fingerprint is not None
+        assert bits(fingerprint ^ (simhash_file(b) or 0)) <= 3
+        assert bits(fingerprint ^ (simhash_file(c) or 0)) > 3
+
+    def test_chunks(self, tmp_path: Path) -> None:
+        a = write_text(tmp_path / "a.txt", "Grüße " + self.words)
+        assert simhash_file(a, 5) == simhash_file(a)
+
+    def test_long_word(self, tmp_path: Path) -> None:
+        a = write_text(tmp_path / "a.txt", "x" * 1000 + " end")
+        b = write_text(tmp_path / "b.txt", "x" * 64 + " end")
+        assert simhash_file(a, 7) == simhash_file(a) == simhash_file(b)
+
+    def test_binary_and_empty(self, tmp_path: Path) -> None:
+        binary = tmp_path / "a.bin"
+        binary.write_bytes(b"text\0text")
+        assert simhash_file(str(binary)) is None
+        assert simhash_file(write_text(tmp_path / "b.txt", " \n ")) is None
+
+
+class TestFunctionHammingPairs:
+    def test_same_as_brute_force(self) -> None:
+        rng = random.Random(2)
+        fingerprints = []
+        for _ in range(200):
+            fingerprint = rng.getrandbits(64)
+            fingerprints.append(fingerprint)
+            for _ in range(rng.randint(0, 2)):
+                for _ in range(rng.randint(0, 5)):
+                    fingerprint ^= 1 << rng.randrange(64)
+                fingerprints.append(fingerprint)
+        for max_bits in (0, 3):
+            expected = {
+                (a, b)
+                for a, b in itertools.combinations(range(len(fingerprints)), 2)
+                if bits(fingerprints[a] ^ fingerprints[b]) <= max_bits
+            }
+            found = {
+                (min(pair), max(pair)) for pair in hamming_pairs(fingerprints, max_bits)
+            }
+            assert expected
+            assert found == expected
+
+
+class TestFunctionFindSimilarTexts:
+    def test_clusters(self, tmp_path: Path) -> None:
+        text = " ".join("word{}".format(i) for i in range(500))
+        a = write_text(tmp_path / "a.txt", text)
+        b = write_text(tmp_path / "sub" / "b.txt", text.replace(" ", "\n"))
+        write_text(tmp_path / "c.txt", "something else entirely")
+        (tmp_path / "d.bin").write_bytes(b"\0" + text.encode())
+        paths, clusters = find_similar_texts(str(tmp_path))
+        assert [sorted(paths[i] for i in cluster) for cluster in clusters] == [[a, b]]
+
+
+class TestFunctionCollectNames:
+    def test_collect(self, tmp_path: Path) -> None:
+        a = touch(tmp_path / "a" / "Report.pdf")
+        b = touch(tmp_path / "b" / "report.pdf")
+        touch(tmp_path / ".git" / "report.pdf")
+        touch(tmp_path / "a" / "x.tmp")
+        touch(tmp_path / "___")
+        names = collect_names(str(tmp_path), [".git", "*.tmp"])
+        assert {key: sorted(value) for key, value in names.items()} == {
+            "report pdf": [a, b]
+        }
+
+
+class TestFunctionCheckForFuzzyDuplicates:
+    def test_output(self, tmp_path: Path) -> None:
+        a = touch(tmp_path / "Annual Report 2020.pdf")
+        b = touch(tmp_path / "sub" / "annual_report_2020.pdf")
+        c = touch(tmp_path / "Annual Report 2021.pdf")
+        touch(tmp_path / "shopping list.txt")
+        with Capturing() as output:
+            check_for_fuzzy_duplicates(str(tmp_path))
+        assert output == [a, b, c]
+
+
+class TestIntegration:
+    def test_command_line_interface(self) -> None:
+        assert is_executable("find_dupes_by_fuzzy")
+
+    def test_option_version(self) -> None:
+        output = subprocess.check_output(["find-dupes-by-fuzzy.py", "--version"])
+        assert output
+        assert "find-dupes-by-fuzzy.py" in str(output)
+
+    def test_threshold_out_of_range(self, tmp_path: Path) -> None:
+        run = subprocess.run(
+            ["find-dupes-by-fuzzy.py", "-t", "101", str(tmp_path)],
+            encoding="utf-8",
+            stderr=subprocess.PIPE,
+        )
+        assert run.returncode == 2
+        assert "--threshold must be between 0 and 100" in run.stderr
+
+    def test_simhash(self, tmp_path: Path) -> None:
+        text = " ".join("word{}".format(i) for i in range(500))
+        a = write_text(tmp_path / "a.txt", text)
+        b = write_text(tmp_path / "b.txt", text + " appendix")
+        write_text(tmp_path / "c.txt", "something else entirely")
+        output = subprocess.check_output(
+            ["find-dupes-by-fuzzy.py", "--simhash", str(tmp_path)], encoding="utf-8"
+        )
+        assert output.splitlines() == [a, b]
+
+    def test_build_index_and_query(self, tmp_path: Path) -> None:
+        a = touch(tmp_path / "archive" / "Annual Report.pdf")
+        touch(tmp_path / "archive" / "list.txt")
+        index = str(tmp_path / "index")
+        subprocess.check_call(
+            [
+                "find-dupes-by-fuzzy.py",
+                "--build-index",
+                index,
+                str(tmp_path / "archive"),
+            ]
+        )
+        output = subprocess.check_output(
+            ["find-dupes-by-fuzzy.py", "--query", index, "-d", "1"],
+            input="annual_report.PDF\nanual report.pdf\nnothing\n",
+            encoding="utf-8",
+        )
+        assert output.splitlines() == [
+            "annual_report.PDF\t0\t" + a,
+            "anual report.pdf\t1\t" + a,
+        ]
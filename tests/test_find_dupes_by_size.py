@@ -1,6 +1,1167 @@
+import argparse
+import hashlib
+import inspect
+import io
+import json
+import os
+import shlex
+import shutil
 import subprocess
+import sys
+from pathlib import Path
+from typing import Optional
+from unittest import mock
 
+import pytest
+from stdout_stderr_capturing import Capturing
+
+from jfscripts import find_dupes_by_size
+from jfscripts.find_dupes_by_size import (
+    ActionEngine,
+    DirectoryTable,
+    DirectoryTree,
+    DuplicateGroup,
+    FileEntry,
+    FingerprintCache,
+    Hasher,
+    InotifyEvent,
+    ManifestRecord,
+    Progress,
+    RateLimiter,
+    SizeIndex,
+    SpillingSizeIndex,
+    Stage,
+    Stats,
+    WalkFilter,
+    Watcher,
+    check_for_duplicates,
+    choose_strategy,
+    compare_content,
+    export_manifest,
+    find_duplicates,
+    find_in_manifest,
+    full_digest,
+    new_hash,
+    parse_size,
+    partial_digest,
+    physical_offset,
+    prefetch_digests,
+    read_key,
+    read_manifest,
+    read_manifest_header,
+    verify_content,
+    walk,
+    watch_for_duplicates,
+)
 from tests._helper import is_executable
+from tests.benchmark_find_dupes_by_size import (
+    SCENARIOS,
+    compare,
+    generate_tree,
+    run_benchmark,
+)
+
+
+def write(path: Path, content: bytes) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return str(path)
+
+
+def entry(path: str) -> FileEntry:
+    return FileEntry.from_stat(path, os.stat(path))
+
+
+class TestFunctionWalk:
+    def make_tree(self, tmp_path: Path) -> None:
+        for d in ("a", "b", "a/c", "a/c/d"):
+            for f in ("1", "2"):
+                write(tmp_path / d / f, d.encode())
+        os.symlink(str(tmp_path / "a"), str(tmp_path / "link"))
+
+    def test_sequential(self, tmp_path: Path) -> None:
+        self.make_tree(tmp_path)
+        dirs = [os.path.dirname(e.path) for e in walk(str(tmp_path))]
+        # Depth first, subdirectories in sorted order, symlinks not followed.
+        assert dirs == [
+            str(tmp_path / d)
+            for d in ("a", "a", "a/c", "a/c", "a/c/d", "a/c/d", "b", "b")
+        ]
+
+    def test_jobs(self, tmp_path: Path) -> None:
+        self.make_tree(tmp_path)
+        expected = sorted(walk(str(tmp_path)))
+        assert sorted(walk(str(tmp_path), jobs=4)) == expected
+
+    def test_stat(self, tmp_path: Path) -> None:
+        path = write(tmp_path / "a", b"abc")
+        assert list(walk(str(tmp_path))) == [entry(path)]
+
+    def test_filter_size(self, tmp_path: Path) -> None:
+        write(tmp_path / "empty", b"")
+        small = write(tmp_path / "small", b"a")
+        write(tmp_path / "large", b"abc")
+        walk_filter = WalkFilter(str(tmp_path), min_size=1, max_size=2)
+        assert [e.path for e in walk(str(tmp_path), walk_filter=walk_filter)] == [small]
+
+    def test_filter_exclude(self, tmp_path: Path) -> None:
+        self.make_tree(tmp_path)
+        write(tmp_path / "a" / "x.tmp", b"")
+        walk_filter = WalkFilter(str(tmp_path), excludes=["c", "b/*", "*.tmp"])
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            paths = [e.path for e in walk(str(tmp_path), walk_filter=walk_filter)]
+        assert sorted(paths) == [str(tmp_path / "a" / "1"), str(tmp_path / "a" / "2")]
+        # The excluded directories are not listed at all.
+        assert [c.args[0] for c in scandir.call_args_list] == [
+            str(tmp_path),
+            str(tmp_path / "a"),
+            str(tmp_path / "b"),
+        ]
+
+    def test_filter_one_file_system(self, tmp_path: Path) -> None:
+        self.make_tree(tmp_path)
+        walk_filter = WalkFilter(str(tmp_path), one_file_system=True)
+        assert len(list(walk(str(tmp_path), walk_filter=walk_filter))) == 8
+        # Pretend the subdirectories are on another file system.
+        walk_filter.dev = os.stat(str(tmp_path)).st_dev + 1
+        assert list(walk(str(tmp_path), walk_filter=walk_filter)) == []
+
+    def test_nonexistent(self, tmp_path: Path) -> None:
+        assert list(walk(str(tmp_path / "nonexistent"), jobs=2)) == []
+
+
+class TestFunctionParseSize:
+    def test_bytes(self) -> None:
+        assert parse_size("123") == 123
+
+    def test_suffixes(self) -> None:
+        assert parse_size("1K") == 1024
+        assert parse_size("512M") == 512 * 1024**2
+        assert parse_size("2GiB") == 2 * 1024**3
+        assert parse_size("1.5t") == int(1.5 * 1024**4)
+
+    def test_invalid(self) -> None:
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_size("lol")
+
+
+class TestClassSizeIndex:
+    def test_round_trip(self) -> None:
+        index = SizeIndex()
+        entries = [
+            FileEntry("/dir/a", 3, 1, 2, 3, 1),
+            FileEntry("relative", 1, 1, 3, -4, 2),
+            FileEntry("/root", 3, 1, 4, 5, 1),
+            FileEntry('/dir/new\nline "quote" \udcff', 1, 2, 2**63, 6, 1),
+        ]
+        for entry in entries:
+            index.add(entry)
+        assert len(index) == 4
+        assert list(index.groups()) == [
+            (1, [entries[1], entries[3]]),
+            (3, [entries[0], entries[2]]),
+        ]
+        assert index.dirs.prefixes == ["/dir/", "", "/"]
+        index.close()
+        assert list(index.groups()) == []
+
+    def test_directory_table(self) -> None:
+        table = DirectoryTable()
+        assert table.split("/a/b/c") == (0, "c")
+        assert table.split("/a/b/d") == (0, "d")
+        assert table.split("/a/e") == (1, "e")
+        assert table.join(0, "c") == "/a/b/c"
+
+
+class TestClassSpillingSizeIndex:
+    def entries(self):
+        for i in range(100):
+            yield FileEntry("/dir/file-{:03}".format(i), i % 7, 1, i, 0, 1)
+
+    def groups(self, index: SizeIndex):
+        for entry in self.entries():
+            index.add(entry)
+        groups = [(size, sorted(group)) for size, group in index.groups()]
+        index.close()
+        return groups
+
+    def test_same_groups_as_in_memory(self) -> None:
+        expected = self.groups(SizeIndex())
+        index = SpillingSizeIndex(max_memory=2000)
+        assert self.groups(index) == expected
+        assert len(index.runs) > 1
+
+    def test_multi_pass_merge(self) -> None:
+        expected = self.groups(SizeIndex())
+        index = SpillingSizeIndex(max_memory=1000)
+        index.MERGE_FAN_IN = 3
+        assert self.groups(index) == expected
+
+    def test_no_spill(self) -> None:
+        index = SpillingSizeIndex(max_memory=1024**3)
+        assert self.groups(index) == self.groups(SizeIndex())
+        assert index.runs == []
+
+    def test_len(self) -> None:
+        index = SpillingSizeIndex(max_memory=2000)
+        assert len(index) == 0
+        for entry in self.entries():
+            index.add(entry)
+        assert len(index.runs) > 1
+        assert len(index) == len(list(self.entries()))
+        index.clear()
+        assert len(index) == 0
+        assert list(index.groups()) == []
+        index.close()
+
+    def test_unusual_paths(self) -> None:
+        index = SpillingSizeIndex(max_memory=1)
+        entry = FileEntry('/dir/new\nline "quote" \udcff', 1, 2, 3, 4, 5)
+        index.add(entry)
+        assert list(index.groups()) == [(1, [entry])]
+        index.close()
+
+
+class TestFunctionVerifyContent:
+    def test_small_files(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        c = write(tmp_path / "c", b"xyz")
+        stats = Stats()
+        groups = verify_content(3, [entry(a), entry(b), entry(c)], stats)
+        assert [sorted(e.path for e in group) for _, group in groups] == [[a, b]]
+        # The sample covers the whole file: no full digest necessary.
+        assert stats.partial.files == 3
+        assert stats.full.files == 0
+
+    def test_partial_digest_differs(self, tmp_path: Path) -> None:
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        a = write(tmp_path / "a", b"a" * size)
+        b = write(tmp_path / "b", b"b" * size)
+        stats = Stats()
+        assert verify_content(size, [entry(a), entry(b)], stats) == []
+        assert stats.full.files == 0
+        sample = 2 * find_dupes_by_size.SAMPLE_SIZE
+        assert stats.partial.bytes_read == 2 * sample
+        assert stats.partial.bytes_avoided == 2 * (size - sample)
+
+    def test_full_digest_differs(self, tmp_path: Path) -> None:
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        middle = 2 * find_dupes_by_size.SAMPLE_SIZE
+        content = b"a" * size
+        a = write(tmp_path / "a", content)
+        b = write(tmp_path / "b", content)
+        c = write(tmp_path / "c", content[:middle] + b"b" + content[middle + 1 :])
+        stats = Stats()
+        groups = verify_content(size, [entry(a), entry(b), entry(c)], stats)
+        assert [sorted(e.path for e in group) for _, group in groups] == [[a, b]]
+        assert stats.full.files == 3
+        assert stats.full.bytes_read == 3 * size
+
+    def test_strategy_auto(self, tmp_path: Path) -> None:
+        size = find_dupes_by_size.COMPARE_MIN_SIZE
+        a = write(tmp_path / "a", b"a" * size)
+        b = write(tmp_path / "b", b"a" * size)
+        stats = Stats()
+        groups = verify_content(size, [entry(a), entry(b)], stats)
+        assert groups == [(None, [entry(a), entry(b)])]
+        assert stats.compare.files == 2
+        assert stats.full.files == 0
+
+    def test_strategy_hash(self, tmp_path: Path) -> None:
+        size = find_dupes_by_size.COMPARE_MIN_SIZE
+        a = write(tmp_path / "a", b"a" * size)
+        b = write(tmp_path / "b", b"a" * size)
+        stats = Stats()
+        groups = verify_content(size, [entry(a), entry(b)], stats, strategy="hash")
+        assert groups[0][0] is not None
+        assert stats.compare.files == 0
+        assert stats.full.files == 2
+
+    def test_vanished_file(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        entries = [entry(a), entry(b)]
+        os.remove(b)
+        assert verify_content(3, entries, Stats()) == []
+
+
+class TestFunctionCompareContent:
+    def test_early_exit(self, tmp_path: Path) -> None:
+        size = 3 * find_dupes_by_size.CHUNK_SIZE
+        a = write(tmp_path / "a", b"a" * size)
+        b = write(tmp_path / "b", b"b" + b"a" * (size - 1))
+        stage = Stage("Compare")
+        groups = compare_content([entry(a), entry(b)], stage)
+        assert [[e.path for e in group] for group in groups] == [[a], [b]]
+        assert stage.bytes_read == 2 * find_dupes_by_size.CHUNK_SIZE
+        assert stage.bytes_avoided == 2 * (size - find_dupes_by_size.CHUNK_SIZE)
+
+    def test_three_files(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"xyz")
+        c = write(tmp_path / "c", b"abc")
+        groups = compare_content([entry(a), entry(b), entry(c)], Stage("Compare"))
+        assert [[e.path for e in group] for group in groups] == [[a, c], [b]]
+
+    def test_unaligned_tail(self, tmp_path: Path) -> None:
+        size = find_dupes_by_size.CHUNK_SIZE + 13
+        a = write(tmp_path / "a", b"a" * size)
+        b = write(tmp_path / "b", b"a" * (size - 1) + b"b")
+        c = write(tmp_path / "c", b"a" * size)
+        stage = Stage("Compare")
+        groups = compare_content([entry(a), entry(b), entry(c)], stage)
+        assert [[e.path for e in group] for group in groups] == [[a, c], [b]]
+
+
+class TestFunctionChooseStrategy:
+    def test_small_group_large_files(self) -> None:
+        assert choose_strategy(2, 1024**2) == "compare"
+
+    def test_small_files(self) -> None:
+        assert choose_strategy(2, 1024) == "hash"
+
+    def test_large_group(self) -> None:
+        assert choose_strategy(4, 1024**2) == "hash"
+
+    def test_cache(self) -> None:
+        assert choose_strategy(2, 1024**2, cache=True) == "hash"
+
+
+class TestClassHasher:
+    def test_small_buffer(self, tmp_path: Path) -> None:
+        content = os.urandom(5 * find_dupes_by_size.SAMPLE_SIZE + 7)
+        path = write(tmp_path / "a", content)
+        hasher = Hasher("sha256", buffer_size=1)
+        assert len(hasher.buffer) == find_dupes_by_size.SAMPLE_SIZE
+        assert hasher.full(path) == hashlib.sha256(content).hexdigest()
+        sample = content[: find_dupes_by_size.SAMPLE_SIZE]
+        sample += content[-find_dupes_by_size.SAMPLE_SIZE :]
+        assert hasher.partial(path, len(content)) == hashlib.sha256(sample).hexdigest()
+
+    def test_small_file(self, tmp_path: Path) -> None:
+        path = write(tmp_path / "a", b"abc")
+        assert partial_digest(path, 3) == full_digest(path)
+        assert full_digest(path) == hashlib.blake2b(b"abc", digest_size=16).hexdigest()
+
+    def test_algorithms(self, tmp_path: Path) -> None:
+        path = write(tmp_path / "a", b"abc")
+        assert len(full_digest(path, "sha256")) == 64
+        assert full_digest(path, "sha256") != full_digest(path, "blake2b")
+
+    def test_unknown_algorithm(self) -> None:
+        with pytest.raises(ValueError, match="Unknown hash algorithm: md5"):
+            new_hash("md5")
+
+    def test_xxh3_not_installed(self) -> None:
+        with mock.patch.object(find_dupes_by_size, "xxhash", None):
+            with pytest.raises(ValueError, match="needs the package xxhash"):
+                Hasher("xxh3")
+
+    @pytest.mark.skipif(find_dupes_by_size.xxhash is None, reason="no xxhash")
+    def test_xxh3(self, tmp_path: Path) -> None:
+        path = write(tmp_path / "a", b"abc")
+        assert (
+            full_digest(path, "xxh3")
+            == find_dupes_by_size.xxhash.xxh3_128(b"abc").hexdigest()
+        )
+
+
+class TestClassRateLimiter:
+    @mock.patch("time.sleep")
+    @mock.patch("time.monotonic")
+    def test_consume(self, monotonic: mock.Mock, sleep: mock.Mock) -> None:
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(1000)
+        limiter.consume(500)
+        sleep.assert_called_once_with(0.5)
+        sleep.reset_mock()
+        monotonic.return_value = 101.0
+        limiter.consume(500)
+        sleep.assert_not_called()
+
+    @mock.patch("time.sleep")
+    @mock.patch("time.monotonic")
+    def test_burst(self, monotonic: mock.Mock, sleep: mock.Mock) -> None:
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(1000)
+        monotonic.return_value = 200.0
+        limiter.consume(1)
+        sleep.assert_not_called()
+        # Only one second of credit is left after the idle period.
+        limiter.consume(3000)
+        assert sleep.call_args[0][0] == pytest.approx(2.0)
+
+
+class TestFunctionReadKey:
+    def test_default(self) -> None:
+        defaults = {
+            inspect.signature(function).parameters["read_order"].default
+            for function in (prefetch_digests, find_duplicates, check_for_duplicates)
+        }
+        defaults.add(find_dupes_by_size.get_parser().get_default("read_order"))
+        assert defaults == {"inode"}
+
+    def test_orders(self, tmp_path: Path) -> None:
+        a = entry(write(tmp_path / "a", b"abc"))
+        assert read_key(a, "path") == (a.path,)
+        assert read_key(a, "inode") == (a.dev, a.ino)
+        assert read_key(a, "extent")[::2] == (a.dev, a.ino)
+
+    def test_physical_offset(self, tmp_path: Path) -> None:
+        path = write(tmp_path / "a", b"a" * 8192)
+        offset = physical_offset(path)
+        assert offset is None or offset >= 0
+        assert physical_offset(str(tmp_path / "missing")) is None
+
+    def test_prefetch_digests(self, tmp_path: Path) -> None:
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        a = entry(write(tmp_path / "a", b"a" * size))
+        b = entry(write(tmp_path / "b", b"a" * size))
+        c = entry(write(tmp_path / "c", b"c"))
+        d = entry(write(tmp_path / "d", b"d"))
+        stats = Stats()
+        digests = prefetch_digests(
+            [(1, [c, d]), (size, [a, b])], stats, None, Hasher(), "hash"
+        )
+        assert digests[(a.path, "full")] == full_digest(a.path)
+        assert digests[(c.path, "partial")] == full_digest(c.path)
+        assert (c.path, "full") not in digests
+        assert stats.partial.files == 4
+        assert stats.full.files == 2
+
+    @pytest.mark.parametrize("read_order", ["inode", "extent"])
+    def test_find_duplicates(self, tmp_path: Path, read_order: str) -> None:
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        for name, content in (("a", b"a"), ("b", b"a"), ("c", b"c"), ("d", b"c")):
+            write(tmp_path / "x" / name, content * size)
+            write(tmp_path / "y" / name, content * 3)
+        path_stats = Stats()
+        by_path = list(
+            find_duplicates(str(tmp_path), path_stats, verify=True, strategy="hash")
+        )
+        stats = Stats()
+        scheduled = list(
+            find_duplicates(
+                str(tmp_path),
+                stats,
+                verify=True,
+                strategy="hash",
+                read_order=read_order,
+            )
+        )
+        assert scheduled == by_path
+        assert len(scheduled) == 4
+        assert [str(stage) for stage in stats.stages] == [
+            str(stage) for stage in path_stats.stages
+        ]
+
+
+class TestClassFingerprintCache:
+    def test_get_set(self, tmp_path: Path) -> None:
+        a = entry(write(tmp_path / "a", b"abc"))
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        assert cache.get(a, "partial") is None
+        cache.set(a, "partial", "1234")
+        assert cache.get(a, "partial") == "1234"
+        assert cache.get(a, "full") is None
+        cache.set(a, "full", "5678")
+        assert cache.get(a, "partial") == "1234"
+        assert cache.get(a._replace(mtime_ns=a.mtime_ns + 1), "partial") is None
+        assert cache.hits == 2
+        assert cache.misses == 3
+
+    def test_persistence(self, tmp_path: Path) -> None:
+        a = entry(write(tmp_path / "a", b"abc"))
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        cache.set(a, "full", "5678")
+        cache.close()
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        assert cache.get(a, "full") == "5678"
+
+    def test_algorithms(self, tmp_path: Path) -> None:
+        a = entry(write(tmp_path / "a", b"abc"))
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        cache.set(a, "full", "5678")
+        cache.close()
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"), "sha256")
+        assert cache.get(a, "full") is None
+        cache.set(a, "full", "abcd")
+        assert cache.get(a, "full") == "abcd"
+        cache.close()
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        assert cache.get(a, "full") == "5678"
+
+    def test_evict(self, tmp_path: Path) -> None:
+        a = entry(write(tmp_path / "tree" / "a", b"abc"))
+        b = entry(write(tmp_path / "tree" / "b", b"abc"))
+        c = entry(write(tmp_path / "tree" / "c", b"abc"))
+        outside = entry(write(tmp_path / "outside", b"abc"))
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        for e in (a, b, c, outside):
+            cache.set(e, "partial", "1234")
+        os.remove(a.path)
+        os.remove(outside.path)
+        with open(b.path, "ab") as f:
+            f.write(b"d")
+        assert cache.evict(str(tmp_path / "tree")) == 2
+        assert cache.get(c, "partial") == "1234"
+        assert cache.get(outside, "partial") == "1234"
+
+    def test_evict_chunks(self, tmp_path: Path) -> None:
+        entries = [entry(write(tmp_path / "tree" / str(i), b"abc")) for i in range(5)]
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        for e in entries:
+            cache.set(e, "partial", "1234")
+        for e in entries[:2]:
+            os.remove(e.path)
+        # Found during this run, so it is not checked again.
+        assert cache.get(entries[4], "partial") == "1234"
+        with mock.patch.object(FingerprintCache, "EVICT_CHUNK", 2), mock.patch(
+            "os.lstat", side_effect=os.lstat
+        ) as lstat:
+            assert cache.evict(str(tmp_path / "tree")) == 2
+        assert lstat.call_count == 4
+        assert [cache.get(e, "partial") for e in entries] == [
+            None,
+            None,
+            "1234",
+            "1234",
+            "1234",
+        ]
+
+    def test_commit_interval(self, tmp_path: Path) -> None:
+        entries = [entry(write(tmp_path / str(i), b"abc")) for i in range(3)]
+        cache = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        with mock.patch.object(FingerprintCache, "COMMIT_INTERVAL", 2):
+            for e in entries:
+                cache.set(e, "full", "5678")
+        # An interrupted scan keeps the committed digests.
+        other = FingerprintCache(str(tmp_path / "cache.sqlite"))
+        assert [other.get(e, "full") for e in entries] == ["5678", "5678", None]
+        other.close()
+        cache.close()
+
+    def test_shared(self, tmp_path: Path) -> None:
+        a = entry(write(tmp_path / "a", b"abc"))
+        b = entry(write(tmp_path / "b", b"abc"))
+        with mock.patch.object(FingerprintCache, "COMMIT_SECONDS", 0.0):
+            first = FingerprintCache(str(tmp_path / "cache.sqlite"))
+            second = FingerprintCache(str(tmp_path / "cache.sqlite"))
+            first.set(a, "full", "1234")
+            second.set(b, "full", "5678")
+            assert second.get(a, "full") == "1234"
+            assert first.get(b, "full") == "5678"
+        second.close()
+        first.close()
+
+
+class TestClassDirectoryTree:
+    def make_tree(self, tmp_path: Path) -> str:
+        for copy in ("photos", "backup/photos", "backup/old/photos"):
+            write(tmp_path / copy / "a.jpg", b"aaa")
+            write(tmp_path / copy / "sub" / "b.jpg", b"bbbb")
+        # Same names and sizes, but different content.
+        write(tmp_path / "other" / "photos" / "a.jpg", b"aaa")
+        write(tmp_path / "other" / "photos" / "sub" / "b.jpg", b"bbbX")
+        write(tmp_path / "loose.jpg", b"aaa")
+        return str(tmp_path)
+
+    def test_duplicates(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        stats = Stats()
+        tree = DirectoryTree(root, list(walk(root)), stats)
+        assert tree.duplicates() == [
+            [
+                os.path.join(root, "backup/old/photos"),
+                os.path.join(root, "backup/photos"),
+                os.path.join(root, "photos"),
+            ]
+        ]
+        # Only the four trees with the same signature are hashed.
+        assert stats.partial.files == 8
+
+    def test_nested_groups_are_omitted(self, tmp_path: Path) -> None:
+        for copy in ("a", "b"):
+            write(tmp_path / copy / "x" / "1", b"1")
+            write(tmp_path / copy / "x" / "y" / "2", b"22")
+        root = str(tmp_path)
+        tree = DirectoryTree(root, list(walk(root)), Stats())
+        assert tree.duplicates() == [[os.path.join(root, "a"), os.path.join(root, "b")]]
+
+    def test_nested_in_redundant_tree(self, tmp_path: Path) -> None:
+        write(tmp_path / "A" / "g", b"gg")
+        write(tmp_path / "A" / "x" / "f", b"f" * 30000)
+        write(tmp_path / "B" / "g", b"gg")
+        write(tmp_path / "B" / "x" / "f", b"f" * 30000)
+        write(tmp_path / "C" / "f", b"f" * 30000)
+        root = str(tmp_path)
+        tree = DirectoryTree(root, list(walk(root)), Stats())
+        assert tree.duplicates() == [
+            [os.path.join(root, "A"), os.path.join(root, "B")],
+            [os.path.join(root, "A", "x"), os.path.join(root, "C")],
+        ]
+
+    def test_find_duplicates(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        groups = list(find_duplicates(root + "/", Stats(), verify=True, dirs=True))
+        assert [(g.kind, [e.path for e in g.entries]) for g in groups] == [
+            (
+                "directories",
+                [
+                    os.path.join(root, "backup/old/photos"),
+                    os.path.join(root, "backup/photos"),
+                    os.path.join(root, "photos"),
+                ],
+            ),
+            (
+                "duplicates",
+                [
+                    os.path.join(root, "backup/old/photos/a.jpg"),
+                    os.path.join(root, "loose.jpg"),
+                    os.path.join(root, "other/photos/a.jpg"),
+                ],
+            ),
+        ]
+        assert groups[0].size == 7
+        assert groups[0].reclaimable == 14
+
+
+class TestClassStats:
+    def test_to_dict(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "b", b"abc")
+        stats = Stats()
+        list(find_duplicates(str(tmp_path), stats=stats, verify=True))
+        report = stats.to_dict()
+        assert report["walk"]["dirs"] == 1
+        assert report["walk"]["files"] == 2
+        assert report["stages"]["partial"]["files"] == 2
+        assert report["stages"]["partial"]["bytes_read"] == 6
+        assert report["cache"] == {"hits": 0, "misses": 0, "hit_rate": 0.0}
+        assert set(report["phases"]) == {"walk", "verify"}
+
+    def test_progress(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "b", b"abc")
+        stream = io.StringIO()
+        progress = Progress(stream, interval=0)
+        list(find_duplicates(str(tmp_path), stats=Stats(progress), verify=True))
+        progress.finish()
+        lines = stream.getvalue().split("\r")
+        assert "Walk: 1 dirs" in [line[:12] for line in lines]
+        assert lines[-1].startswith("Verify: 1 groups, Partial digest: 0.0 MB")
+        assert lines[-1].endswith("\n")
+
+
+class TestClassActionEngine:
+    def group(self, *paths: str) -> DuplicateGroup:
+        entries = [entry(path) for path in paths]
+        return DuplicateGroup("duplicates", entries[0].size, None, entries)
+
+    def test_hardlink(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "dir" / "b", b"abc")
+        engine = ActionEngine("hardlink")
+        engine.apply(self.group(a, b))
+        engine.sync()
+        assert os.stat(a).st_ino == os.stat(b).st_ino
+        assert engine.reclaimed == 3
+        assert os.listdir(str(tmp_path / "dir")) == ["b"]
+
+    def test_delete(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        engine = ActionEngine("delete")
+        engine.apply(self.group(a, b))
+        assert os.path.exists(a)
+        assert not os.path.exists(b)
+
+    def test_dry_run(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        engine = ActionEngine("delete", dry_run=True)
+        engine.apply(self.group(a, b))
+        assert os.path.exists(b)
+        assert engine.reclaimed == 3
+        assert str(engine) == "Dry run Delete: 1 files, 3 bytes reclaimed, 0 skipped"
+
+    def test_content_differs(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abd")
+        engine = ActionEngine("delete")
+        with Capturing(stream="stderr"):
+            engine.apply(self.group(a, b))
+        assert os.path.exists(b)
+        assert engine.failed == 1
+
+    def test_reflink_unsupported(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        engine = ActionEngine("reflink")
+        with Capturing(stream="stderr"):
+            engine.apply(self.group(a, b))
+        assert open(b, "rb").read() == b"abc"
+        assert sorted(os.listdir(str(tmp_path))) == ["a", "b"]
+        if engine.failed == 0:
+            assert engine.reclaimed == 3
+
+    def test_reflink_already_shared(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        engine = ActionEngine("reflink")
+        extent = (4096, find_dupes_by_size.FIEMAP_EXTENT_SHARED)
+        with mock.patch.object(
+            find_dupes_by_size, "_first_extent", return_value=extent
+        ):
+            assert engine.apply(self.group(a, b)) == []
+        assert (engine.replaced, engine.failed) == (0, 0)
+
+    def test_reflink_batched_sync(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        duplicates = [write(tmp_path / name, b"abc") for name in ("b", "c", "d")]
+        engine = ActionEngine("reflink")
+        with mock.patch("fcntl.ioctl"), mock.patch("os.fsync") as fsync:
+            engine.apply(self.group(a, *duplicates))
+            fsync.assert_not_called()
+            engine.sync()
+        # One flush for the directory instead of one per file.
+        assert fsync.call_count == 1
+        assert engine.replaced == 3
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify")
+class TestClassWatcher:
+    def paths(self, groups: list) -> list:
+        return [[os.path.basename(e.path) for e in g.entries] for g in groups]
+
+    def test_scan(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "sub" / "b", b"abc")
+        write(tmp_path / "c", b"c")
+        watcher = Watcher(str(tmp_path), Stats())
+        assert self.paths(watcher.scan()) == [["a", "b"]]
+        assert sorted(watcher.watches.values()) == [
+            str(tmp_path),
+            str(tmp_path / "sub"),
+        ]
+        watcher.close()
+
+    def test_missing_root(self, tmp_path: Path) -> None:
+        missing = str(tmp_path / "missing")
+        argv = ["find-dupes-by-size.py", "--watch", missing]
+        with mock.patch("sys.argv", argv):
+            with Capturing(stream="stderr") as stderr:
+                with pytest.raises(SystemExit) as e:
+                    find_dupes_by_size.main()
+        assert e.value.code == 1
+        assert "No such file or directory: '{}'".format(missing) in stderr.tostring()
+        assert "Not watching" not in stderr.tostring()
+
+    def test_new_file(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        watcher = Watcher(str(tmp_path), Stats(), verify=True)
+        assert watcher.scan() == []
+        write(tmp_path / "b", b"xyz")
+        assert watcher.poll(1) == []
+        write(tmp_path / "c", b"abc")
+        groups = watcher.poll(1)
+        assert self.paths(groups) == [["a", "c"]]
+        assert groups[0].digest == full_digest(str(tmp_path / "a"))
+        watcher.close()
+
+    def test_new_directory(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        watcher = Watcher(str(tmp_path), Stats())
+        watcher.scan()
+        os.mkdir(tmp_path / "new")
+        write(tmp_path / "new" / "b", b"abc")
+        assert self.paths(watcher.poll(1)) == [["a", "b"]]
+        write(tmp_path / "new" / "c", b"abc")
+        assert self.paths(watcher.poll(1)) == [["a", "b", "c"]]
+        watcher.close()
+
+    def test_delete_and_move(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "sub" / "b", b"abc")
+        watcher = Watcher(str(tmp_path), Stats())
+        watcher.scan()
+        os.rename(tmp_path / "sub", tmp_path.parent / (tmp_path.name + "-moved"))
+        os.remove(tmp_path / "a")
+        assert watcher.poll(1) == []
+        assert watcher.files == {}
+        assert list(watcher.watches.values()) == [str(tmp_path)]
+        watcher.close()
+
+    def test_hardlink(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        watcher = Watcher(str(tmp_path), Stats())
+        watcher.scan()
+        os.link(tmp_path / "a", tmp_path / "b")
+        assert watcher.poll(1) == []
+        assert len(watcher.files) == 2
+        watcher.close()
+
+    def test_filter(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        watcher = Watcher(
+            str(tmp_path),
+            Stats(),
+            walk_filter=WalkFilter(str(tmp_path), excludes=["*.tmp"]),
+        )
+        watcher.scan()
+        write(tmp_path / "b.tmp", b"abc")
+        assert watcher.poll(1) == []
+        watcher.close()
+
+    def test_overflow(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "b", b"xy")
+        watcher = Watcher(str(tmp_path), Stats())
+        watcher.scan()
+        write(tmp_path / "c", b"abc")
+        overflow = [InotifyEvent(-1, find_dupes_by_size.IN_Q_OVERFLOW, 0, "")]
+        with mock.patch.object(watcher.inotify, "read", return_value=overflow):
+            with Capturing(stream="stderr"):
+                groups = watcher.poll(1)
+        assert self.paths(groups) == [["a", "c"]]
+        watcher.close()
+
+    def test_action_reflink_settles(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "b", b"abc")
+        poll = Watcher.poll
+        polls = []
+
+        def limited_poll(watcher: Watcher, timeout: Optional[float] = None) -> list:
+            if len(polls) == 3:
+                raise KeyboardInterrupt
+            groups = poll(watcher, 0.5)
+            polls.append(groups)
+            return groups
+
+        def copy(src: str, dst: str) -> None:
+            with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+                shutil.copyfileobj(fsrc, fdst)
+
+        with mock.patch.object(Watcher, "poll", limited_poll), mock.patch.object(
+            find_dupes_by_size, "reflink", copy
+        ), Capturing() as output:
+            watch_for_duplicates(str(tmp_path), action="reflink")
+        assert polls == [[], [], []]
+        assert "Reflink: 1 files, 3 bytes reclaimed, 0 skipped" in output
+
+
+class TestManifest:
+    def make_backup(self, tmp_path: Path) -> str:
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        write(tmp_path / "backup" / "small", b"abc")
+        write(tmp_path / "backup" / "sub" / "large", b"a" * size)
+        write(tmp_path / "backup" / "sub" / "other", b"b" * size)
+        manifest = str(tmp_path / "manifest")
+        assert export_manifest(str(tmp_path / "backup"), manifest, Stats()) == 3
+        return manifest
+
+    def test_export(self, tmp_path: Path) -> None:
+        manifest = self.make_backup(tmp_path)
+        with open(manifest) as f:
+            assert read_manifest_header(f) == ("blake2b", str(tmp_path / "backup"))
+            records = list(read_manifest(f))
+        assert records == sorted(records)
+        assert [record.path for record in records][0] == "small"
+        assert records[0].partial == records[0].full
+        by_path = {record.path: record for record in records}
+        assert by_path["sub/large"].full == full_digest(
+            str(tmp_path / "backup" / "sub" / "large")
+        )
+
+    def test_find_in_manifest(self, tmp_path: Path) -> None:
+        manifest = self.make_backup(tmp_path)
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        a = write(tmp_path / "host" / "a", b"abc")
+        b = write(tmp_path / "host" / "b", b"a" * size)
+        half = size // 2
+        write(tmp_path / "host" / "c", b"a" * half + b"c" + b"a" * (half - 1))
+        write(tmp_path / "host" / "d", b"c" * size)
+        write(tmp_path / "host" / "e", b"unique size")
+        stats = Stats()
+        groups = list(find_in_manifest(str(tmp_path / "host"), manifest, stats))
+        assert [[e.path for e in g.entries] for g in groups] == [
+            [a, str(tmp_path / "backup" / "small")],
+            [b, str(tmp_path / "backup" / "sub" / "large")],
+        ]
+        assert groups[0].kind == "manifest"
+        # "e" is never opened, "d" only partially.
+        assert stats.partial.files == 4
+        assert stats.full.files == 2
+
+    def test_max_memory(self, tmp_path: Path) -> None:
+        manifest = self.make_backup(tmp_path)
+        write(tmp_path / "host" / "a", b"abc")
+        groups = find_in_manifest(
+            str(tmp_path / "host"), manifest, Stats(), max_memory=1
+        )
+        assert len(list(groups)) == 1
+
+    def test_unsorted(self, tmp_path: Path) -> None:
+        records = [ManifestRecord(2, "b", "b", "x"), ManifestRecord(1, "a", "a", "y")]
+        lines = [find_dupes_by_size.format_manifest_record(r) for r in records]
+        with pytest.raises(ValueError, match="not sorted: y"):
+            list(read_manifest(io.StringIO("".join(lines))))
+
+    def test_invalid_header(self) -> None:
+        with pytest.raises(ValueError, match="Not a manifest"):
+            read_manifest_header(io.StringIO("1 a a x\n"))
+
+
+class TestFunctionCheckForDuplicates:
+    def test_size_only(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "dir" / "b", b"xyz")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path))
+        assert "rm -f " + shlex.quote(a) in output
+        assert "rm -f " + shlex.quote(b) in output
+        assert "Duplicates found: 1" in output
+
+    def test_verify(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "dir" / "b", b"abc")
+        c = write(tmp_path / "c", b"xyz")
+        write(tmp_path / "d", b"singleton")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), verify=True)
+        assert "rm -f " + shlex.quote(a) in output
+        assert "rm -f " + shlex.quote(b) in output
+        assert "rm -f " + shlex.quote(c) not in output
+        assert "Duplicates found: 1" in output
+        assert "Size: 4 files, 0 bytes read, 9 bytes avoided" in output
+
+    def test_max_memory(self, tmp_path: Path) -> None:
+        for i in range(20):
+            write(tmp_path / "{:02}".format(i), b"x" * (i % 3))
+        with Capturing() as expected:
+            check_for_duplicates(str(tmp_path), verify=True)
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), verify=True, max_memory=1000)
+        assert output == expected
+        assert "Duplicates found: 3" in output
+
+    def test_hardlinks(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = str(tmp_path / "b")
+        os.link(a, b)
+        c = write(tmp_path / "c", b"abc")
+        os.symlink(c, str(tmp_path / "d"))
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), verify=True)
+        assert output[1:] == [
+            "-----------------------------------------",
+            "# Hardlinks to the same inode, deleting one frees no space:",
+            "# " + shlex.quote(a),
+            "# " + shlex.quote(b),
+            "-----------------------------------------",
+            "rm -f " + shlex.quote(a),
+            "rm -f " + shlex.quote(c),
+            "Duplicates found: 1",
+            "Hardlink sets found: 1",
+            "Reclaimable bytes: 3",
+            "Size: 2 files, 0 bytes read, 0 bytes avoided",
+            "Partial digest: 2 files, 6 bytes read, 0 bytes avoided",
+            "Full digest: 0 files, 0 bytes read, 0 bytes avoided",
+            "Compare: 0 files, 0 bytes read, 0 bytes avoided",
+        ]
+
+    def test_shell_quoting(self, tmp_path: Path) -> None:
+        a = write(tmp_path / 'it\'s "a"', b"abc")
+        b = write(tmp_path / "$b", b"abc")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path))
+        assert shlex.split(output[2]) == ["rm", "-f", b]
+        assert shlex.split(output[3]) == ["rm", "-f", a]
+
+    def test_format_jsonl(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), verify=True, output_format="jsonl")
+        assert len(output) == 1
+        record = json.loads(output[0])
+        assert record["type"] == "duplicates"
+        assert record["size"] == 3
+        assert len(record["digest"]) == 32
+        assert record["paths"] == [a, b]
+        assert record["inodes"] == [os.stat(a).st_ino, os.stat(b).st_ino]
+
+    def test_format_nul(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        c = write(tmp_path / "c", b"a")
+        d = write(tmp_path / "d", b"a")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), output_format="nul")
+        assert output == ["\0".join((c, d, "", a, b, "", ""))]
+
+    def test_stats_json(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "b", b"abc")
+        with Capturing(stream="stderr") as output:
+            check_for_duplicates(
+                str(tmp_path), verify=True, output_format="jsonl", stats_format="json"
+            )
+        report = json.loads(output[-1])
+        assert report["groups"]["duplicates"] == 1
+        assert report["reclaimable_bytes"] == 3
+        assert report["stages"]["partial"]["files"] == 2
+
+    def test_hash_sha256(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"abc")
+        write(tmp_path / "b", b"abc")
+        with Capturing() as output:
+            check_for_duplicates(
+                str(tmp_path),
+                verify=True,
+                output_format="jsonl",
+                hash_algorithm="sha256",
+                buffer_size=find_dupes_by_size.SAMPLE_SIZE,
+            )
+        assert json.loads(output[0])["digest"] == hashlib.sha256(b"abc").hexdigest()
+
+    def test_action(self, tmp_path: Path) -> None:
+        a = write(tmp_path / "a", b"abc")
+        b = write(tmp_path / "b", b"abc")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), action="hardlink")
+        assert "Hardlink: 1 files, 3 bytes reclaimed, 0 skipped" in output
+        assert os.path.samefile(a, b)
+
+    def test_reclaimable_external_hardlink(self, tmp_path: Path) -> None:
+        write(tmp_path / "a", b"x" * 100000)
+        write(tmp_path / "b", b"x" * 100000)
+        write(tmp_path / "s" / "c", b"x" * 100000)
+        os.link(tmp_path / "s" / "c", tmp_path / "s" / "c2")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), action="hardlink", dry_run=True)
+        # Replacing s/c frees nothing: its data is kept by s/c2.
+        assert "Reclaimable bytes: 100000" in output
+        assert "Dry run Hardlink: 2 files, 100000 bytes reclaimed, 0 skipped" in output
+
+    def make_trees(self, tmp_path: Path) -> None:
+        for copy in ("photos", "backup/photos"):
+            write(tmp_path / copy / "a.jpg", b"aaa")
+            write(tmp_path / copy / "sub" / "b.jpg", b"bbbb")
+        write(tmp_path / "c.jpg", b"ccccc")
+        write(tmp_path / "d.jpg", b"ccccc")
+
+    def test_action_dirs_dry_run(self, tmp_path: Path) -> None:
+        self.make_trees(tmp_path)
+        with Capturing() as output:
+            check_for_duplicates(
+                str(tmp_path), dirs=True, action="delete", dry_run=True
+            )
+        assert "Reclaimable bytes: 12" in output
+        assert "Dry run Delete: 3 files, 12 bytes reclaimed, 0 skipped" in output
+
+    def test_action_dirs(self, tmp_path: Path) -> None:
+        self.make_trees(tmp_path)
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), dirs=True, action="delete")
+        assert "Delete: 3 files, 12 bytes reclaimed, 0 skipped" in output
+        # The first tree of the group is kept.
+        assert not (tmp_path / "photos").exists()
+        assert (tmp_path / "backup" / "photos" / "sub" / "b.jpg").exists()
+
+    def make_nested_trees(self, tmp_path: Path) -> str:
+        for copy in ("A", "B"):
+            write(tmp_path / "t" / copy / "g", b"gg")
+            write(tmp_path / "t" / copy / "x" / "f", b"f" * 30000)
+        write(tmp_path / "t" / "C" / "f", b"f" * 30000)
+        return str(tmp_path / "t")
+
+    def test_action_dirs_nested_dry_run(self, tmp_path: Path) -> None:
+        root = self.make_nested_trees(tmp_path)
+        with Capturing() as output:
+            check_for_duplicates(root, dirs=True, action="delete", dry_run=True)
+        assert "Reclaimable bytes: 60002" in output
+        assert "Dry run Delete: 3 files, 60002 bytes reclaimed, 0 skipped" in output
+
+    def test_action_dirs_nested(self, tmp_path: Path) -> None:
+        root = self.make_nested_trees(tmp_path)
+        with Capturing() as output:
+            check_for_duplicates(root, dirs=True, action="delete")
+        assert "Delete: 3 files, 60002 bytes reclaimed, 0 skipped" in output
+        assert sorted(os.listdir(root)) == ["A"]
+        assert os.path.getsize(os.path.join(root, "A", "x", "f")) == 30000
+
+    def test_action_dirs_hardlink(self, tmp_path: Path) -> None:
+        self.make_trees(tmp_path)
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path), dirs=True, action="hardlink")
+        assert "Hardlink: 3 files, 12 bytes reclaimed, 0 skipped" in output
+        assert os.path.samefile(
+            tmp_path / "photos" / "sub" / "b.jpg",
+            tmp_path / "backup" / "photos" / "sub" / "b.jpg",
+        )
+
+    def test_cache_second_run_reads_nothing(self, tmp_path: Path) -> None:
+        size = 4 * find_dupes_by_size.SAMPLE_SIZE
+        write(tmp_path / "tree" / "a", b"a" * size)
+        write(tmp_path / "tree" / "b", b"a" * size)
+        write(tmp_path / "tree" / "c", b"c" * size)
+        cache_file = str(tmp_path / "cache.sqlite")
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path / "tree"), cache_file=cache_file)
+        assert (
+            "Full digest: 2 files, {} bytes read, 0 bytes avoided".format(2 * size)
+            in output
+        )
+        with Capturing() as output:
+            check_for_duplicates(str(tmp_path / "tree"), cache_file=cache_file)
+        assert "Duplicates found: 1" in output
+        assert (
+            "Partial digest: 3 files, 0 bytes read, {} bytes avoided".format(
+                size - 2 * find_dupes_by_size.SAMPLE_SIZE
+            )
+            in output
+        )
+        assert "Full digest: 2 files, 0 bytes read, 0 bytes avoided" in output
+        assert "Cache: 5 hits, 0 misses" in output
+
+
+class TestBenchmark:
+    def test_generate_tree(self, tmp_path: Path) -> None:
+        summary = generate_tree(str(tmp_path), files=50, depth=2, fanout=2, seed=1)
+        assert summary["dirs"] == 7
+        assert summary["files"] == 50
+        paths = [os.path.join(d, f) for d, _, files in os.walk(tmp_path) for f in files]
+        assert len(paths) == 50
+        assert sum(os.path.getsize(p) for p in paths) >= summary["bytes"]
+
+    def test_generate_tree_reproducible(self, tmp_path: Path) -> None:
+        a = generate_tree(str(tmp_path / "a"), files=20, seed=3)
+        b = generate_tree(str(tmp_path / "b"), files=20, seed=3)
+        assert a == b
+
+    def test_run_benchmark(self, tmp_path: Path) -> None:
+        tiny = {"files": 10, "depth": 1, "fanout": 2, "sizes": "small"}
+        with mock.patch.dict(SCENARIOS, {"tiny": tiny}):
+            current = run_benchmark(
+                str(tmp_path), ["tiny"], ["size", "verify"], repeat=1
+            )
+        result = current["results"]["tiny/verify"]
+        assert result["stats"]["walk"]["files"] == 10
+        assert sorted(current["results"]) == ["tiny/size", "tiny/verify"]
+
+    def test_compare(self) -> None:
+        def results(seconds: float) -> dict:
+            return {"results": {"large-files/size": {"seconds": seconds}}}
+
+        with Capturing():
+            assert compare(results(1.0), results(1.0)) == []
+            assert compare(results(1.1), results(1.0)) == []
+            assert compare(results(2.0), results(1.0)) == ["large-files/size"]
+            # Differences below the noise floor are never regressions.
+            assert compare(results(0.005), results(0.001)) == []
 
 
 class TestIntetration:
@@ -11,3 +1172,57 @@ class TestIntetration:
         output = subprocess.check_output(["find-dupes-by-size.py", "--version"])
         assert output
         assert "find-dupes-by-size.py" in str(output)
+
+    def test_cache_locked(self, tmp_path: Path) -> None:
+        error = find_dupes_by_size.sqlite3.OperationalError("database is locked")
+        argv = ["find-dupes-by-size.py", "--cache-file", "cache.sqlite", str(tmp_path)]
+        with mock.patch("sys.argv", argv), mock.patch.object(
+            find_dupes_by_size, "check_for_duplicates", side_effect=error
+        ):
+            with Capturing(stream="stderr") as stderr:
+                with pytest.raises(SystemExit) as e:
+                    find_dupes_by_size.main()
+        assert e.value.code == 1
+        assert "cache.sqlite: database is locked" in stderr.tostring()
+
+    def test_export_manifest_unwritable(self, tmp_path: Path) -> None:
+        write(tmp_path / "tree" / "a", b"abc")
+        manifest = str(tmp_path / "missing" / "manifest")
+        argv = [
+            "find-dupes-by-size.py",
+            "--export-manifest",
+            manifest,
+            str(tmp_path / "tree"),
+        ]
+        with mock.patch("sys.argv", argv):
+            with Capturing(stream="stderr") as stderr:
+                with pytest.raises(SystemExit) as e:
+                    find_dupes_by_size.main()
+        assert e.value.code == 1
+        assert "error: {}: ".format(manifest) in stderr.tostring()
+
+    def test_one_file_system_missing(self, tmp_path: Path) -> None:
+        missing = str(tmp_path / "missing")
+        argv = ["find-dupes-by-size.py", "--one-file-system", missing]
+        with mock.patch("sys.argv", argv):
+            with Capturing(stream="stderr") as stderr:
+                with pytest.raises(SystemExit) as e:
+                    find_dupes_by_size.main()
+        assert e.value.code == 2
+        assert "{}: No such file or directory".format(missing) in stderr.tostring()
+
+    def test_against_format_nul(self, tmp_path: Path) -> None:
+        argv = [
+            "find-dupes-by-size.py",
+            "--against",
+            str(tmp_path / "manifest"),
+            "--format",
+            "nul",
+            str(tmp_path),
+        ]
+        with mock.patch("sys.argv", argv):
+            with Capturing(stream="stderr") as stderr:
+                with pytest.raises(SystemExit) as e:
+                    find_dupes_by_size.main()
+        assert e.value.code == 2
+        assert "--against cannot be combined with --format nul" in stderr.tostring()
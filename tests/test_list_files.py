@@ -1,14 +1,28 @@
+import os
+import shutil
+import sqlite3
 import subprocess
+import time
+from pathlib import Path
+from typing import Iterator, List, Tuple
 from unittest import mock
 
+import pytest
+from stdout_stderr_capturing import Capturing
+
 from jfscripts.list_files import (
+    DirectoryIndex,
+    GlobPattern,
     _list_files_all,  # type: ignore
     _list_files_filter,  # type: ignore
     _split_glob,  # type: ignore
     common_path,
     doc_examples,
     is_glob,
+    iter_files,
     list_files,
+    main,
+    match_glob,
 )
 from tests._helper import is_executable
 
@@ -64,7 +78,81 @@ class TestFunctionSplitGlob:
         assert _split_glob("t*st/a/l*l/lol/*") == (".", "t*st/a/l*l/lol/*")
 
 
+class TestFunctionMatchGlob:
+    def test_name(self) -> None:
+        assert match_glob("a/b/node_modules", "node_modules")
+
+    def test_name_glob(self) -> None:
+        assert match_glob("a/b/c.tmp", "*.tmp")
+        assert not match_glob("a/b.tmp/c", "*.tmp")
+
+    def test_path(self) -> None:
+        assert match_glob("data/2024/raw", "data/*/raw")
+        assert not match_glob("other/data/2024/raw", "data/*/raw")
+
+    def test_segments(self) -> None:
+        assert not match_glob("data/2024/01/raw", "data/*/raw")
+        assert match_glob("data/2024/01/raw", "data/**/raw")
+
+
+class TestClassGlobPattern:
+    def test_name_at_any_depth(self) -> None:
+        pattern = GlobPattern("*.txt")
+        assert pattern.match("a.txt")
+        assert pattern.match("a/b/c.txt")
+        assert not pattern.match("a.txt/b")
+
+    def test_segments(self) -> None:
+        pattern = GlobPattern("data/2024-*/raw/*.csv")
+        assert pattern.match("data/2024-01/raw/x.csv")
+        assert not pattern.match("data/2024-01/x/raw/x.csv")
+        assert not pattern.match("data/2023-01/raw/x.csv")
+        assert not pattern.match("data/2024-01/raw/sub/x.csv")
+
+    def test_asterisk_within_segment(self) -> None:
+        assert GlobPattern("*/a.txt").match("b/a.txt")
+        assert not GlobPattern("*/a.txt").match("b/c/a.txt")
+
+    def test_double_asterisk(self) -> None:
+        pattern = GlobPattern("data/**/raw/*.csv")
+        assert pattern.match("data/raw/x.csv")
+        assert pattern.match("data/a/b/raw/x.csv")
+        assert not pattern.match("other/raw/x.csv")
+        assert GlobPattern("data/**").match("data/a/b")
+        assert GlobPattern("**").match("a/b")
+        assert GlobPattern("**/**/*.txt").match("a.txt")
+
+    def test_character_sequence(self) -> None:
+        assert GlobPattern("*/[ab].txt").match("x/a.txt")
+        assert not GlobPattern("*/[!ab].txt").match("x/a.txt")
+
+    def test_descend(self) -> None:
+        pattern = GlobPattern("data/2024-*/raw/*.csv")
+        assert pattern.descend(pattern.states("data/2024-01"))
+        assert not pattern.descend(pattern.states("data/2023-01"))
+        assert not pattern.descend(pattern.states("other"))
+        assert pattern.descend(pattern.states("data/2024-01/raw"))
+        assert not pattern.descend(pattern.states("data/2024-01/raw/sub"))
+
+
 class TestFunctionListFilesAll:
+    def test_jobs(self, tmp_path: Path) -> None:
+        for path in (
+            "data/2024-01/raw/a.csv",
+            "data/2024-01/raw/deep/b.csv",
+            "data/2024-01/other/c.csv",
+            "data/2023-12/raw/d.csv",
+            "data/2024-02/raw/e.txt",
+        ):
+            (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / path).write_text("")
+        (tmp_path / "link").symlink_to(tmp_path / "data")
+        for pattern in ("data/2024-*/raw/*.csv", "*.csv", "data/**/*.txt"):
+            assert _list_files_filter(
+                str(tmp_path), pattern, jobs=4
+            ) == _list_files_filter(str(tmp_path), pattern)
+        assert _list_files_all(str(tmp_path), jobs=4) == _list_files_all(str(tmp_path))
+
     @mock.patch("os.walk")
     def test_only_files(self, os_walk: mock.Mock) -> None:
         os_walk.return_value = (("a", (), ("a.txt", "b.txt")),)
@@ -110,6 +198,33 @@ class TestFunctionListFilesFilter:
         result = _list_files_filter("a", "*/a.txt")
         assert result == ["a/b/a.txt"]
 
+    def test_prune(self, tmp_path: Path) -> None:
+        for path in (
+            "data/2024-01/raw/a.csv",
+            "data/2024-01/raw/deep/b.csv",
+            "data/2024-01/other/c.csv",
+            "data/2023-12/raw/d.csv",
+            "data/2024-02/raw/e.txt",
+        ):
+            (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / path).write_text("")
+        # os.walk() lists each visited directory with os.scandir().
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            result = _list_files_filter(str(tmp_path), "data/2024-*/raw/*.csv")
+        assert result == [str(tmp_path / "data/2024-01/raw/a.csv")]
+        visited = [
+            os.path.relpath(call.args[0], str(tmp_path))
+            for call in scandir.call_args_list
+        ]
+        assert sorted(visited) == [
+            ".",
+            "data",
+            "data/2024-01",
+            "data/2024-01/raw",
+            "data/2024-02",
+            "data/2024-02/raw",
+        ]
+
     @mock.patch("os.walk")
     def test_glob_character_seq(self, os_walk: mock.Mock) -> None:
         os_walk.return_value = (("a", (), ("a.mscx", "b.mscz")),)
@@ -148,6 +263,137 @@ class TestFunctionListFiles:
         ]
 
 
+class TestFunctionIterFiles:
+    @mock.patch("os.walk")
+    def test_lazy(self, os_walk: mock.Mock) -> None:
+        def walk(path: str) -> Iterator[Tuple[str, List[str], List[str]]]:
+            yield ("/data", [], ["b.txt", "a.txt"])
+            raise RuntimeError("walked too far")
+
+        os_walk.side_effect = walk
+        files = iter_files(["/data/*.txt"])
+        assert next(files) == "/data/b.txt"
+        assert next(files) == "/data/a.txt"
+        with pytest.raises(RuntimeError):
+            next(files)
+
+    @mock.patch("os.walk")
+    def test_sort(self, os_walk: mock.Mock) -> None:
+        os_walk.return_value = (("/data", (), ("b.txt", "a.txt")),)
+        assert list(iter_files(["/data/*.txt"])) == ["/data/b.txt", "/data/a.txt"]
+        assert list(iter_files(["/data/*.txt"], sort=True)) == [
+            "/data/a.txt",
+            "/data/b.txt",
+        ]
+
+    def test_multiple_files(self) -> None:
+        assert list(iter_files(["b.txt", "a.txt"], sort=True)) == ["b.txt", "a.txt"]
+
+    def test_single_file(self) -> None:
+        assert list(iter_files(["/mnt/lol.txt"])) == ["/mnt/lol.txt"]
+
+
+class TestClassDirectoryIndex:
+    def make_tree(self, tmp_path: Path) -> Path:
+        root = tmp_path / "tree"
+        for path in ("a/x.txt", "a/b/y.txt", "c/z.csv", "w.txt"):
+            (root / path).parent.mkdir(parents=True, exist_ok=True)
+            (root / path).write_text("")
+        self.age(root)
+        return root
+
+    def age(self, root: Path) -> None:
+        past = time.time() - 3600
+        for d in [root] + [p for p in root.rglob("*") if p.is_dir()]:
+            os.utime(d, (past, past))
+
+    def query(self, root: Path, index: DirectoryIndex) -> List[str]:
+        return [
+            os.path.relpath(p, root)
+            for p in _list_files_filter(str(root), "*.txt", index=index)
+        ]
+
+    def test_unchanged(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        index = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        assert self.query(root, index) == ["a/b/y.txt", "a/x.txt", "w.txt"]
+        assert (index.hits, index.misses) == (0, 4)
+        index.close()
+        index = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        with mock.patch("os.scandir") as scandir:
+            assert self.query(root, index) == ["a/b/y.txt", "a/x.txt", "w.txt"]
+        scandir.assert_not_called()
+        assert (index.hits, index.misses) == (4, 0)
+        index.close()
+
+    def test_changed(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        index = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        self.query(root, index)
+        (root / "a" / "b" / "new.txt").write_text("")
+        assert self.query(root, index) == [
+            "a/b/new.txt",
+            "a/b/y.txt",
+            "a/x.txt",
+            "w.txt",
+        ]
+        assert index.misses == 5
+
+    def test_recently_modified(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        os.utime(root / "c")
+        index = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        self.query(root, index)
+        self.query(root, index)
+        assert (index.hits, index.misses) == (3, 5)
+
+    def test_removed(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        index = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        self.query(root, index)
+        shutil.rmtree(root / "a")
+        assert self.query(root, index) == ["w.txt"]
+        rows = index.connection.execute("SELECT path FROM directories").fetchall()
+        assert sorted(os.fsdecode(row[0]) for row in rows) == [
+            str(root),
+            str(root / "c"),
+        ]
+
+    def test_commit_interval(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        index = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        with mock.patch.object(DirectoryIndex, "COMMIT_INTERVAL", 3):
+            self.query(root, index)
+        # An interrupted walk keeps the committed listings.
+        other = DirectoryIndex(str(tmp_path / "index.sqlite"))
+        count = other.connection.execute("SELECT COUNT(*) FROM directories")
+        assert count.fetchone()[0] == 3
+        other.close()
+        index.close()
+
+    def test_shared(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        with mock.patch.object(DirectoryIndex, "COMMIT_SECONDS", 0.0):
+            first = DirectoryIndex(str(tmp_path / "index.sqlite"))
+            second = DirectoryIndex(str(tmp_path / "index.sqlite"))
+            first.listdir(str(root / "a"))
+            assert self.query(root, second) == ["a/b/y.txt", "a/x.txt", "w.txt"]
+            assert (second.hits, second.misses) == (1, 3)
+        second.close()
+        first.close()
+
+    def test_list_files(self, tmp_path: Path) -> None:
+        root = self.make_tree(tmp_path)
+        index_file = str(tmp_path / "index.sqlite")
+        for _ in range(2):
+            assert list_files([str(root / "*.csv")], index_file=index_file) == [
+                str(root / "c" / "z.csv")
+            ]
+            assert list_files([str(root)], index_file=index_file) == _list_files_all(
+                str(root)
+            )
+
+
 class TestFunctionArgparseExamples:
     def test_without_arguments(self) -> None:
         result = (
@@ -202,3 +448,57 @@ class TestIntegration:
         output = subprocess.check_output(["list-files.py", "--version"])
         assert output
         assert "list-files.py" in str(output)
+
+    def test_option_sort(self, tmp_path: Path) -> None:
+        for name in ("c.txt", "a.txt", "b.txt"):
+            (tmp_path / name).write_text("")
+        output = subprocess.check_output(
+            ["list-files.py", "--sort", str(tmp_path)], encoding="utf-8"
+        )
+        assert output.splitlines() == [
+            str(tmp_path / name) for name in ("a.txt", "b.txt", "c.txt")
+        ]
+
+    def test_option_jobs(self, tmp_path: Path) -> None:
+        for name in ("a/c.txt", "b/a.txt", "b.txt"):
+            (tmp_path / name).parent.mkdir(exist_ok=True)
+            (tmp_path / name).write_text("")
+        output = subprocess.check_output(
+            ["list-files.py", "--jobs", "4", str(tmp_path / "*.txt")],
+            encoding="utf-8",
+        )
+        assert sorted(output.splitlines()) == [
+            str(tmp_path / name) for name in ("a/c.txt", "b.txt", "b/a.txt")
+        ]
+
+    def test_option_index_file(self, tmp_path: Path) -> None:
+        (tmp_path / "tree").mkdir()
+        (tmp_path / "tree" / "a.txt").write_text("")
+        command = [
+            "list-files.py",
+            "--index-file",
+            str(tmp_path / "index.sqlite"),
+            str(tmp_path / "tree" / "*.txt"),
+        ]
+        for _ in range(2):
+            output = subprocess.check_output(command, encoding="utf-8")
+            assert output == str(tmp_path / "tree" / "a.txt") + "\n"
+        assert (tmp_path / "index.sqlite").exists()
+
+    def test_index_locked(self, tmp_path: Path) -> None:
+        error = sqlite3.OperationalError("database is locked")
+        argv = ["list-files.py", "--index-file", "index.sqlite", str(tmp_path)]
+        with mock.patch("sys.argv", argv), mock.patch(
+            "jfscripts.list_files.iter_files", side_effect=error
+        ):
+            with Capturing(stream="stderr") as stderr:
+                with pytest.raises(SystemExit) as e:
+                    main()
+        assert e.value.code == 1
+        assert "index.sqlite: database is locked" in stderr.tostring()
+
+    def test_nothing_found(self, tmp_path: Path) -> None:
+        output = subprocess.check_output(
+            ["list-files.py", str(tmp_path / "*.txt")], encoding="utf-8"
+        )
+        assert output == "Nothing found to list. :-(\n"